@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+In-process snapshot of the quiz bank.
+Questions are drawn from a local, versioned copy of `hcia.quiz` so that serving
+a question never costs a database round trip. The snapshot is reloaded in the
+background and patched in place whenever a quiz is created or edited, a reload
+keeps the patches made while it ran and only makes a new version when the
+collection changed.
+An inverted index maps each tag to the _ids of its quiz, a session on some
+topics is drawn from the intersection of their posting sets, cached until the
+next change of the bank.
+"""
+
+import os
+import random
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import metrics
+from models.quiz import Quiz
+from repository import QuizRepository
+
+logger = logging.getLogger(__name__)
+
+
+def index_tags(records: Iterable[Quiz]) -> Dict[str, Set]:
+    """Inverted index of records: tag -> _ids of the quiz tagged with it"""
+    tags = {}
+    for quiz in records:
+        for tag in quiz.tags:
+            tags.setdefault(tag, set()).add(quiz._id)
+    return tags
+
+
+def place(records: List[Quiz], index: dict, tags: Dict[str, Set], record: Quiz) -> None:
+    """Insert or replace record in records, its index and its tag index"""
+    position = index.get(record._id)
+    if position is None:
+        index[record._id] = len(records)
+        records.append(record)
+    else:
+        for tag in records[position].tags:
+            posting = tags[tag]
+            posting.discard(record._id)
+            if not posting:
+                del tags[tag]
+        records[position] = record
+    for tag in record.tags:
+        tags.setdefault(tag, set()).add(record._id)
+
+
+BANK_REFRESH_SECONDS = int(os.environ.get("BANK_REFRESH_SECONDS", "300"))
+# Until a first load succeeds, it is retried after 1, 2, 4... seconds up to this
+BANK_RETRY_SECONDS = 60
+# Intersections of tags kept until the bank changes
+TAGGED_CACHE_SIZE = 256
+
+
+class QuizBank:
+    """Versioned in-memory copy of the quiz collection"""
+
+    def __init__(
+        self,
+        repository: QuizRepository,
+        refresh_seconds: int = BANK_REFRESH_SECONDS,
+        on_load: Callable[[List[Quiz]], None] = None,
+    ):
+        self._repository = repository
+        self._refresh_seconds = refresh_seconds
+        # Called with the records of each new snapshot, e.g. to index them
+        self._on_load = on_load
+        self._lock = threading.Lock()
+        # One load at a time, upserts made while it streams the collection
+        # are kept in _upserted and applied again on top of its snapshot
+        self._load_lock = threading.Lock()
+        self._upserted = None
+        self._stop = threading.Event()
+        self._thread = None
+        # Set once a snapshot was loaded, the bank may still be empty
+        self.loaded = threading.Event()
+        # Records live in a list, `_index` maps each _id to its position
+        self._records = []
+        self._index = {}
+        self._tags = {}
+        # frozenset of tags -> tuple of the _ids having them all
+        self._tagged = {}
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def load(self) -> bool:
+        """Reload the whole bank and swap it in as a new snapshot, unless
+        nothing changed. Return whether it was swapped in"""
+        with self._load_lock:
+            with self._lock:
+                self._upserted = {}
+            try:
+                with metrics.timed("bank.load"):
+                    records = list(self._repository.iter_bank())
+            except Exception:
+                with self._lock:
+                    self._upserted = None
+                raise
+            with self._lock:
+                upserted, self._upserted = self._upserted, {}
+                current = {quiz._id: quiz for quiz in self._records}
+            index = {quiz._id: i for i, quiz in enumerate(records)}
+            tags = index_tags(records)
+            for record in upserted.values():
+                place(records, index, tags, record)
+            # Same records, a new version would rebuild every derived index
+            changed = len(records) != len(current) or any(
+                current.get(quiz._id) != quiz for quiz in records
+            )
+            with self._lock:
+                # Upserted since current was read, they are in _records already
+                late, self._upserted = self._upserted, None
+                if changed:
+                    for record in late.values():
+                        place(records, index, tags, record)
+                    self._records = records
+                    self._index = index
+                    self._tags = tags
+                    self._tagged = {}
+                    self.version += 1
+        self.loaded.set()
+        if not changed:
+            return False
+        logger.info(
+            "[i]-> Quiz bank loaded : %d quiz (version %d)", len(records), self.version
+        )
+        if self._on_load is not None:
+            self._on_load(records)
+        return True
+
+    def _refresh_loop(self) -> None:
+        delay = 0
+        while not self._stop.wait(delay):
+            try:
+                self.load()
+                delay = self._refresh_seconds
+            except Exception as ex:
+                logger.error("[e]-> Exception in QuizBank.load() -> " + str(ex))
+                if self.loaded.is_set():
+                    delay = self._refresh_seconds
+                else:
+                    delay = min(delay * 2 or 1, BANK_RETRY_SECONDS)
+
+    def start(self) -> None:
+        """Load the bank then keep it fresh, from a background thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def upsert(self, quiz: Quiz) -> None:
+        """Insert or replace one quiz without reloading the bank"""
+        # The bank only keeps what serving a question needs
+        record = quiz.replace(chat_id=None, msg_id=None)
+        with self._lock:
+            if self._upserted is not None:
+                # A load is streaming, it must not swap this change away
+                self._upserted[record._id] = record
+            place(self._records, self._index, self._tags, record)
+            self._tagged = {}
+            self.version += 1
+
+    def get(self, quiz_id) -> Optional[Quiz]:
+        position = self._index.get(quiz_id)
+        return None if position is None else self._records[position]
+
+    def snapshot(self) -> Tuple[int, List[Quiz]]:
+        """Version and records of the current snapshot"""
+        with self._lock:
+            return self.version, list(self._records)
+
+    def tags(self) -> Dict[str, int]:
+        """Number of quiz of each tag"""
+        with self._lock:
+            return {tag: len(posting) for tag, posting in self._tags.items()}
+
+    def tagged(self, tags: Iterable[str]) -> Sequence:
+        """_ids of the quiz having every tag of tags"""
+        key = frozenset(tags)
+        with self._lock:
+            found = self._tagged.get(key)
+            if found is not None:
+                return found
+            postings = [self._tags.get(tag) for tag in key]
+            if not postings or not all(postings):
+                found = ()
+            else:
+                # Scan the smallest posting set, look the others up
+                postings.sort(key=len)
+                found = tuple(postings[0].intersection(*postings[1:]))
+            if len(self._tagged) >= TAGGED_CACHE_SIZE:
+                self._tagged.clear()
+            self._tagged[key] = found
+            return found
+
+    def draw(self, size: int, tags: Iterable[str] = ()) -> List[Quiz]:
+        """Pick up to size distinct quiz in random order, having every tag of
+        tags if any"""
+        if tags:
+            ids = self.tagged(tags)
+            picked = (self.get(i) for i in random.sample(ids, min(size, len(ids))))
+            # A reload may have dropped some in between
+            return [quiz for quiz in picked if quiz is not None]
+        records = self._records
+        return random.sample(records, min(size, len(records)))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Broadcast to every tracked chat, next to quiz traffic.
+A Broadcaster sends a message to --chats chats through the outbox and a fake
+Bot API, some of which blocked the bot, while quiz polls keep being sent on
+the poll lane. It reports the broadcast throughput against the global rate,
+the outbox latency of quiz polls meanwhile against an idle outbox, and checks
+that blocked chats are pruned from the registry.
+The broadcast is stopped halfway and left as a crashed process would leave
+it, then resumed by another Broadcaster: every chat must get the message
+once, give or take the calls in flight at the crash.
+Usage:
+    python -m benchmarks.broadcast --chats 100000 --global-rate 1000
+"""
+
+import time
+import random
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+from telegram import Poll
+
+import outbox
+from broadcast import BROADCAST_ID, Broadcaster
+from benchmarks.fakes import FakeMongoClient, fake_bot
+from benchmarks.load_test import percentile
+
+
+def poll_latencies(bot, rate: float, stop: threading.Event) -> list:
+    """Send quiz polls to chats of their own at rate until stop, return the
+    outbox latency of each"""
+    latencies = []
+    futures = []
+    chat_id = -(10**12)
+    while not stop.wait(1 / rate):
+        chat_id -= 1
+        enqueued = time.perf_counter()
+        future = outbox.send(
+            bot.send_poll,
+            chat_id,
+            "Question ?",
+            ["A", "B"],
+            type=Poll.QUIZ,
+            correct_option_id=0,
+            chat=chat_id,
+            priority=outbox.POLL,
+        )
+        future.add_done_callback(
+            lambda f, e=enqueued: latencies.append(time.perf_counter() - e)
+        )
+        futures.append(future)
+    for future in futures:
+        future.exception()
+    return latencies
+
+
+def measure_polls(bot, rate: float, seconds: float) -> list:
+    stop = threading.Event()
+    timer = threading.Timer(seconds, stop.set)
+    timer.start()
+    return poll_latencies(bot, rate, stop)
+
+
+def wait(broadcaster: Broadcaster) -> None:
+    while broadcaster.running():
+        time.sleep(0.01)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--chats", type=int, default=20000)
+    parser.add_argument("--blocked", type=float, default=0.05, help="share of chats")
+    parser.add_argument("--global-rate", type=float, default=1000)
+    parser.add_argument("--poll-rate", type=float, default=20, help="quiz polls/s")
+    parser.add_argument("--window", type=int, default=64)
+    parser.add_argument("--outbox-workers", type=int, default=32)
+    parser.add_argument("--api-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    # Every blocked chat would log a warning
+    logging.getLogger("outbox").setLevel(logging.ERROR)
+    # Per-chat limits don't apply, each chat gets one message
+    outbox.outbox = outbox.Outbox(args.outbox_workers, args.global_rate)
+    bot = fake_bot(args.api_latency)
+    users = list(range(1, args.chats + 1))
+    bot.request.blocked = set(random.sample(users, int(len(users) * args.blocked)))
+    bot_data = {"user_ids": set(users)}
+    state = FakeMongoClient().hcia.state
+
+    idle = measure_polls(bot, args.poll_rate, 1.0)
+    first = Broadcaster(state, window=args.window, checkpoint_seconds=0.5)
+    start = time.perf_counter()
+    first.start(bot, bot_data, text="Hello")
+    busy = measure_polls(bot, args.poll_rate, 1.0)
+    while first.progress()["sent"] < args.chats // 2:
+        time.sleep(0.01)
+    first.cancel()
+    wait(first)
+    # As left by a process stopped since its last checkpoint
+    state.update_one(
+        {"_id": BROADCAST_ID},
+        {"$set": {"done": False, "updated_at": datetime(2000, 1, 1)}},
+    )
+    second = Broadcaster(state, window=args.window)
+    second.resume(bot, bot_data)
+    wait(second)
+    elapsed = time.perf_counter() - start
+
+    job = second.progress()
+    sent = [bot.request.recipients[chat_id] for chat_id in users]
+    delivered = sum(1 for count in sent if count)
+    twice = sum(1 for count in sent if count > 1)
+    expected = args.chats - len(bot.request.blocked)
+    print(
+        "%d chats in %.1fs  %.0f sends/s (global rate %.0f/s)  %d pruned"
+        % (args.chats, elapsed, sum(sent) / elapsed, args.global_rate, job["pruned"])
+    )
+    print(
+        "quiz polls  idle p50 %.3fs p99 %.3fs  during broadcast p50 %.3fs p99 %.3fs"
+        % (
+            percentile(idle, 0.5),
+            percentile(idle, 0.99),
+            percentile(busy, 0.5),
+            percentile(busy, 0.99),
+        )
+    )
+    ok = (
+        delivered == expected
+        and twice <= args.window
+        and not bot_data["user_ids"] & bot.request.blocked
+        and job["done"]
+    )
+    print(
+        "delivered %d/%d  sent twice %d  registry %d chats  %s"
+        % (
+            delivered,
+            expected,
+            twice,
+            len(bot_data["user_ids"]),
+            "OK" if ok else "FAILED",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,572 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Offline stand-ins used by the benchmarks.
+FakeRequest answers Bot API calls locally (with an optional simulated network
+latency) and FakeMongoClient keeps collections in memory, supporting the subset
+of the pymongo API the bot relies on.
+"""
+
+import copy
+import time
+import random
+import itertools
+import threading
+from collections import Counter, defaultdict
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from telegram import Bot, Update
+from telegram.error import Unauthorized
+
+BOT_TOKEN = "123456:FAKE-TOKEN"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "hcia", "username": "hcia_bot"}
+
+
+class FakeRequest:
+    """Replacement for telegram.utils.request.Request"""
+
+    def __init__(self, latency: float = 0.0, first_id: int = 1):
+        self.latency = latency
+        self.calls = Counter()
+        # Messages and polls sent to each chat, chats which blocked the bot
+        self.recipients = Counter()
+        self.blocked = set()
+        # Fake Bot API servers sharing a database need disjoint message/poll ids
+        self._ids = itertools.count(first_id)
+        self._lock = threading.Lock()
+        self.con_pool_size = 1
+
+    def stop(self) -> None:
+        pass
+
+    def _message(self, data: dict, **fields) -> dict:
+        message = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+        }
+        message.update(fields)
+        return message
+
+    def post(self, url: str, data: dict = None, timeout: float = None):
+        method = url.rsplit("/", 1)[-1]
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        data = data or {}
+        if method in ("sendMessage", "sendPoll") and "chat_id" in data:
+            chat_id = int(data["chat_id"])
+            if chat_id in self.blocked:
+                raise Unauthorized("Forbidden: bot was blocked by the user")
+            with self._lock:
+                self.recipients[chat_id] += 1
+
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendPoll":
+            return self._message(data, poll=poll_dict(data, str(next(self._ids))))
+        if method == "stopPoll":
+            return poll_dict(data, str(next(self._ids)), is_closed=True)
+        if method == "sendPhoto":
+            photo = data.get("photo")
+            file_id = photo if isinstance(photo, str) else "file-" + str(id(photo))
+            return self._message(
+                data,
+                photo=[
+                    {
+                        "file_id": file_id,
+                        "file_unique_id": file_id,
+                        "width": 1,
+                        "height": 1,
+                    }
+                ],
+            )
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(data, text=data.get("text", ""))
+        return True
+
+
+def poll_dict(data: dict, poll_id: str, is_closed: bool = False) -> dict:
+    return {
+        "id": poll_id,
+        "question": data.get("question", ""),
+        "options": [
+            {"text": str(option), "voter_count": 0}
+            for option in data.get("options", [])
+        ],
+        "total_voter_count": 0,
+        "is_closed": is_closed,
+        "is_anonymous": data.get("is_anonymous", True),
+        "type": data.get("type", "quiz"),
+        "allows_multiple_answers": False,
+        "correct_option_id": data.get("correct_option_id"),
+    }
+
+
+def fake_bot(latency: float = 0.0, first_id: int = 1) -> Bot:
+    return Bot(BOT_TOKEN, request=FakeRequest(latency, first_id))
+
+
+_update_ids = itertools.count(1)
+
+
+def command_update(bot: Bot, chat_id: int, text: str) -> Update:
+    command = text.split()[0]
+    return Update.de_json(
+        {
+            "update_id": next(_update_ids),
+            "message": {
+                "message_id": next(_update_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+                "text": text,
+                "entities": [
+                    {"type": "bot_command", "offset": 0, "length": len(command)}
+                ],
+            },
+        },
+        bot,
+    )
+
+
+def poll_update(
+    bot: Bot, poll_id: str, nb_options: int, voted: int, correct: int
+) -> Update:
+    """Update of a private quiz poll after the user voted for option `voted`"""
+    return Update.de_json(
+        {
+            "update_id": next(_update_ids),
+            "poll": {
+                "id": poll_id,
+                "question": "?",
+                "options": [
+                    {"text": str(i), "voter_count": 1 if i == voted else 0}
+                    for i in range(nb_options)
+                ],
+                "total_voter_count": 1,
+                "is_closed": False,
+                "is_anonymous": True,
+                "type": "quiz",
+                "allows_multiple_answers": False,
+                "correct_option_id": correct,
+            },
+        },
+        bot,
+    )
+
+
+def poll_answer_update(
+    bot: Bot, poll_id: str, user_id: int, option_ids: list
+) -> Update:
+    """Update sent when a user answers a non anonymous poll"""
+    return Update.de_json(
+        {
+            "update_id": next(_update_ids),
+            "poll_answer": {
+                "poll_id": poll_id,
+                "user": {"id": user_id, "is_bot": False, "first_name": "user"},
+                "option_ids": list(option_ids),
+            },
+        },
+        bot,
+    )
+
+
+def poll_message(
+    chat_id: int,
+    message_id: int,
+    question: str,
+    options: list,
+    correct: int,
+    reply_to: dict = None,
+) -> dict:
+    """Message of a quiz poll sent by a user in a private chat"""
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+        "poll": poll_dict(
+            {"question": question, "options": options, "correct_option_id": correct},
+            "poll-%d-%d" % (chat_id, message_id),
+        ),
+    }
+    if reply_to is not None:
+        message["reply_to_message"] = reply_to
+    return message
+
+
+def message_update(bot: Bot, message: dict) -> Update:
+    return Update.de_json({"update_id": next(_update_ids), "message": message}, bot)
+
+
+def photo_message(chat_id: int, message_id: int, file_id: str, reply_to: dict) -> dict:
+    """Message of a photo sent by a user in reply to reply_to"""
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "user"},
+        "photo": [
+            {"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}
+        ],
+        "reply_to_message": reply_to,
+    }
+
+
+def random_quiz(number: int) -> dict:
+    options = ["Option %d of quiz %d" % (i, number) for i in range(4)]
+    return {
+        "question": "Question %d ?" % number,
+        "options": options,
+        "response_id": random.randrange(len(options)),
+        "explanation": None,
+    }
+
+
+# In-memory Mongo
+
+
+def _get(document: dict, path: str):
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+_MISSING = object()
+
+
+def _match_value(value, condition) -> bool:
+    if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+        for operator, argument in condition.items():
+            if operator == "$in":
+                ok = value in argument or (
+                    isinstance(value, list) and any(v in argument for v in value)
+                )
+            elif operator == "$nin":
+                ok = not _match_value(value, {"$in": argument})
+            elif operator == "$exists":
+                ok = (value is not _MISSING) == bool(argument)
+            elif operator == "$not":
+                ok = not _match_value(value, argument)
+            elif operator == "$ne":
+                ok = value != argument
+            elif operator == "$lt":
+                ok = value is not _MISSING and value < argument
+            elif operator == "$lte":
+                ok = value is not _MISSING and value <= argument
+            elif operator == "$gt":
+                ok = value is not _MISSING and value > argument
+            elif operator == "$gte":
+                ok = value is not _MISSING and value >= argument
+            else:
+                raise NotImplementedError(operator)
+            if not ok:
+                return False
+        return True
+    if isinstance(value, list) and not isinstance(condition, list):
+        return condition in value
+    return value == condition
+
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(document, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, sub) for sub in condition):
+                return False
+        elif not _match_value(_get(document, key), condition):
+            return False
+    return True
+
+
+def project(document: dict, projection) -> dict:
+    if not projection:
+        return copy.deepcopy(document)
+    included = {k for k, v in projection.items() if v}
+    if included:
+        result = {k: copy.deepcopy(document[k]) for k in included if k in document}
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+        return result
+    return {
+        k: copy.deepcopy(v)
+        for k, v in document.items()
+        if k not in projection or projection[k]
+    }
+
+
+def _parent(document: dict, path: str):
+    """Container of a dotted path and its last key, created as needed"""
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    return document, parts[-1]
+
+
+def apply_update(document: dict, update: dict, inserting: bool = False) -> None:
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            parent, key = _parent(document, path)
+            if operator == "$set" or (operator == "$setOnInsert" and inserting):
+                parent[key] = copy.deepcopy(value)
+            elif operator == "$inc":
+                parent[key] = parent.get(key, 0) + value
+            elif operator == "$max":
+                parent[key] = max(parent.get(key, value), value)
+            elif operator == "$unset":
+                parent.pop(key, None)
+            elif operator == "$push":
+                parent.setdefault(key, []).append(copy.deepcopy(value))
+            elif operator == "$addToSet":
+                values = parent.setdefault(key, [])
+                each = value["$each"] if isinstance(value, dict) else [value]
+                for item in each:
+                    if item not in values:
+                        values.append(copy.deepcopy(item))
+            elif operator == "$pull":
+                parent[key] = [v for v in parent.get(key, []) if v != value]
+            elif operator == "$pullAll":
+                parent[key] = [v for v in parent.get(key, []) if v not in value]
+            elif operator != "$setOnInsert":
+                raise NotImplementedError(operator)
+
+
+class Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class FakeCollection:
+    """Thread safe in-memory collection"""
+
+    def __init__(self, name: str, latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.documents = {}
+        self.ops = Counter()
+        self._lock = threading.RLock()
+
+    def _op(self, name: str) -> None:
+        self.ops[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def create_index(self, keys, **kwargs) -> str:
+        self._op("create_index")
+        return str(keys)
+
+    def create_indexes(self, indexes) -> list:
+        self._op("create_indexes")
+        return [str(index) for index in indexes]
+
+    def _find(self, query):
+        with self._lock:
+            key = (query or {}).get("_id")
+            if key is not None and not isinstance(key, dict):
+                # Like the _id index, other lookups scan the collection
+                document = self.documents.get(key)
+                if document is None or not matches(document, query):
+                    return []
+                return [document]
+            return [d for d in self.documents.values() if matches(d, query)]
+
+    def find(self, query=None, projection=None, **kwargs):
+        self._op("find")
+        found = [project(d, projection) for d in self._find(query)]
+        limit = kwargs.get("limit")
+        return iter(found[:limit] if limit else found)
+
+    def find_one(self, query=None, projection=None, **kwargs):
+        self._op("find_one")
+        found = self._find(query)
+        return project(found[0], projection) if found else None
+
+    def count_documents(self, query, **kwargs) -> int:
+        self._op("count_documents")
+        return len(self._find(query))
+
+    def estimated_document_count(self) -> int:
+        self._op("estimated_document_count")
+        return len(self.documents)
+
+    def _insert(self, document: dict):
+        document.setdefault("_id", ObjectId())
+        with self._lock:
+            if document["_id"] in self.documents:
+                raise DuplicateKeyError("duplicate key " + str(document["_id"]))
+            self.documents[document["_id"]] = copy.deepcopy(document)
+        return document["_id"]
+
+    def insert_one(self, document: dict):
+        self._op("insert_one")
+        return Result(inserted_id=self._insert(document))
+
+    def insert_many(self, documents, ordered: bool = True):
+        self._op("insert_many")
+        return Result(inserted_ids=[self._insert(d) for d in documents])
+
+    def replace_one(self, query, document, upsert: bool = False):
+        self._op("replace_one")
+        with self._lock:
+            found = self._find(query)
+            if found:
+                document = dict(document, _id=found[0]["_id"])
+                self.documents[document["_id"]] = copy.deepcopy(document)
+                return Result(matched_count=1, upserted_id=None)
+            if upsert:
+                return Result(matched_count=0, upserted_id=self._insert(document))
+        return Result(matched_count=0, upserted_id=None)
+
+    def _update(self, query, update, upsert, many):
+        with self._lock:
+            found = self._find(query)
+            if not many:
+                found = found[:1]
+            for document in found:
+                apply_update(document, update)
+            if not found and upsert:
+                document = {
+                    k: v
+                    for k, v in query.items()
+                    if not k.startswith("$") and not isinstance(v, dict)
+                }
+                apply_update(document, update, inserting=True)
+                return Result(
+                    matched_count=0,
+                    modified_count=0,
+                    upserted_id=self._insert(document),
+                )
+        return Result(
+            matched_count=len(found), modified_count=len(found), upserted_id=None
+        )
+
+    def update_one(self, query, update, upsert: bool = False):
+        self._op("update_one")
+        return self._update(query, update, upsert, many=False)
+
+    def update_many(self, query, update, upsert: bool = False):
+        self._op("update_many")
+        return self._update(query, update, upsert, many=True)
+
+    def find_one_and_update(
+        self, query, update, projection=None, upsert=False, return_document=False
+    ):
+        self._op("find_one_and_update")
+        with self._lock:
+            found = self._find(query)
+            before = copy.deepcopy(found[0]) if found else None
+            result = self._update(query, update, upsert, many=False)
+            if return_document:
+                key = found[0]["_id"] if found else result.upserted_id
+                after = self.documents.get(key)
+                return project(after, projection) if after else None
+        return project(before, projection) if before else None
+
+    def delete_one(self, query):
+        self._op("delete_one")
+        with self._lock:
+            found = self._find(query)[:1]
+            for document in found:
+                del self.documents[document["_id"]]
+        return Result(deleted_count=len(found))
+
+    def delete_many(self, query):
+        self._op("delete_many")
+        with self._lock:
+            found = self._find(query)
+            for document in found:
+                del self.documents[document["_id"]]
+        return Result(deleted_count=len(found))
+
+    def bulk_write(self, requests, ordered: bool = True):
+        self._op("bulk_write")
+        for request in requests:
+            name = type(request).__name__
+            document = getattr(request, "_doc", None)
+            if name == "InsertOne":
+                self._insert(document)
+            elif name == "ReplaceOne":
+                self.replace_one(request._filter, document, upsert=request._upsert)
+            elif name == "UpdateOne":
+                self._update(request._filter, document, request._upsert, many=False)
+            elif name == "UpdateMany":
+                self._update(request._filter, document, request._upsert, many=True)
+            elif name == "DeleteOne":
+                self.delete_one(request._filter)
+            else:
+                raise NotImplementedError(name)
+        return Result(acknowledged=True)
+
+    def aggregate(self, pipeline):
+        self._op("aggregate")
+        with self._lock:
+            documents = list(self.documents.values())
+        for stage in pipeline:
+            if "$match" in stage:
+                documents = [d for d in documents if matches(d, stage["$match"])]
+            elif "$sample" in stage:
+                size = stage["$sample"]["size"]
+                documents = random.sample(documents, min(size, len(documents)))
+            elif "$limit" in stage:
+                documents = documents[: stage["$limit"]]
+            elif "$project" in stage:
+                documents = [project(d, stage["$project"]) for d in documents]
+            else:
+                raise NotImplementedError(list(stage))
+        return iter(copy.deepcopy(documents))
+
+
+class FakeDatabase:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._collections = defaultdict(self._new_collection)
+
+    def _new_collection(self):
+        return FakeCollection("collection", self.latency)
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        collection = self._collections[name]
+        collection.name = name
+        return collection
+
+    def ops(self) -> Counter:
+        total = Counter()
+        for collection in self._collections.values():
+            total.update(collection.ops)
+        return total
+
+
+class FakeMongoClient:
+    """In-memory replacement for pymongo.MongoClient"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._databases = {}
+
+    def __getattr__(self, name: str) -> FakeDatabase:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        if name not in self._databases:
+            self._databases[name] = FakeDatabase(self.latency)
+        return self._databases[name]
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Offline load test of the quiz answer path.
+Replays bursts of poll answers from many concurrent quiz takers through a real
+Dispatcher, with a fake Bot API and an in-memory Mongo, and compares in-order
+dispatch (RUN_ASYNC=0) with dispatch on the worker pool (RUN_ASYNC=1), then
+measures the overhead of write-behind state persistence on the latter.
+Telegram rate limits are lifted by default, pass --global-rate 30 --chat-rate 1
+to measure under the real ones.
+Usage:
+    python -m benchmarks.load_test --chats 200 --api-latency 0.02
+"""
+
+import time
+import argparse
+import threading
+from queue import Queue
+
+from telegram.ext import CallbackContext, Dispatcher
+
+import bot
+import outbox
+from bank import QuizBank
+from dedup import NearDuplicateIndex
+from media import MediaCache
+from persistence import StateStore
+from repository import QuizRepository
+from results import ResultStore
+from selection import AdaptiveSelector
+from sessions import SessionStore
+from benchmarks.fakes import FakeMongoClient, fake_bot, poll_answer_update, random_quiz
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def setup_store(nb_quiz: int, db_latency: float) -> FakeMongoClient:
+    """Point the bot module at a fresh in-memory Mongo holding nb_quiz quiz"""
+    client = FakeMongoClient()
+    client.hcia.quiz.insert_many([random_quiz(i) for i in range(nb_quiz)])
+    client.hcia.quiz.latency = db_latency
+    bot.quiz_repository = QuizRepository(client.hcia.quiz)
+    bot.duplicates = NearDuplicateIndex()
+    bot.quiz_bank = QuizBank(bot.quiz_repository, on_load=bot.duplicates.sync)
+    bot.quiz_bank.load()
+    bot.media = MediaCache(client.hcia.media)
+    bot.selector = AdaptiveSelector(bot.quiz_bank)
+    bot.results = ResultStore()
+    bot.sessions = SessionStore()
+    return client
+
+
+def setup_outbox(args) -> None:
+    """Fresh outbox, Telegram rate limits are lifted unless asked otherwise"""
+    outbox.PRIVATE_RATE = args.chat_rate
+    outbox.CHAT_BURST = max(outbox.CHAT_BURST, int(args.chat_rate))
+    outbox.outbox = outbox.Outbox(args.outbox_workers, args.global_rate)
+
+
+class Timing:
+    """Records the latency of each update, from enqueue to handler completion"""
+
+    def __init__(self, expected: int):
+        self.enqueued = {}
+        self.latencies = []
+        self.expected = expected
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def wrap(self, callback):
+        def timed(update, context, *args, **kwargs):
+            try:
+                return callback(update, context, *args, **kwargs)
+            finally:
+                latency = time.perf_counter() - self.enqueued[update.update_id]
+                with self._lock:
+                    self.latencies.append(latency)
+                    if len(self.latencies) >= self.expected:
+                        self.done.set()
+
+        return timed
+
+
+def flush_loop(store: StateStore, interval: float, stop: threading.Event) -> None:
+    while not stop.wait(interval):
+        store.flush(bot.sessions, {})
+
+
+def run(args, run_async: bool, persist: bool = False) -> dict:
+    client = setup_store(args.quiz, args.db_latency)
+    setup_outbox(args)
+    fake = fake_bot(args.api_latency)
+    dispatcher = Dispatcher(fake, Queue(), workers=args.workers)
+
+    rounds = bot.QUIZ_PER_SESSION - 1
+    timing = Timing(args.chats * rounds)
+    original = bot.receive_quiz_answer
+    bot.receive_quiz_answer = timing.wrap(original)
+    try:
+        bot.register_handlers(dispatcher, run_async=run_async)
+    finally:
+        bot.receive_quiz_answer = original
+
+    # Every chat is in the middle of a session
+    context = CallbackContext(dispatcher)
+    for chat_id in range(1, args.chats + 1):
+        bot.starting_quiz(context, chat_id)
+
+    stop = threading.Event()
+    if persist:
+        store = StateStore(client.hcia.sessions, client.hcia.state)
+        threading.Thread(
+            target=flush_loop, args=(store, args.flush_interval, stop), daemon=True
+        ).start()
+
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        # Burst: every quiz taker answers at once
+        answered = len(timing.latencies) + args.chats
+        for chat_id in range(1, args.chats + 1):
+            session = bot.sessions.get(chat_id)
+            quiz = session.questions[session.nb_question]
+            update = poll_answer_update(
+                fake, session.poll_id, chat_id, [quiz.response_id]
+            )
+            timing.enqueued[update.update_id] = time.perf_counter()
+            dispatcher.update_queue.put(update)
+        while len(timing.latencies) < answered:
+            time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    dispatcher.stop()
+    thread.join()
+
+    return {
+        "mode": ("async" if run_async else "in-order") + ("+state" if persist else ""),
+        "updates": len(timing.latencies),
+        "updates/s": len(timing.latencies) / elapsed,
+        "p50": percentile(timing.latencies, 0.5),
+        "p99": percentile(timing.latencies, 0.99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--quiz", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=bot.DISPATCHER_WORKERS)
+    parser.add_argument("--api-latency", type=float, default=0.02)
+    parser.add_argument("--db-latency", type=float, default=0.005)
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    parser.add_argument("--outbox-workers", type=int, default=32)
+    parser.add_argument("--global-rate", type=float, default=10000)
+    parser.add_argument("--chat-rate", type=float, default=10000)
+    args = parser.parse_args()
+
+    for run_async, persist in ((False, False), (True, False), (True, True)):
+        result = run(args, run_async, persist)
+        print(
+            "%(mode)-12s %(updates)6d updates  %(updates/s)9.1f updates/s"
+            "  p50 %(p50).3fs  p99 %(p99).3fs" % result
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Multi-worker check of the shared session store.
+Several bot workers, each with its own Dispatcher and fake Bot API, serve the
+same quiz sessions through MongoSessionStore (SESSION_BACKEND=mongo). Every
+poll answer is delivered to two different workers at once, as a retried webhook
+would be, and every session must still move exactly once per question with
+each answer scored once.
+Workers are processes sharing the MongoDB given by --mongo (e.g. a local
+mongod, the `hcia_bench` database is wiped), or threads sharing the in-memory
+stand-in when it is not given.
+Usage:
+    python -m benchmarks.multi_worker --workers 4 --chats 100
+    python -m benchmarks.multi_worker --workers 4 --mongo mongodb://localhost:27017
+"""
+
+import copy
+import time
+import queue
+import random
+import argparse
+import threading
+import multiprocessing
+
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher
+
+import bot
+import outbox
+from bank import QuizBank
+from media import MediaCache
+from repository import QuizRepository
+from results import ResultStore
+from selection import AdaptiveSelector
+from ingest import BoundedDispatcher
+from sessions import MongoSessionStore
+from benchmarks.fakes import FakeMongoClient, fake_bot, poll_answer_update, random_quiz
+
+# Poll and message ids of worker n start at (n + 1) * ID_RANGE
+ID_RANGE = 10**8
+
+
+def connect(args):
+    if args.mongo:
+        from pymongo import MongoClient
+
+        return MongoClient(args.mongo)[args.database]
+    return FakeMongoClient(args.db_latency)[args.database]
+
+
+def setup(database, args) -> None:
+    """Point the bot module of this process at the shared database"""
+    bot.quiz_repository = QuizRepository(database.quiz)
+    bot.quiz_bank = QuizBank(bot.quiz_repository)
+    bot.quiz_bank.load()
+    bot.media = MediaCache(database.media)
+    bot.selector = AdaptiveSelector(bot.quiz_bank)
+    bot.results = ResultStore()
+    bot.sessions = MongoSessionStore(database.sessions, bot.quiz_bank)
+    # Telegram rate limits are not what is measured here
+    outbox.PRIVATE_RATE = 10000
+    outbox.CHAT_BURST = 10000
+    outbox.outbox = outbox.Outbox(args.outbox_workers, 10000)
+
+
+def serve(number: int, args, inbox, results, database=None) -> None:
+    """One bot worker: feeds updates from inbox to its dispatcher until None"""
+    if database is None:
+        # Worker process, with its own bot module
+        database = connect(args)
+        setup(database, args)
+    fake = fake_bot(args.api_latency, (number + 1) * ID_RANGE)
+    dispatcher = BoundedDispatcher(fake, queue.Queue(), workers=args.threads)
+    bot.register_handlers(dispatcher, run_async=True)
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+
+    received = 0
+    while True:
+        data = inbox.get()
+        if data is None:
+            break
+        received += 1
+        # de_json consumes its data, and threads share it
+        dispatcher.update_queue.put(Update.de_json(copy.deepcopy(data), fake))
+    # Let handlers in progress finish before stopping
+    while dispatcher.update_queue.qsize() or dispatcher.inflight:
+        time.sleep(0.01)
+    dispatcher.stop()
+    thread.join()
+    results.put(
+        {
+            "worker": number,
+            "received": received,
+            "polls": fake.request.calls["sendPoll"],
+        }
+    )
+
+
+def wait_for(sessions, nb_question: int, chats: int, timeout: float) -> bool:
+    """Wait for every session to reach nb_question, with its next poll bound"""
+    query = {"nb_question": nb_question, "poll_id": {"$ne": None}}
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if sessions.count_documents(query) == chats:
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--quiz", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=bot.DISPATCHER_WORKERS)
+    parser.add_argument("--outbox-workers", type=int, default=32)
+    parser.add_argument("--api-latency", type=float, default=0.01)
+    parser.add_argument("--db-latency", type=float, default=0.001)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--mongo", help="MongoDB URI, in-memory stand-in if unset")
+    parser.add_argument("--database", default="hcia_bench")
+    args = parser.parse_args()
+
+    database = connect(args)
+    database.quiz.delete_many({})
+    database.sessions.delete_many({})
+    database.quiz.insert_many([random_quiz(i) for i in range(args.quiz)])
+    setup(database, args)
+
+    if args.mongo:
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        inboxes = [context.Queue() for _ in range(args.workers)]
+        workers = [
+            context.Process(target=serve, args=(n, args, inboxes[n], results))
+            for n in range(args.workers)
+        ]
+    else:
+        # Threads share this bot module, and so its session store
+        results = queue.Queue()
+        inboxes = [queue.Queue() for _ in range(args.workers)]
+        workers = [
+            threading.Thread(
+                target=serve, args=(n, args, inboxes[n], results, database)
+            )
+            for n in range(args.workers)
+        ]
+    for worker in workers:
+        worker.start()
+
+    # Sessions are opened by the driver, workers only see them in the database
+    driver = fake_bot(args.api_latency)
+    context = CallbackContext(Dispatcher(driver, queue.Queue()))
+    for chat_id in range(1, args.chats + 1):
+        bot.starting_quiz(context, chat_id)
+
+    rounds = bot.QUIZ_PER_SESSION - 1
+    delivered = 0
+    completed = True
+    start = time.perf_counter()
+    for nb_question in range(rounds):
+        for doc in database.sessions.find({}):
+            quiz = bot.quiz_bank.get(doc["questions"][doc["nb_question"]])
+            data = poll_answer_update(
+                driver, doc["poll_id"], doc["_id"], [quiz.response_id]
+            ).to_dict()
+            # The same answer reaches two workers
+            for number in random.sample(range(args.workers), min(2, args.workers)):
+                inboxes[number].put(data)
+                delivered += 1
+        if not wait_for(database.sessions, nb_question + 1, args.chats, args.timeout):
+            completed = False
+            break
+    elapsed = time.perf_counter() - start
+
+    for inbox in inboxes:
+        inbox.put(None)
+    reports = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    scored = database.sessions.count_documents({"nb_question": rounds, "marks": rounds})
+    polls = sum(report["polls"] for report in reports)
+    for report in sorted(reports, key=lambda report: report["worker"]):
+        print("worker %(worker)d: %(received)d updates, %(polls)d polls sent" % report)
+    print(
+        "%d workers  %d updates  %.1f updates/s  sessions scored %d/%d"
+        "  polls %d/%d  %s"
+        % (
+            args.workers,
+            delivered,
+            delivered / elapsed,
+            scored,
+            args.chats,
+            polls,
+            args.chats * rounds,
+            "OK" if completed and scored == args.chats else "FAILED",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Cost of adaptive question selection.
+Fills AdaptiveSelector with the answer history of many users over banks of
+growing size, then times the draw of a session question set and the recording
+of an answer, next to the uniform draw of the bank. A draw should cost about
+the same whatever the bank size and the number of users.
+Quiz are spread over --topics tags, the draws of a session on one topic (/quiz
+ospf) are timed too.
+Usage:
+    python -m benchmarks.selection --banks 1000 10000 100000 --users 100 10000
+"""
+
+import time
+import random
+import argparse
+
+from bank import QuizBank
+from repository import QuizRepository
+from selection import AdaptiveSelector
+from benchmarks.fakes import FakeMongoClient, random_quiz
+
+
+def topic(number: int) -> str:
+    return "topic%d" % number
+
+
+def build_bank(size: int, topics: int) -> QuizBank:
+    client = FakeMongoClient()
+    quizzes = [random_quiz(i) for i in range(size)]
+    for i, quiz in enumerate(quizzes):
+        quiz["tags"] = [topic(i % topics)]
+    client.hcia.quiz.insert_many(quizzes)
+    bank = QuizBank(QuizRepository(client.hcia.quiz))
+    bank.load()
+    return bank
+
+
+def timed_calls(function, calls: int) -> float:
+    """Average duration of function() in microseconds"""
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def run(
+    bank: QuizBank, users: int, history: int, draws: int, size: int, topics: int
+) -> dict:
+    selector = AdaptiveSelector(bank)
+    _, records = bank.snapshot()
+    ids = [quiz._id for quiz in records]
+    for user_id in range(users):
+        for quiz_id in random.sample(ids, min(history, len(ids))):
+            selector.record(user_id, quiz_id, random.random() < 0.7)
+    # Weights of every user are computed at their first draw
+    for user_id in range(users):
+        selector.draw(user_id, size)
+
+    return {
+        "bank": len(bank),
+        "users": users,
+        "draw": timed_calls(
+            lambda: selector.draw(random.randrange(users), size), draws
+        ),
+        "record": timed_calls(
+            lambda: selector.record(
+                random.randrange(users), random.choice(ids), random.random() < 0.7
+            ),
+            draws,
+        ),
+        "uniform": timed_calls(lambda: bank.draw(size), draws),
+        "topic": timed_calls(
+            lambda: selector.draw(
+                random.randrange(users), size, [topic(random.randrange(topics))]
+            ),
+            draws,
+        ),
+        "topic uniform": timed_calls(
+            lambda: bank.draw(size, [topic(random.randrange(topics))]), draws
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--banks", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--history", type=int, default=50, help="answers per user")
+    parser.add_argument("--draws", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=10, help="questions per draw")
+    parser.add_argument("--topics", type=int, default=20, help="tags of the bank")
+    args = parser.parse_args()
+
+    for size in args.banks:
+        bank = build_bank(size, args.topics)
+        for users in args.users:
+            result = run(bank, users, args.history, args.draws, args.size, args.topics)
+            print(
+                "bank %(bank)7d  users %(users)6d  draw %(draw)7.1fus"
+                "  record %(record)5.1fus  uniform draw %(uniform)6.1fus"
+                "  topic draw %(topic)7.1fus  topic uniform %(topic uniform)6.1fus"
+                % result
+            )
+
+
+if __name__ == "__main__":
+    main()
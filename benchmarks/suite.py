@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Offline benchmark suite of the update handlers, to run before deploying.
+Each scenario replays synthetic updates through the real Dispatcher and
+handlers, with a fake Bot API and an in-memory MongoDB:
+- answers: chats in the middle of a session all answer at once, question
+  after question, with in-memory sessions
+- answers-shared: the same with sessions in the database (SESSION_BACKEND=mongo)
+- create: creators all send a new quiz poll at once, several times
+- edit: every quiz sent by a creator gets an illustration, then a corrected poll
+It reports throughput, p50/p99 handler latency (from enqueue to handler
+completion), database operations per session or per update and the peak of
+memory allocated during the replay. Memory tracing slows everything down, pass
+--no-memory to compare throughput only. The fake database scans collections
+for lookups other than by _id, keep --quiz small to time the handlers rather
+than the scans.
+Usage:
+    python -m benchmarks.suite --json before.json
+    python -m benchmarks.suite --scenarios answers create --no-memory
+"""
+
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+import tracemalloc
+from queue import Queue
+
+from telegram.ext import CallbackContext, Dispatcher
+
+import bot
+from models.quiz import Quiz
+from sessions import MongoSessionStore
+from benchmarks.fakes import (
+    fake_bot,
+    message_update,
+    photo_message,
+    poll_answer_update,
+    poll_message,
+)
+from benchmarks.load_test import Timing, percentile, setup_outbox, setup_store
+
+# Chat ids of creators, away from those of quiz takers
+CREATOR_IDS = 10**6
+WORDS = (
+    "ospf bgp rip vlan trunk access stp rstp mstp lacp vrrp acl nat dhcp dns arp"
+    " icmp tcp udp ipv4 ipv6 mask subnet router switch port frame packet segment"
+    " area lsa hello dead interval cost metric route static default gateway"
+    " loopback interface ethernet serial ppp hdlc mpls qos telnet ssh ftp"
+).split()
+
+_message_ids = itertools.count(1)
+
+
+def random_text(words: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(words))
+
+
+def random_poll(chat_id: int, reply_to: dict = None) -> dict:
+    """Message of a new quiz poll, unlike any other"""
+    options = [random_text(2) for _ in range(4)]
+    question = random_text(10) + " ?"
+    return poll_message(
+        chat_id,
+        next(_message_ids),
+        question,
+        options,
+        random.randrange(len(options)),
+        reply_to,
+    )
+
+
+def answer_rounds(args, client, fake, context, shared: bool):
+    """Start a session in every chat, then answer every question at once"""
+    for chat_id in range(1, args.chats + 1):
+        bot.starting_quiz(context, chat_id)
+
+    def open_poll(chat_id: int):
+        if shared:
+            # Read behind the store, not to count the reads of the benchmark
+            doc = client.hcia.sessions.documents[chat_id]
+            return doc["poll_id"], bot.quiz_bank.get(
+                doc["questions"][doc["nb_question"]]
+            )
+        session = bot.sessions.get(chat_id)
+        return session.poll_id, session.questions[session.nb_question]
+
+    def rounds():
+        for _ in range(bot.QUIZ_PER_SESSION - 1):
+            batch = []
+            for chat_id in range(1, args.chats + 1):
+                poll_id, quiz = open_poll(chat_id)
+                # Half of the answers are wrong
+                option = quiz.response_id
+                if random.random() < 0.5:
+                    option = (option + 1) % len(quiz.options)
+                batch.append(poll_answer_update(fake, poll_id, chat_id, [option]))
+            yield batch
+
+    return args.chats, "session", rounds()
+
+
+def create_rounds(args, client, fake, context, shared: bool):
+    """Every creator sends args.polls new quiz, one at a time"""
+    creators = range(CREATOR_IDS, CREATOR_IDS + args.creators)
+    rounds = (
+        [message_update(fake, random_poll(chat_id)) for chat_id in creators]
+        for _ in range(args.polls)
+    )
+    return args.creators * args.polls, "update", rounds
+
+
+def edit_rounds(args, client, fake, context, shared: bool):
+    """Every creator illustrates their saved quiz, then corrects it"""
+    saved = []
+    for chat_id in range(CREATOR_IDS, CREATOR_IDS + args.creators):
+        message = random_poll(chat_id)
+        poll = message["poll"]
+        quiz = bot.quiz_repository.insert(
+            Quiz(
+                poll["question"],
+                [option["text"] for option in poll["options"]],
+                poll["correct_option_id"],
+                chat_id=chat_id,
+                msg_id=message["message_id"],
+            )
+        )
+        bot.quiz_bank.upsert(quiz)
+        bot.duplicates.add(quiz._id, quiz)
+        saved.append(message)
+
+    rounds = iter(
+        [
+            [
+                message_update(
+                    fake,
+                    photo_message(
+                        message["chat"]["id"],
+                        next(_message_ids),
+                        "photo-%d" % message["message_id"],
+                        message,
+                    ),
+                )
+                for message in saved
+            ],
+            [
+                message_update(fake, random_poll(message["chat"]["id"], message))
+                for message in saved
+            ],
+        ]
+    )
+    return 2 * len(saved), "update", rounds
+
+
+SCENARIOS = {
+    "answers": ("receive_quiz_answer", False, answer_rounds),
+    "answers-shared": ("receive_quiz_answer", True, answer_rounds),
+    "create": ("update_quiz", False, create_rounds),
+    "edit": ("update_quiz", False, edit_rounds),
+}
+
+
+def run(args, scenario: str) -> dict:
+    handler, shared, make_rounds = SCENARIOS[scenario]
+    client = setup_store(args.quiz, args.db_latency)
+    if shared:
+        bot.sessions = MongoSessionStore(client.hcia.sessions, bot.quiz_bank)
+    setup_outbox(args)
+    fake = fake_bot(args.api_latency)
+    dispatcher = Dispatcher(fake, Queue(), workers=args.workers)
+    # Creators have entered the user code
+    dispatcher.bot_data["user_code"] = "ok"
+
+    timing = Timing(0)
+    original = getattr(bot, handler)
+    setattr(bot, handler, timing.wrap(original))
+    try:
+        bot.register_handlers(dispatcher, run_async=True)
+    finally:
+        setattr(bot, handler, original)
+
+    context = CallbackContext(dispatcher)
+    units, unit, rounds = make_rounds(args, client, fake, context, shared)
+    ops_before = client.hcia.ops()
+    if args.memory:
+        tracemalloc.start()
+
+    thread = threading.Thread(target=dispatcher.start, daemon=True)
+    thread.start()
+    start = time.perf_counter()
+    for batch in rounds:
+        handled = len(timing.latencies) + len(batch)
+        for update in batch:
+            timing.enqueued[update.update_id] = time.perf_counter()
+            dispatcher.update_queue.put(update)
+        while len(timing.latencies) < handled:
+            time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    peak = 0
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    dispatcher.stop()
+    thread.join()
+    ops = sum((client.hcia.ops() - ops_before).values())
+
+    return {
+        "scenario": scenario,
+        "updates": len(timing.latencies),
+        "updates/s": len(timing.latencies) / elapsed,
+        "p50": percentile(timing.latencies, 0.5),
+        "p99": percentile(timing.latencies, 0.99),
+        "db ops": ops / units,
+        "unit": unit,
+        "peak MB": peak / 2**20,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--chats", type=int, default=100, help="quiz takers")
+    parser.add_argument("--creators", type=int, default=100)
+    parser.add_argument("--polls", type=int, default=3, help="quiz per creator")
+    parser.add_argument("--quiz", type=int, default=500, help="size of the bank")
+    parser.add_argument("--workers", type=int, default=bot.DISPATCHER_WORKERS)
+    parser.add_argument("--api-latency", type=float, default=0.02)
+    parser.add_argument("--db-latency", type=float, default=0.005)
+    parser.add_argument("--outbox-workers", type=int, default=32)
+    parser.add_argument("--global-rate", type=float, default=10000)
+    parser.add_argument("--chat-rate", type=float, default=10000)
+    parser.add_argument("--no-memory", dest="memory", action="store_false")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for scenario in args.scenarios:
+        result = run(args, scenario)
+        results.append(result)
+        print(
+            "%(scenario)-15s %(updates)6d updates  %(updates/s)8.1f updates/s"
+            "  p50 %(p50).3fs  p99 %(p99).3fs  db ops %(db ops)5.1f/%(unit)s"
+            "  peak %(peak MB).1fMB" % result
+        )
+    if args.json:
+        with open(args.json, "w") as stream:
+            json.dump(results, stream, indent=2)
+
+
+if __name__ == "__main__":
+    main()
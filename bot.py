@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 # pylint: disable=C0116,W0613
 
-import threading
 import time
+import threading
+from concurrent.futures import Future
+from typing import List, Optional
+
+# Measured before anything else is imported, see the startup report in main()
+STARTED_AT = time.perf_counter()
+
 import logging
 
 import os
 from telegram import (
+    Chat,
     Poll,
-    ParseMode,
     KeyboardButton,
     KeyboardButtonPollType,
     ReplyKeyboardMarkup,
@@ -16,46 +22,56 @@ from telegram import (
     Update,
 )
 from telegram.ext import (
-    Updater,
+    Dispatcher,
     CommandHandler,
-    PollAnswerHandler,
     PollHandler,
+    PollAnswerHandler,
     MessageHandler,
     Filters,
     CallbackContext,
 )
-from telegram.files.photosize import PhotoSize
-
-from models.quiz import Quiz
 
-from telegram.constants import POLL_QUIZ
+from telegram.constants import MAX_MESSAGE_LENGTH, POLL_QUIZ
 
 from look import track_chats, show_chats, greet_chat_members
 
-# Additionnal imports need for previous functions
-from typing import Tuple, Optional
-
-from telegram import Chat, ChatMember, ChatMemberUpdated
-
 from telegram.ext import ChatMemberHandler
 
-from pymongo import MongoClient  # this lets us connect to MongoDB
+from apscheduler.executors.pool import ThreadPoolExecutor
+
+import db
+from bank import QuizBank
+from dedup import NearDuplicateIndex
+from models.quiz import Quiz, parse_tags, split_hashtags
+from repository import QuizRepository
+import ingest
+import metrics
+import outbox
+from media import MediaCache
+from sessions import (
+    MongoSessionStore,
+    SessionStore,
+    Session,
+    SESSION_BACKEND,
+    SESSION_SWEEP_SECONDS,
+)
+from persistence import StateStore, STATE_FLUSH_SECONDS
+from selection import AdaptiveSelector, STATS_FLUSH_SECONDS
+from results import ResultStore
+from broadcast import Broadcaster, BROADCAST_LEASE_SECONDS
+
+IMPORTED_AT = time.perf_counter()
 
 """ Environment variables"""
-mongoClient = MongoClient(os.environ.get("MONGO_DB"))
 APP_NAME = "https://buzzvb.herokuapp.com/"
 PORT = int(os.environ.get("PORT", "8443"))
 USER_CODE = os.environ.get("USER_CODE")
+# Comma separated ids of the users allowed to run /stats, /hardest, /broadcast
+ADMIN_IDS = [int(i) for i in os.environ.get("ADMIN_IDS", "").split(",") if i.strip()]
 # Don't forget to set Config Vars on Heroku (settings Section)
 TOKEN = os.environ.get("BOT_SECRET")
 LOGO_RELATIVE_PATH = "hcia_rs_files_tmp/logo.png"
-HELLO_MESSAGE = "Hi, Nice to meet you! \n\nI'm a opensource HCIA Q/A Bot. \n[->] /quiz to start a Q/A session. Don't worry, it's anonymous. \n[->] /create to contribute to the Quiz librairy.\n\nFind my source code https://github.com/script-0/hcia-rs-prep-bot"
-CLOSED_QUIZ_MSG = (
-    "Sorry ! Your Quiz section is closed. Please send /quiz to start a new one."
-)
-OLD_QUIZ_MSG = (
-    "Sorry ! Your Quiz section is too old. Please send /quiz to start a new one."
-)
+HELLO_MESSAGE = "Hi, Nice to meet you! \n\nI'm a opensource HCIA Q/A Bot. \n[->] /quiz to start a Q/A session, here or in a group to compete with its members. \n[->] /quiz ospf to only get questions on a topic. \n[->] /me to see your results. \n[->] /create to contribute to the Quiz librairy.\n\nFind my source code https://github.com/script-0/hcia-rs-prep-bot"
 NO_PREVIOUS_POLL_MSG = (
     "Sorry ! No previous quiz session found. Plz send /quiz to start a new one."
 )
@@ -66,10 +82,28 @@ QUIZ_UPDATE_ADD_IMAGE = "All done, Great ! Illustration added successfully."
 QUIZ_PER_SESSION = 10
 SECOND_PER_QUIZ = 20
 SECOND_BEFORE_START = 15
-NO_PREVIOUS_POLL = -1
+# Players listed at the end of a group quiz
+LEADERBOARD_SIZE = 10
+# Countdown message is edited once per tick instead of every second
+COUNTDOWN_TICK = int(os.environ.get("COUNTDOWN_TICK", "5"))
+# Size of the thread pool running scheduled jobs (countdowns, evictions)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "8"))
+# Run handlers on the dispatcher pool so blocking Mongo/Bot API calls of one
+# update don't hold back the others. Set RUN_ASYNC=0 for in-order dispatch
+RUN_ASYNC = os.environ.get("RUN_ASYNC", "1") == "1"
+DISPATCHER_WORKERS = int(os.environ.get("DISPATCHER_WORKERS", "16"))
 INITIALISE_QUIZ_MSG = "Press the above button to initialise Quiz Creation."
 REPLIED_QUIZ_NOT_FOUND = "Sorry, the quiz you want to edit not found. Plz, make sure you selected the right one or try to create another one."
 QUIZ_NOT_SELECTED = "Plz reply to a quiz."
+DUPLICATE_QUIZ = "Sorry ! This quiz looks like one already saved :\n"
+NO_RESULT_MSG = "No result yet. Send /quiz to start a Q/A session."
+NO_HARDEST_MSG = "Not enough answers yet to rank the questions."
+NO_TAGGED_QUIZ_MSG = "Sorry ! No quiz found on "
+NO_BROADCAST_MSG = "No broadcast yet. Send /broadcast followed by a text, or /qotd, to send it to every chat."
+NOT_RESTORED_MSG = "The bot is starting, try again in a minute."
+BROADCAST_RUNNING_MSG = "A broadcast is already running. Send /broadcast to follow it, /broadcast_cancel to stop it."
+# Tags listed when no quiz is found on the requested ones
+TAGS_LISTED = 30
 
 """ Setup Logging """
 logging.basicConfig(
@@ -77,241 +111,588 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# The MongoDB connection is only opened on first use (see db.warm_up)
+quiz_repository = QuizRepository(db.collection("hcia", "quiz"))
+# Near-duplicate index of the bank, kept in sync by each bank load
+duplicates = NearDuplicateIndex()
+quiz_bank = QuizBank(quiz_repository, on_load=duplicates.sync)
+# Several bot processes can only run side by side with shared sessions
+if SESSION_BACKEND == "mongo":
+    sessions = MongoSessionStore(db.collection("hcia", "sessions"), quiz_bank)
+else:
+    sessions = SessionStore()
+media = MediaCache(db.collection("hcia", "media"))
+# Answers of each user, drawing their private sessions
+selector = AdaptiveSelector(
+    quiz_bank, db.collection("hcia", "user_stats"), db.collection("hcia", "quiz_stats")
+)
+state = StateStore(db.collection("hcia", "sessions"), db.collection("hcia", "state"))
+# Completed sessions and score aggregates of each user
+results = ResultStore(
+    db.collection("hcia", "results"), db.collection("hcia", "user_scores")
+)
+# Admin messages to every tracked chat, resumed after a restart
+broadcaster = Broadcaster(db.collection("hcia", "state"))
+# Set by warm_up_quiz once the chat registry is loaded back
+restored = threading.Event()
+# Restore steps of warm_up_quiz done so far, each one runs once
+warmed_up = set()
+metrics.gauge("sessions.active", lambda: len(sessions))
+metrics.gauge("bank.quiz", lambda: len(quiz_bank))
+metrics.gauge("selection.users", lambda: len(selector))
+
+
+def get_quiz_set(size: int, user_id: int = None, tags=()) -> List[Quiz]:
+    """Draw the ordered question set of a session, for user_id if it has one,
+    among the quiz having every tag of tags if any"""
+    # Served from the in-memory bank, Mongo is only hit while the bank is empty
+    if user_id is None:
+        questions = quiz_bank.draw(size, tags)
+    else:
+        questions = selector.draw(user_id, size, tags)
+    if questions or tags:
+        return questions
 
-def get_quiz(quiz_to_skip=None):
-    if quiz_to_skip == None:
-        quiz = list(mongoClient.hcia.quiz.aggregate([{"$sample": {"size": 1}}]))[0]
-        return quiz
+    return quiz_repository.sample(size)
 
-    quiz = list(
-        mongoClient.hcia.quiz.aggregate(
-            [
-                {"$match": {"_id": {"$not": {"$in": quiz_to_skip}}}},
-                {"$sample": {"size": 1}},
-            ]
-        )
-    )[0]
 
-    return quiz
+def record_answer(user_id: int, quiz: Quiz, correct: bool) -> None:
+    """Count an answer in the selection stats and the user aggregates"""
+    selector.record(user_id, quiz._id, correct)
+    results.answer(user_id, correct)
 
 
-def is_answer_correct(update):
+def is_answer_correct(session: Session, poll_answer) -> bool:
     """determine if user answer is correct"""
-    answers = update.poll.options
-    ret = False
-    counter = 0
-    for answer in answers:
-        if answer.voter_count == 1 and update.poll.correct_option_id == counter:
-            ret = True
-            break
-        counter = counter + 1
-    return ret
+    return session.is_correct(poll_answer.poll_id, poll_answer.option_ids)
 
 
-def get_latest_quiz_id(bot_data):
-    tmp = list(bot_data.keys())
-    return tmp[-1] if len(tmp) > 0 else NO_PREVIOUS_POLL
+def user_code(context: CallbackContext) -> Optional[str]:
+    """State of the /create gate: None until a code is asked, "" while it is,
+    "ok" once given. Shared by the bot processes of a shared session store"""
+    code = context.bot_data.get("user_code")
+    if code != "ok" and sessions.shared:
+        try:
+            shared = state.user_code()
+        except Exception as ex:
+            logger.error("[e]-> Exception in user_code() -> " + str(ex))
+            return code
+        if shared is not None:
+            code = context.bot_data["user_code"] = shared
+    return code
 
 
-def clear_data(bot_data):
-    for i in list(bot_data.keys()):
-        del bot_data[i]
+def set_user_code(context: CallbackContext, value: str) -> None:
+    context.bot_data["user_code"] = value
+    if sessions.shared:
+        try:
+            state.set_user_code(value)
+        except Exception as ex:
+            logger.error("[e]-> Exception in set_user_code() -> " + str(ex))
 
 
 def check_user_code(context: CallbackContext):
-    if "user_code" in context.bot_data.keys():
-        if context.bot_data["user_code"] == "ok":
-            return True
-    return False
+    return user_code(context) == "ok"
+
+
+def reply(update: Update, text: str, **kwargs) -> Future:
+    """Reply to the message of update through the outbox"""
+    return outbox.send(
+        update.effective_message.reply_text,
+        text,
+        chat=update.effective_chat.id,
+        **kwargs
+    )
 
 
 def start(update: Update, context: CallbackContext) -> None:
     """Inform user about what this bot can do"""
-    update.message.reply_photo(
-        photo=open(LOGO_RELATIVE_PATH, "rb"), caption=HELLO_MESSAGE
+    outbox.send(
+        media.send_asset,
+        context.bot,
+        update.effective_chat.id,
+        LOGO_RELATIVE_PATH,
+        caption=HELLO_MESSAGE,
+        chat=update.effective_chat.id,
+    )
+    sessions.close(update.effective_chat.id)
+
+
+def countdown(context: CallbackContext) -> None:
+    """Tick of a countdown job, starts the session once the deadline is reached"""
+    data = context.job.context
+    second = round(data["deadline"] - time.monotonic())
+
+    if second > 0:
+        # Several ticks may round to the same second, don't edit twice
+        if second != data["second"]:
+            data["second"] = second
+            # A pending edit of the countdown is replaced by the newer one
+            outbox.send(
+                context.bot.edit_message_text,
+                message_id=data["message_id"],
+                chat_id=data["chat_id"],
+                text="-" + str(second),
+                chat=data["chat_id"],
+                priority=outbox.EDIT,
+                merge_key=("countdown", data["chat_id"], data["message_id"]),
+                max_age=COUNTDOWN_TICK,
+            )
+        return
+
+    context.job.schedule_removal()
+    outbox.send(
+        context.bot.delete_message,
+        message_id=data["message_id"],
+        chat_id=data["chat_id"],
+        chat=data["chat_id"],
+    )
+    # Its Bot API calls wait for the chat rate limit, don't hold a job worker
+    context.dispatcher.run_async(
+        starting_quiz, context, data["chat_id"], data["group"], data["tags"]
     )
-    clear_data(context.bot_data)
 
 
-def starting_quiz(update: Update, context: CallbackContext) -> None:
-    # Countdown
+def no_tagged_quiz(tags) -> str:
+    """Message of tags without quiz, listing the most used tags"""
+    counts = quiz_bank.tags()
+    listed = sorted(counts, key=counts.get, reverse=True)[:TAGS_LISTED]
+    return (
+        NO_TAGGED_QUIZ_MSG
+        + " ".join("#" + tag for tag in tags)
+        + ("\nTry one of : " + " ".join(sorted(listed)) if listed else "")
+    )
 
-    second = SECOND_BEFORE_START
-    msg = update.effective_message.reply_text("-" + str(second))
-    while second >= 0:
-        time.sleep(1)
-        second -= 1
-        context.bot.edit_message_text(
-            message_id=msg.message_id,
-            chat_id=update.message.chat_id,
-            text="-" + str(second),
-        )
 
-    context.bot.deleteMessage(message_id=msg.message_id, chat_id=update.message.chat_id)
-    msg = update.effective_message.reply_text("Let's start!")
-    # Load a quiz
-    quiz = get_quiz()
+def starting_quiz(
+    context: CallbackContext, chat_id: int, group: bool = False, tags=()
+) -> None:
+    # Load the session questions at once, picked for the user of a private chat
+    questions = get_quiz_set(QUIZ_PER_SESSION, None if group else chat_id, tags)
+    if tags and not questions:
+        # Quiz of these tags edited away during the countdown
+        outbox.send(
+            context.bot.send_message, chat_id, no_tagged_quiz(tags), chat=chat_id
+        )
+        return
+    outbox.send(
+        context.bot.send_message, chat_id, "Let's start!", chat=chat_id
+    ).result()
+    quiz = questions[0]
 
     # Send first quiz
 
-    if "imgs" in list(quiz.keys()):
-        update.effective_message.reply_photo(photo=quiz["imgs"][0])
-
-    message = update.effective_message.reply_poll(
-        quiz["question"],
-        quiz["options"],
+    if quiz.imgs:
+        # Illustration must be shown before its poll
+        outbox.send(
+            context.bot.send_photo,
+            chat_id,
+            quiz.imgs[0],
+            chat=chat_id,
+            priority=outbox.POLL,
+        ).result()
+
+    message = outbox.send(
+        context.bot.send_poll,
+        chat_id,
+        quiz.question,
+        quiz.options,
         type=Poll.QUIZ,
-        correct_option_id=int(quiz["response_id"]),
+        correct_option_id=quiz.response_id,
+        # Answers come as PollAnswer updates, telling who answered what
+        is_anonymous=False,
         # 20s to response
         open_period=SECOND_PER_QUIZ,
         # close_date=SECOND_PER_QUIZ
-    )
+        chat=chat_id,
+        priority=outbox.POLL,
+    ).result()
 
-    # Save some info about the poll the bot_data for later use in receive_quiz_answer
-    payload = {
-        message.poll.id: {
-            "chat_id": update.effective_chat.id,
-            "message_id": message.message_id,
-            "nb_question": 0,
-            "marks": 0,
-            "quiz_to_skip": [quiz["_id"]],
-        }
-    }
-    context.bot_data.update(payload)
+    # Open the chat session, receive_quiz_answer finds it back by poll id
+    session = sessions.open(chat_id, group)
+    session.questions = questions
+    sessions.bind_poll(session, message.poll.id, message.message_id, quiz.response_id)
 
 
+@metrics.instrument("handler.quiz")
 def quiz(update: Update, context: CallbackContext) -> None:
+    """Initiate Q/A session and send the first quiz, on the topics given as
+    arguments if any (/quiz ospf)"""
+    chat_id = update.effective_chat.id
+    tags = parse_tags(context.args)
+    size = QUIZ_PER_SESSION
+    if tags:
+        size = min(size, len(quiz_bank.tagged(tags)))
+        if not size:
+            # The session in progress, if any, goes on
+            reply(update, no_tagged_quiz(tags))
+            return
 
-    """Initiate Q/A session and send the first quiz"""
-    # Clear all previous Q/A session data
-    clear_data(context.bot_data)
+    # Clear previous Q/A session and countdown of this chat
+    sessions.close(chat_id)
+    job_name = "countdown-" + str(chat_id)
+    for job in context.job_queue.get_jobs_by_name(job_name):
+        job.schedule_removal()
 
     #
-    update.effective_message.reply_text(
+    reply(
+        update,
         "Before starting, I have a couple of words to say to you:\n[->] This session consist of "
-        + str(QUIZ_PER_SESSION)
+        + str(size)
         + " questions\n[->] You will have "
         + str(SECOND_PER_QUIZ)
-        + " seconds per question.\n[->] If the time allotted to a question expires before you have answered it, enter /next to start the next one.\n\nLet's Go! The first question in "
+        + " seconds per question.\n[->] When the time allotted to a question runs out, the next one is sent. Send /next to skip a question.\n\nLet's Go! The first question in "
         + str(SECOND_BEFORE_START)
-        + " seconds."
+        + " seconds.",
+    ).result()
+
+    # Countdown, driven by the job queue instead of a sleeping thread
+    msg = reply(update, "-" + str(SECOND_BEFORE_START)).result()
+    context.job_queue.run_repeating(
+        countdown,
+        interval=min(COUNTDOWN_TICK, SECOND_BEFORE_START),
+        context={
+            "chat_id": chat_id,
+            # In groups, one poll per question is answered by every member
+            "group": update.effective_chat.type in (Chat.GROUP, Chat.SUPERGROUP),
+            "tags": tags,
+            "message_id": msg.message_id,
+            "second": SECOND_BEFORE_START,
+            "deadline": time.monotonic() + SECOND_BEFORE_START,
+        },
+        name=job_name,
+        # Late ticks are merged into one instead of replayed
+        job_kwargs={"coalesce": True, "misfire_grace_time": COUNTDOWN_TICK},
     )
 
-    x = threading.Thread(
-        target=starting_quiz,
-        args=(
-            update,
-            context,
-        ),
-        daemon=True,
-    )
-    x.start()
 
+@metrics.instrument("handler.next_question")
+def next_question(
+    update: Update,
+    context: CallbackContext,
+    session: Session = None,
+    answered_at: float = None,
+    poll_closed: bool = False,
+) -> None:
+    if session is None:
+        session = sessions.get(update.effective_chat.id)
 
-def next_question(update: Update, context: CallbackContext) -> None:
-    previous_poll_id = get_latest_quiz_id(context.bot_data)
-
-    if previous_poll_id == NO_PREVIOUS_POLL:
-        update.effective_message.reply_text(NO_PREVIOUS_POLL_MSG)
+    if session is None:
+        reply(update, NO_PREVIOUS_POLL_MSG)
         return
-    quiz_data = context.bot_data[previous_poll_id]
-    nb_question = quiz_data["nb_question"]
-
-    # Stop current Quiz
-    try:
-        context.bot.stop_poll(quiz_data["chat_id"], quiz_data["message_id"])
-    except Exception:
-        pass
-
-    if (nb_question + 1) < QUIZ_PER_SESSION:
-        quiz_data["nb_question"] = quiz_data["nb_question"] + 1
+    nb_question = session.nb_question
+
+    # Stop current Quiz, its closing update must not be scored.
+    # Unless it timed out, it may still be closed meanwhile, a failure is only
+    # logged by the outbox
+    sessions.claim_poll(session.poll_id)
+    if not poll_closed:
+        outbox.send(
+            context.bot.stop_poll,
+            session.chat_id,
+            session.message_id,
+            chat=session.chat_id,
+            priority=outbox.POLL,
+        )
 
-        # Load previous quiz _id. This will be skipped
-        quiz_to_skip = quiz_data["quiz_to_skip"]
+    # Move the cursor, unless another worker moved it first (e.g. /next
+    # and an answer handled at once), then this update is late and ignored
+    if not sessions.advance(session, nb_question):
+        return
 
-        # Load another quiz
-        quiz = get_quiz(quiz_to_skip)
-        quiz_to_skip.append(quiz["_id"])
+    if session.nb_question < len(session.questions):
+        # Next quiz of the set drawn at session start
+        quiz = session.questions[session.nb_question]
 
         # Send Another quiz
-        if "imgs" in list(quiz.keys()):
-            context.bot.send_photo(chat_id=quiz_data["chat_id"], photo=quiz["imgs"][0])
-
-        message = context.bot.send_poll(
-            chat_id=quiz_data["chat_id"],
-            question=quiz["question"] + str(nb_question % QUIZ_PER_SESSION),
-            options=quiz["options"],
+        if quiz.imgs:
+            outbox.send(
+                context.bot.send_photo,
+                session.chat_id,
+                quiz.imgs[0],
+                chat=session.chat_id,
+                priority=outbox.POLL,
+            ).result()
+
+        message = outbox.send(
+            context.bot.send_poll,
+            chat_id=session.chat_id,
+            question=quiz.question + str(nb_question % QUIZ_PER_SESSION),
+            options=quiz.options,
             type=Poll.QUIZ,
-            correct_option_id=int(quiz["response_id"]),
+            correct_option_id=quiz.response_id,
+            is_anonymous=False,
             open_period=SECOND_PER_QUIZ,
+            chat=session.chat_id,
+            priority=outbox.POLL,
+        ).result()
+        # Bind the new poll to the session for later use in receive_quiz_answer
+        sessions.bind_poll(
+            session, message.poll.id, message.message_id, quiz.response_id
         )
-        # Save some info about the poll the bot_data for later use in receive_quiz_answer\
-        quiz_data["message_id"] = message.message_id
-        quiz_data["quiz_to_skip"] = quiz_to_skip
-
-        payload = {message.poll.id: quiz_data}
-        context.bot_data.update(payload)
+        if answered_at is not None:
+            metrics.observe(
+                "answer_to_next_question", time.perf_counter() - answered_at
+            )
+    elif session.group:
+        outbox.send(
+            context.bot.send_message,
+            session.chat_id,
+            leaderboard(session),
+            chat=session.chat_id,
+        )
+        results.finish(session)
+        sessions.close(session.chat_id)
     else:
-        if quiz_data["marks"] >= 0.8 * QUIZ_PER_SESSION:
-            context.bot.send_message(
-                quiz_data["chat_id"],
+        # Fewer than QUIZ_PER_SESSION when few quiz have the session tags
+        size = len(session.questions)
+        if session.marks >= 0.8 * size:
+            outbox.send(
+                context.bot.send_message,
+                session.chat_id,
                 "WHOOWW, Great Work ! You got "
-                + str(quiz_data["marks"])
+                + str(session.marks)
                 + " over "
-                + str(QUIZ_PER_SESSION)
+                + str(size)
                 + " -> "
-                + str(round(quiz_data["marks"] * 100 / QUIZ_PER_SESSION))
+                + str(round(session.marks * 100 / size))
                 + "%",
+                chat=session.chat_id,
             )
         else:
-            context.bot.send_message(
-                quiz_data["chat_id"],
+            outbox.send(
+                context.bot.send_message,
+                session.chat_id,
                 "Sorry, Need more work ! You got "
-                + str(quiz_data["marks"])
+                + str(session.marks)
                 + " over "
-                + str(QUIZ_PER_SESSION)
+                + str(size)
                 + " -> "
-                + str(round(quiz_data["marks"] * 100 / QUIZ_PER_SESSION))
+                + str(round(session.marks * 100 / size))
                 + "%",
+                chat=session.chat_id,
             )
-        clear_data(context.bot_data)
+        results.finish(session)
+        sessions.close(session.chat_id)
+
+
+def leaderboard(session: Session) -> str:
+    """Final ranking of a group session"""
+    if not session.scores:
+        return "Quiz over ! Nobody answered."
+    ranking = sorted(
+        session.scores.values(), key=lambda score: score["marks"], reverse=True
+    )
+    lines = [
+        "%d. %s -> %d/%d"
+        % (rank, score["name"], score["marks"], len(session.questions))
+        for rank, score in enumerate(ranking[:LEADERBOARD_SIZE], start=1)
+    ]
+    return "Quiz over ! Leaderboard :\n" + "\n".join(lines)
+
+
+def me(update: Update, context: CallbackContext) -> None:
+    """Show the aggregates of the user"""
+    user = results.user(update.effective_user.id)
+    if user is None:
+        reply(update, NO_RESULT_MSG)
+        return
+    text = "Your results :\n[->] %d session(s)" % user["sessions"]
+    if user["questions"]:
+        text += ", %d%% of the marks, best %d" % (
+            round(user["marks"] * 100 / user["questions"]),
+            user["best_marks"],
+        )
+    if user["answers"]:
+        text += "\n[->] %d answer(s), %d%% correct" % (
+            user["answers"],
+            round(user["correct"] * 100 / user["answers"]),
+        )
+    text += "\n[->] %d correct answer(s) in a row, best %d" % (
+        user["streak"],
+        user["best_streak"],
+    )
+    reply(update, text)
+
+
+def hardest(update: Update, context: CallbackContext) -> None:
+    """Show the questions with the lowest success rate to admins"""
+    ranking = selector.hardest()
+    if not ranking:
+        reply(update, NO_HARDEST_MSG)
+        return
+    lines = [
+        "%d. %s -> %d%% correct over %d answers"
+        % (rank, quiz.question, round(correct * 100 / attempts), attempts)
+        for rank, (quiz, attempts, correct) in enumerate(ranking, start=1)
+    ]
+    reply(update, ("Hardest questions :\n" + "\n".join(lines))[:MAX_MESSAGE_LENGTH])
+
+
+def broadcast_progress() -> str:
+    job = broadcaster.progress()
+    if job is None:
+        return NO_BROADCAST_MSG
+    if job["done"]:
+        status = "cancelled" if job["cancelled"] else "done"
+    else:
+        status = "running"
+    return "Broadcast %s : %d sent, %d pruned, %d failed over %d chats" % (
+        status,
+        job["sent"],
+        job["pruned"],
+        job["failed"],
+        job["total"],
+    )
+
+
+def start_broadcast(update: Update, context: CallbackContext, **content) -> None:
+    if not restored.is_set():
+        # The chat registry is still empty
+        reply(update, NOT_RESTORED_MSG)
+        return
+    chats = broadcaster.start(context.bot, context.bot_data, **content)
+    if chats is None:
+        reply(update, BROADCAST_RUNNING_MSG)
+    else:
+        reply(update, "Broadcast started to %d chats." % chats)
+
+
+def broadcast(update: Update, context: CallbackContext) -> None:
+    """Send the text following the command to every tracked chat, or show
+    the progress of the last broadcast"""
+    # Line breaks of the text are kept, unlike with context.args
+    parts = update.effective_message.text.split(None, 1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        reply(update, broadcast_progress())
+        return
+    start_broadcast(update, context, text=text)
+
+
+def qotd(update: Update, context: CallbackContext) -> None:
+    """Send a question of the day poll to every tracked chat, drawn from the
+    quiz having the tags given as arguments if any"""
+    tags = parse_tags(context.args)
+    # An illustration would cost a second call per chat
+    found = [quiz for quiz in quiz_bank.draw(QUIZ_PER_SESSION, tags) if not quiz.imgs]
+    if not found:
+        reply(update, no_tagged_quiz(tags))
+        return
+    start_broadcast(update, context, quiz=found[0])
+
+
+def broadcast_cancel(update: Update, context: CallbackContext) -> None:
+    """Stop the running broadcast"""
+    if broadcaster.cancel():
+        reply(update, "Broadcast cancelled, the calls in flight are still sent.")
+    else:
+        reply(update, broadcast_progress())
+
+
+def resume_broadcast(context: CallbackContext) -> None:
+    """Take over a broadcast left unfinished by a stopped bot process"""
+    # Resumed against an empty registry, it would be checkpointed as done
+    if restored.is_set():
+        broadcaster.resume(context.bot, context.bot_data)
 
 
+@metrics.instrument("handler.receive_quiz_answer")
 def receive_quiz_answer(update: Update, context: CallbackContext) -> None:
     """Respond after quiz user response"""
-    try:
-        # if not previous context data found , ignore
-        if len(list(context.bot_data.keys())) <= 0:
-            return
-        # When the poll is closed after respond , ignore
-        if update.poll.is_closed and (
-            update.poll.id != list(context.bot_data.keys())[-1]
+    answered_at = time.perf_counter()
+    poll_answer = update.poll_answer
+    # Only the open poll of a session is bound, answers to older polls are ignored.
+    session = sessions.by_poll(poll_answer.poll_id)
+    if session is None:
+        return
+
+    if session.group:
+        # Every member scores on the same poll, the session moves on when it closes
+        mark = is_answer_correct(session, poll_answer)
+        # The poll may time out meanwhile and move the cursor on
+        quiz = session.question(poll_answer.poll_id)
+        if (
+            sessions.score(
+                session,
+                poll_answer.poll_id,
+                poll_answer.user.id,
+                poll_answer.user.full_name,
+                mark,
+            )
+            and quiz is not None
         ):
-            return
+            record_answer(poll_answer.user.id, quiz, mark)
+        return
 
-        # calcul les points
-        quiz_data = context.bot_data[update.poll.id]
-        mark = is_answer_correct(update=update)
-        quiz_data["marks"] += 1 if mark else 0
-        payload = {update.poll.id: quiz_data}
-        context.bot_data.update(payload)
+    # The poll is claimed so concurrent answers to the same poll are ignored too
+    session = sessions.claim_poll(poll_answer.poll_id)
+    if session is None:
+        return
+
+    # calcul les points
+    mark = is_answer_correct(session, poll_answer)
+    session.marks += 1 if mark else 0
+    record_answer(poll_answer.user.id, session.questions[session.nb_question], mark)
 
-        # Load next question
-        next_question(update=update, context=context)
+    # Load next question
+    next_question(
+        update=update, context=context, session=session, answered_at=answered_at
+    )
 
-    except KeyError:
-        # this means this poll answer update is from an old poll, we can't stop it then
-        update.effective_message.reply_text(OLD_QUIZ_MSG)
+
+def receive_quiz_timeout(update: Update, context: CallbackContext) -> None:
+    """Move on when the open poll of a session closes unanswered"""
+    if not update.poll.is_closed:
+        return
+    # Answered or stopped polls were claimed already
+    session = sessions.claim_poll(update.poll.id)
+    if session is None:
         return
+    next_question(update=update, context=context, session=session, poll_closed=True)
+
+
+def evict_sessions(context: CallbackContext) -> None:
+    """Drop sessions abandoned for too long"""
+    evicted = sessions.evict_expired()
+    if evicted:
+        logger.info("[i]-> %d abandoned session(s) evicted", evicted)
+
+
+def flush_state(context: CallbackContext) -> None:
+    """Persist sessions and chat registry changed since the last flush"""
+    state.flush(sessions, context.bot_data)
+
+
+def flush_stats(context: CallbackContext) -> None:
+    """Persist the answer stats and results changed since the last flush"""
+    selector.flush()
+    results.flush()
+
+
+def metrics_summary(dispatcher: Dispatcher) -> str:
+    return (
+        ingest.summary(dispatcher) + "\n" + outbox.summary() + "\n" + metrics.summary()
+    )
+
+
+def report_metrics(context: CallbackContext) -> None:
+    """Log ingestion state and latency histograms"""
+    logger.info("[i]-> Metrics :\n" + metrics_summary(context.dispatcher))
+
+
+def stats(update: Update, context: CallbackContext) -> None:
+    """Show ingestion state, gauges and latency histograms to admins"""
+    reply(update, metrics_summary(context.dispatcher)[:MAX_MESSAGE_LENGTH])
 
 
 def init_quiz_creation(update: Update, context: CallbackContext) -> None:
     """Check user code and init quiz creation"""
 
-    if "user_code" in context.bot_data.keys():
+    if user_code(context) is not None:
         code = update.effective_message.text
         if code == USER_CODE:
-            context.bot_data.update({"user_code": "ok"})
+            set_user_code(context, "ok")
             button = [
                 [
                     KeyboardButton(
@@ -321,14 +702,13 @@ def init_quiz_creation(update: Update, context: CallbackContext) -> None:
             ]
             message = INITIALISE_QUIZ_MSG
             # using one_time_keyboard to hide the keyboard
-            update.effective_message.reply_text(
+            reply(
+                update,
                 message,
                 reply_markup=ReplyKeyboardMarkup(button, one_time_keyboard=True),
             )
         else:
-            update.effective_message.reply_text(
-                "Incorrect code. Please check it again."
-            )
+            reply(update, "Incorrect code. Please check it again.")
 
 
 def ask_code(update: Update, context: CallbackContext) -> None:
@@ -337,16 +717,16 @@ def ask_code(update: Update, context: CallbackContext) -> None:
         init_quiz_creation(update=update, context=context)
         return
 
-    context.bot_data.update({"user_code": ""})
+    set_user_code(context, "")
     message = " Please, enter the provided user code"
-    update.effective_message.reply_text(message)
+    reply(update, message)
 
 
 def load_quiz(chat_id: int, msg_id: int, del_id=False) -> dict:
     quiz = dict()
     try:
         # logger.info("[i]-> Search in load_quiz(...) -> [ chat = " + str(chat_id) + " , msg = " + str(msg_id) + " ]")
-        quiz = mongoClient.hcia.quiz.find_one({"chat_id": chat_id, "msg_id": msg_id})
+        quiz = quiz_repository.find_by_message(chat_id, msg_id)
     except Exception as ex:
         logger.error(
             "[e]-> Exception in load_quiz(...) -> [ chat = "
@@ -358,11 +738,12 @@ def load_quiz(chat_id: int, msg_id: int, del_id=False) -> dict:
         )
         return None
 
-    if del_id and ("_id" in list(quiz.keys())):
+    if quiz and del_id and ("_id" in list(quiz.keys())):
         del quiz["_id"]
     return quiz
 
 
+@metrics.instrument("handler.update_quiz")
 def update_quiz(update: Update, context: CallbackContext) -> None:
     """On receiving polls, reply by a closed poll copying the received poll"""
 
@@ -388,13 +769,15 @@ def update_quiz(update: Update, context: CallbackContext) -> None:
                     "[e]-> Exception in receive_poll() -> Loaded Poll : \n"
                     + str(previous_poll)
                 )
-                update.effective_message.reply_text(
+                reply(
+                    update,
                     REPLIED_QUIZ_NOT_FOUND,
                     reply_to_message_id=update.effective_message.message_id,
                 )
                 return
         else:
-            update.effective_message.reply_text(
+            reply(
+                update,
                 QUIZ_NOT_SELECTED,
                 reply_to_message_id=update.effective_message.message_id,
             )
@@ -407,13 +790,11 @@ def update_quiz(update: Update, context: CallbackContext) -> None:
             # If reply to a poll
             if "msg_id" in list(previous_poll.keys()):
                 photos = [tmp_photo.file_id for tmp_photo in actual_photo]
-                previous_poll["imgs"] = photos
-                mongoClient.hcia.quiz.replace_one(
-                    {"_id": previous_poll["_id"]}, previous_poll
-                )
-                update.effective_message.reply_text(QUIZ_UPDATE_ADD_IMAGE)
+                quiz_bank.upsert(quiz_repository.set_imgs(previous_poll["_id"], photos))
+                reply(update, QUIZ_UPDATE_ADD_IMAGE)
             else:
-                update.effective_message.reply_text(
+                reply(
+                    update,
                     QUIZ_NOT_SELECTED,
                     reply_to_message_id=update.effective_message.message_id,
                 )
@@ -431,31 +812,48 @@ def update_quiz(update: Update, context: CallbackContext) -> None:
 
     if actual_poll.type != POLL_QUIZ:
         # Not a quiz
-        update.effective_message.reply_text(BAD_POLL_TYPE)
+        reply(update, BAD_POLL_TYPE)
         return
 
-    # Load quiz
-    quiz = dict()
-    quiz["question"] = actual_poll.question
-    quiz["options"] = []
-    for option in actual_poll.options:
-        quiz["options"].append(option.text)
-    quiz["response_id"] = actual_poll.correct_option_id
-    quiz["explanation"] = actual_poll.explanation
-    quiz["chat_id"] = update.effective_chat.id
-    quiz["msg_id"] = update.effective_message.message_id
+    # Load quiz, the #hashtags ending the explanation are its tags
+    explanation, tags = split_hashtags(actual_poll.explanation)
+    quiz = Quiz(
+        actual_poll.question,
+        [option.text for option in actual_poll.options],
+        actual_poll.correct_option_id,
+        explanation=explanation,
+        chat_id=update.effective_chat.id,
+        msg_id=update.effective_message.message_id,
+        tags=tags,
+    )
+
+    # Near duplicates would waste session slots. An edited quiz may look like itself
+    matches = duplicates.query(quiz, exclude=previous_poll.get("_id"))
+    if matches:
+        original = quiz_bank.get(matches[0][0])
+        reply(
+            update,
+            DUPLICATE_QUIZ + (original.question if original else ""),
+            reply_to_message_id=update.effective_message.message_id,
+        )
+        return
 
     # If reply to a poll
     if "msg_id" in list(previous_poll.keys()):
-        quiz["_id"] = previous_poll["_id"]
-        quiz["msg_id"] = previous_poll["msg_id"]
-        quiz["chat_id"] = previous_poll["chat_id"]
-        mongoClient.hcia.quiz.replace_one({"_id": quiz["_id"]}, quiz)
+        quiz = quiz.replace(
+            _id=previous_poll["_id"],
+            msg_id=previous_poll["msg_id"],
+            chat_id=previous_poll["chat_id"],
+        )
+        quiz_repository.replace(quiz)
     else:
         # Save quiz
-        mongoClient.hcia.quiz.insert_one(quiz)
+        quiz = quiz_repository.insert(quiz)
+    quiz_bank.upsert(quiz)
+    duplicates.add(quiz._id, quiz)
 
-    update.effective_message.reply_text(
+    reply(
+        update,
         QUIZ_UPDATE if "msg_id" in list(previous_poll.keys()) else QUIZ_SAVED,
         reply_markup=ReplyKeyboardRemove(),
     )
@@ -463,48 +861,156 @@ def update_quiz(update: Update, context: CallbackContext) -> None:
 
 def help_handler(update: Update, context: CallbackContext) -> None:
     """Display a help message"""
-    update.message.reply_text("Use /quiz, /create to test this bot.")
-
-
-def main() -> None:
-    """Run bot."""
-    # Create the Updater and pass it your bot's token.
-    updater = Updater(TOKEN)
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(CommandHandler("next", next_question))
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("quiz", quiz))
-    dispatcher.add_handler(PollHandler(receive_quiz_answer))
-    dispatcher.add_handler(CommandHandler("create", ask_code))
-    dispatcher.add_handler(MessageHandler(Filters.poll, update_quiz))
-    dispatcher.add_handler(MessageHandler(Filters.photo, update_quiz))
-    dispatcher.add_handler(MessageHandler(Filters.text, init_quiz_creation))
-    dispatcher.add_handler(CommandHandler("help", help_handler))
+    reply(update, "Use /quiz, /create to test this bot.")
+
+
+def warm_up_quiz(bot_data: dict) -> None:
+    """Run the restore steps not done yet, raise if one of them failed so that
+    db.warm_up tries again"""
+    quiz_repository.ensure_indexes()
+    results.ensure_indexes()
+    if sessions.shared:
+        sessions.ensure_indexes()
+    # Sessions and stats refer to the quiz bank, restore them once it is loaded
+    quiz_bank.loaded.wait()
+    failed = []
+    for name, step in (
+        ("state", lambda: state.restore(sessions, bot_data, quiz_bank)),
+        ("selection", selector.restore),
+        ("results", results.restore),
+    ):
+        if name in warmed_up:
+            continue
+        try:
+            step()
+            warmed_up.add(name)
+        except Exception as ex:
+            logger.error(
+                "[e]-> Exception in warm_up_quiz() -> " + name + " -> " + str(ex)
+            )
+            failed.append(name)
+    if failed:
+        raise RuntimeError("Not restored : " + ", ".join(failed))
+    restored.set()
+
+
+def register_handlers(dispatcher: Dispatcher, run_async: bool = RUN_ASYNC) -> None:
+    dispatcher.add_handler(CommandHandler("next", next_question, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("start", start, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("quiz", quiz, run_async=run_async))
+    dispatcher.add_handler(PollAnswerHandler(receive_quiz_answer, run_async=run_async))
+    dispatcher.add_handler(PollHandler(receive_quiz_timeout, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("create", ask_code, run_async=run_async))
+    # Before the text handler, which also matches commands
+    dispatcher.add_handler(CommandHandler("me", me, run_async=run_async))
+    dispatcher.add_handler(
+        CommandHandler(
+            "stats",
+            stats,
+            filters=Filters.user(user_id=ADMIN_IDS),
+            run_async=run_async,
+        )
+    )
+    dispatcher.add_handler(
+        CommandHandler(
+            "hardest",
+            hardest,
+            filters=Filters.user(user_id=ADMIN_IDS),
+            run_async=run_async,
+        )
+    )
+    dispatcher.add_handler(
+        CommandHandler(
+            "broadcast",
+            broadcast,
+            filters=Filters.user(user_id=ADMIN_IDS),
+            run_async=run_async,
+        )
+    )
+    dispatcher.add_handler(
+        CommandHandler(
+            "qotd",
+            qotd,
+            filters=Filters.user(user_id=ADMIN_IDS),
+            run_async=run_async,
+        )
+    )
+    dispatcher.add_handler(
+        CommandHandler(
+            "broadcast_cancel",
+            broadcast_cancel,
+            filters=Filters.user(user_id=ADMIN_IDS),
+            run_async=run_async,
+        )
+    )
+    dispatcher.add_handler(
+        MessageHandler(Filters.poll, update_quiz, run_async=run_async)
+    )
+    dispatcher.add_handler(
+        MessageHandler(Filters.photo, update_quiz, run_async=run_async)
+    )
+    dispatcher.add_handler(
+        MessageHandler(Filters.text, init_quiz_creation, run_async=run_async)
+    )
+    dispatcher.add_handler(CommandHandler("help", help_handler, run_async=run_async))
 
     # Keep track of which chats the bot is in
     dispatcher.add_handler(
         ChatMemberHandler(track_chats, ChatMemberHandler.MY_CHAT_MEMBER)
     )
-    dispatcher.add_handler(CommandHandler("look", show_chats))
+    dispatcher.add_handler(CommandHandler("look", show_chats, run_async=run_async))
 
     # Handle members joining/leaving chats.
     dispatcher.add_handler(
-        ChatMemberHandler(greet_chat_members, ChatMemberHandler.CHAT_MEMBER)
+        ChatMemberHandler(
+            greet_chat_members, ChatMemberHandler.CHAT_MEMBER, run_async=run_async
+        )
     )
 
-    updater.start_webhook(
-        listen="0.0.0.0", port=PORT, url_path=TOKEN, webhook_url=APP_NAME + TOKEN
-    )
 
-    # Start the Bot
+def main() -> None:
+    """Run bot."""
+    main_at = time.perf_counter()
 
-    # We pass 'allowed_updates' handle *all* updates including `chat_member` updates
-    # To reset this, simply pass `allowed_updates=[]
-    updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    # Create the Updater and pass it your bot's token.
+    updater = ingest.build_updater(TOKEN, DISPATCHER_WORKERS)
+
+    # Connect to MongoDB, keep a local copy of the quiz bank and restore the
+    # state, in the background so that updates are received meanwhile. The bank
+    # retries its first load on its own, whatever happens to the warm up
+    quiz_bank.start()
+    db.warm_up(then=lambda: warm_up_quiz(updater.dispatcher.bot_data))
+    # Added before the scheduler starts, it then keeps it as default executor.
+    # configure() would also reset the timezone and job defaults of the job queue
+    updater.job_queue.scheduler.add_executor(ThreadPoolExecutor(JOB_WORKERS), "default")
+    updater.job_queue.run_repeating(evict_sessions, interval=SESSION_SWEEP_SECONDS)
+    updater.job_queue.run_repeating(flush_state, interval=STATE_FLUSH_SECONDS)
+    updater.job_queue.run_repeating(flush_stats, interval=STATS_FLUSH_SECONDS)
+    updater.job_queue.run_repeating(resume_broadcast, interval=BROADCAST_LEASE_SECONDS)
+    updater.job_queue.run_repeating(
+        report_metrics, interval=metrics.METRICS_LOG_SECONDS
+    )
+    register_handlers(updater.dispatcher)
+    ingestion_at = time.perf_counter()
+
+    # Start the Bot, by webhook or long polling (see INGESTION_MODE)
+    ingest.start(updater, port=PORT, url_path=TOKEN, webhook_url=APP_NAME + TOKEN)
+    ready_at = time.perf_counter()
+    logger.info(
+        "[i]-> Ready in %.3fs : imports %.3fs, setup %.3fs, ingestion start %.3fs",
+        ready_at - STARTED_AT,
+        IMPORTED_AT - STARTED_AT,
+        ingestion_at - main_at,
+        ready_at - ingestion_at,
+    )
 
     # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT
     updater.idle()
+    # Heroku sends SIGTERM on every restart, don't lose the last changes
+    state.flush(sessions, updater.dispatcher.bot_data)
+    selector.flush()
+    results.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Resumable broadcast to every tracked chat.
+An admin fans a message, or a quiz poll as the question of the day, out to the
+chat registry of look.py (`user_ids`, `group_ids`, `channel_ids` in bot_data).
+Chats are served in increasing id order by a background thread, with at most
+BROADCAST_WINDOW calls in flight on the lowest outbox lane: the outbox keeps
+the whole bot under Telegram's global rate and quiz sessions are always served
+first. Chats that blocked the bot, or that it was removed from, are pruned
+from the registry.
+Progress is checkpointed in `hcia.state` every BROADCAST_CHECKPOINT_SECONDS.
+A broadcast not checkpointed for BROADCAST_LEASE_SECONDS (its process died) is
+resumed by any bot process from the lowest chat id not known to be served, the
+few calls in flight at the time may be sent twice.
+"""
+
+import os
+import time
+import logging
+import functools
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from telegram import Bot, Poll
+from telegram.error import BadRequest, ChatMigrated, Unauthorized
+
+import metrics
+import outbox
+from models.quiz import Quiz
+from persistence import REGISTRY_KEYS, registry_snapshot
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_WINDOW = int(os.environ.get("BROADCAST_WINDOW", "64"))
+BROADCAST_CHECKPOINT_SECONDS = int(os.environ.get("BROADCAST_CHECKPOINT_SECONDS", "5"))
+BROADCAST_LEASE_SECONDS = int(os.environ.get("BROADCAST_LEASE_SECONDS", "60"))
+BROADCAST_ID = "broadcast"
+COUNTERS = ("sent", "pruned", "failed")
+
+
+def registry(bot_data: dict) -> list:
+    """Ids of every tracked chat, in the order they are served"""
+    chats = set()
+    for ids in registry_snapshot(bot_data).values():
+        chats.update(ids)
+    return sorted(chats)
+
+
+def prune(bot_data: dict, chat_id: int) -> None:
+    for key in REGISTRY_KEYS:
+        bot_data.get(key, set()).discard(chat_id)
+
+
+class Broadcaster:
+    """One broadcast at a time, checkpointed in the state collection"""
+
+    def __init__(
+        self,
+        state_collection=None,
+        window: int = BROADCAST_WINDOW,
+        checkpoint_seconds: float = BROADCAST_CHECKPOINT_SECONDS,
+        lease_seconds: float = BROADCAST_LEASE_SECONDS,
+    ):
+        self._state = state_collection
+        self._window = window
+        self._checkpoint_seconds = checkpoint_seconds
+        self._lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._thread = None
+        # Document of the current or last broadcast of this process
+        self._job = None
+        # Chat ids sent to and not answered yet
+        self._inflight = set()
+
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def progress(self) -> Optional[dict]:
+        """Document of the current or last broadcast, None before the first"""
+        with self._lock:
+            return None if self._job is None else dict(self._job)
+
+    def start(
+        self, bot: Bot, bot_data: dict, text: str = None, quiz: Quiz = None
+    ) -> Optional[int]:
+        """Broadcast text, or quiz as an anonymous poll, to every tracked
+        chat. Return the number of chats, None if a broadcast is running"""
+        if self.running():
+            return None
+        chats = registry(bot_data)
+        now = datetime.utcnow()
+        job = {
+            "text": text,
+            "poll": None if quiz is None else quiz.replace(_id=None).to_bson(),
+            "total": len(chats),
+            "next": None,
+            "done": False,
+            "cancelled": False,
+            "started_at": now,
+            "updated_at": now,
+        }
+        job.update(dict.fromkeys(COUNTERS, 0))
+        if self._state is not None:
+            expired = now - timedelta(seconds=self._lease_seconds)
+            try:
+                # Another process may be running one
+                self._state.update_one(
+                    {
+                        "_id": BROADCAST_ID,
+                        "$or": [{"done": True}, {"updated_at": {"$lt": expired}}],
+                    },
+                    {"$set": job},
+                    upsert=True,
+                )
+            except DuplicateKeyError:
+                return None
+            except Exception as ex:
+                # Sent anyway, without checkpoints to resume from
+                logger.error("[e]-> Exception in start() -> " + str(ex))
+        self._launch(bot, bot_data, job, chats)
+        return len(chats)
+
+    def resume(self, bot: Bot, bot_data: dict) -> bool:
+        """Take over a broadcast left unfinished by a dead process"""
+        if self._state is None or self.running():
+            return False
+        now = datetime.utcnow()
+        expired = now - timedelta(seconds=self._lease_seconds)
+        try:
+            job = self._state.find_one_and_update(
+                {"_id": BROADCAST_ID, "done": False, "updated_at": {"$lt": expired}},
+                {"$set": {"updated_at": now}},
+                return_document=ReturnDocument.AFTER,
+            )
+        except Exception as ex:
+            logger.error("[e]-> Exception in resume() -> " + str(ex))
+            return False
+        if job is None:
+            return False
+        del job["_id"]
+        chats = registry(bot_data)
+        if job["next"] is not None:
+            chats = [chat_id for chat_id in chats if chat_id >= job["next"]]
+        logger.info("[i]-> Broadcast resumed : %d chat(s) left", len(chats))
+        self._launch(bot, bot_data, job, chats)
+        return True
+
+    def cancel(self) -> bool:
+        """Stop the running broadcast after the calls in flight"""
+        if not self.running():
+            return False
+        self._cancel.set()
+        return True
+
+    def _launch(self, bot: Bot, bot_data: dict, job: dict, chats: list) -> None:
+        with self._lock:
+            self._job = job
+            self._inflight = set()
+        self._cancel.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(bot, bot_data, chats), name="broadcast", daemon=True
+        )
+        self._thread.start()
+
+    def _send(self, bot: Bot, chat_id: int, quiz: Optional[Quiz]):
+        if quiz is None:
+            return outbox.send(
+                bot.send_message,
+                chat_id,
+                self._job["text"],
+                chat=chat_id,
+                priority=outbox.BROADCAST,
+            )
+        # Anonymous, answers are not bound to any session
+        return outbox.send(
+            bot.send_poll,
+            chat_id,
+            quiz.question,
+            quiz.options,
+            type=Poll.QUIZ,
+            correct_option_id=quiz.response_id,
+            explanation=quiz.explanation,
+            is_anonymous=True,
+            chat=chat_id,
+            priority=outbox.BROADCAST,
+        )
+
+    def _served(
+        self, window: threading.Semaphore, bot_data: dict, chat_id: int, future
+    ) -> None:
+        exception = future.exception()
+        with self._lock:
+            self._inflight.discard(chat_id)
+            if exception is None:
+                self._job["sent"] += 1
+            elif isinstance(exception, ChatMigrated):
+                # The group became a supergroup, track its new id
+                prune(bot_data, chat_id)
+                bot_data.setdefault("group_ids", set()).add(exception.new_chat_id)
+                self._job["pruned"] += 1
+            elif isinstance(exception, Unauthorized) or (
+                isinstance(exception, BadRequest)
+                and "chat not found" in exception.message.lower()
+            ):
+                # Blocked, kicked or deleted
+                prune(bot_data, chat_id)
+                self._job["pruned"] += 1
+            else:
+                self._job["failed"] += 1
+        window.release()
+
+    def _checkpoint(self, last: Optional[int], done: bool = False) -> None:
+        with self._lock:
+            if self._inflight:
+                self._job["next"] = min(self._inflight)
+            elif last is not None:
+                self._job["next"] = last + 1
+            self._job["done"] = done
+            self._job["updated_at"] = datetime.utcnow()
+            job = dict(self._job)
+        if self._state is None:
+            return
+        try:
+            self._state.replace_one({"_id": BROADCAST_ID}, job, upsert=True)
+        except Exception as ex:
+            logger.error("[e]-> Exception in _checkpoint() -> " + str(ex))
+
+    def _run(self, bot: Bot, bot_data: dict, chats: list) -> None:
+        window = threading.Semaphore(self._window)
+        checkpoint_at = time.monotonic() + self._checkpoint_seconds
+        last = None
+        poll = self._job["poll"]
+        quiz = None if poll is None else Quiz.from_bson(poll)
+        with metrics.timed("broadcast.run"):
+            for chat_id in chats:
+                # A full window must not hold the checkpoints back, or the
+                # lease would expire and another process take over
+                while not window.acquire(timeout=self._checkpoint_seconds):
+                    self._checkpoint(last)
+                    checkpoint_at = time.monotonic() + self._checkpoint_seconds
+                if self._cancel.is_set():
+                    window.release()
+                    break
+                with self._lock:
+                    self._inflight.add(chat_id)
+                future = self._send(bot, chat_id, quiz)
+                future.add_done_callback(
+                    functools.partial(self._served, window, bot_data, chat_id)
+                )
+                last = chat_id
+                if time.monotonic() >= checkpoint_at:
+                    self._checkpoint(last)
+                    checkpoint_at = time.monotonic() + self._checkpoint_seconds
+
+            # Wait for the calls in flight
+            for _ in range(self._window):
+                while not window.acquire(timeout=self._checkpoint_seconds):
+                    self._checkpoint(last)
+        with self._lock:
+            self._job["cancelled"] = self._cancel.is_set()
+        self._checkpoint(last, done=True)
+        logger.info(
+            "[i]-> Broadcast %s : %s",
+            "cancelled" if self._cancel.is_set() else "done",
+            ", ".join("%s %d" % (c, self._job[c]) for c in COUNTERS),
+        )
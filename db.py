@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Lazy MongoDB connection.
+Building a MongoClient for a `mongodb+srv://` URI resolves DNS SRV records and
+sets up the connection pool, which used to delay every cold start. The client
+is now built on first use, or ahead of time by `warm_up` in the background.
+Collection method calls are counted and timed as `mongo.<collection>.<method>`.
+`find` only builds a cursor, its reads are timed by the callers.
+"""
+
+import os
+import time
+import logging
+import functools
+import threading
+from typing import Callable
+
+from pymongo import MongoClient
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MONGO_URI = os.environ.get("MONGO_DB")
+# A failed warm up is tried again after 1, 2, 4... seconds up to this
+WARM_UP_RETRY_SECONDS = 60
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_client() -> MongoClient:
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                with metrics.timed("startup.mongo_client"):
+                    _client = MongoClient(MONGO_URI)
+    return _client
+
+
+class LazyCollection:
+    """Stand-in for a collection, resolved on first attribute access"""
+
+    def __init__(self, database: str, name: str):
+        self._database = database
+        self._name = name
+
+    def __getattr__(self, attribute: str):
+        found = getattr(get_client()[self._database][self._name], attribute)
+        if not callable(found):
+            return found
+        return functools.partial(
+            metrics.call, "mongo.%s.%s" % (self._name, attribute), found
+        )
+
+
+def collection(database: str, name: str) -> LazyCollection:
+    return LazyCollection(database, name)
+
+
+def warm_up(then: Callable[[], None] = None) -> threading.Thread:
+    """Open the connection pool in the background, then run `then`. Both are
+    tried again until `then` returns without raising"""
+
+    def run() -> None:
+        delay = 1
+        while True:
+            start = time.perf_counter()
+            try:
+                get_client().admin.command("ping")
+                connected = time.perf_counter()
+                if then is not None:
+                    then()
+                logger.info(
+                    "[i]-> MongoDB warm up : connect %.3fs, then %.3fs",
+                    connected - start,
+                    time.perf_counter() - connected,
+                )
+                return
+            except Exception as ex:
+                logger.error(
+                    "[e]-> Exception in warm_up() -> "
+                    + str(ex)
+                    + " -> retry in "
+                    + str(delay)
+                    + "s"
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, WARM_UP_RETRY_SECONDS)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
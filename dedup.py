@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Near-duplicate quiz detection.
+Each quiz gets a MinHash signature of the character shingles of its normalized
+question and options. Signatures are computed with one hash per shingle (one
+permutation hashing: the hash picks a bin and each bin keeps its minimum) and
+indexed by LSH bands, so a lookup only compares the few quiz sharing a band
+instead of the whole bank. Two quiz are duplicates when their estimated Jaccard
+similarity reaches DUPLICATE_THRESHOLD and their correct options match: the
+"hello interval" and "dead interval" questions differ by one word only, but
+their correct options differ too, so neither is a duplicate of the other.
+"""
+
+import os
+import re
+import zlib
+import operator
+import threading
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+import metrics
+from models.quiz import Quiz
+
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", "0.8"))
+SHINGLE_SIZE = 4
+# BANDS * ROWS bins per signature. With 16 bands of 4 rows, quiz at 0.8 share a
+# band with probability 1 - (1 - 0.8 ** 4) ** 16 > 0.999, quiz at 0.3 with 0.12
+BANDS = 16
+ROWS = 4
+BINS = BANDS * ROWS
+EMPTY = 1 << 32
+
+_PUNCTUATION = re.compile(r"[\W_]+")
+
+
+def _clean(text: str) -> str:
+    return " ".join(_PUNCTUATION.sub(" ", text.lower()).split())
+
+
+def normalize(quiz: Quiz) -> str:
+    """Question then options in a canonical order, lower case, no punctuation"""
+    options = sorted(_clean(option) for option in quiz.options)
+    return " ".join([_clean(quiz.question)] + options)
+
+
+def answer(quiz: Quiz) -> int:
+    """crc of the normalized correct option, 0 if it is unknown"""
+    try:
+        option = quiz.options[quiz.response_id]
+    except IndexError:
+        return 0
+    return zlib.crc32(_clean(option).encode("utf-8"))
+
+
+def signature(text: str) -> bytes:
+    """MinHash signature of the shingles of text, BINS packed 32 bits values"""
+    data = text.encode("utf-8")
+    mins = [EMPTY] * BINS
+    for start in range(max(len(data) - SHINGLE_SIZE + 1, 1)):
+        value = zlib.crc32(data[start : start + SHINGLE_SIZE])
+        position = value % BINS
+        if value < mins[position]:
+            mins[position] = value
+    # Densification: an empty bin borrows the value of the next filled one
+    for position in range(BINS):
+        if mins[position] == EMPTY:
+            for offset in range(1, BINS):
+                borrowed = mins[(position + offset) % BINS]
+                if borrowed != EMPTY:
+                    mins[position] = (borrowed + offset) & 0xFFFFFFFF
+                    break
+            else:
+                mins[position] = 0
+    return array("I", mins).tobytes()
+
+
+def similarity(first: bytes, second: bytes) -> float:
+    """Estimated Jaccard similarity of the shingles behind two signatures"""
+    return sum(map(operator.eq, array("I", first), array("I", second))) / BINS
+
+
+def _bands(sig: bytes) -> List[Tuple[int, bytes]]:
+    """Bucket keys of a signature, one (band, rows) per band"""
+    size = len(sig) // BANDS
+    return [(band, sig[band * size : (band + 1) * size]) for band in range(BANDS)]
+
+
+class NearDuplicateIndex:
+    """LSH index of quiz signatures, by quiz _id"""
+
+    def __init__(self, threshold: float = DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        # _id -> (crc of the normalized text, answer, signature), and
+        # (band, its rows of the signature) -> _ids.
+        # Kept compact, the index holds every quiz of the bank
+        self._entries = {}
+        self._buckets = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _unlink(self, quiz_id) -> None:
+        entry = self._entries.pop(quiz_id, None)
+        if entry is not None:
+            for key in _bands(entry[2]):
+                bucket = self._buckets.get(key)
+                if bucket is not None and quiz_id in bucket:
+                    bucket.remove(quiz_id)
+                    if not bucket:
+                        del self._buckets[key]
+
+    def _link(self, quiz_id, quiz: Quiz, text: str) -> None:
+        sig = signature(text)
+        self._entries[quiz_id] = (zlib.crc32(text.encode("utf-8")), answer(quiz), sig)
+        for key in _bands(sig):
+            self._buckets.setdefault(key, []).append(quiz_id)
+
+    def add(self, quiz_id, quiz: Quiz) -> None:
+        """Index quiz, replacing what was indexed under its _id"""
+        text = normalize(quiz)
+        with self._lock:
+            self._unlink(quiz_id)
+            self._link(quiz_id, quiz, text)
+
+    def remove(self, quiz_id) -> None:
+        with self._lock:
+            self._unlink(quiz_id)
+
+    def sync(self, records: Iterable[Quiz]) -> None:
+        """Match the index to a full bank, only new or edited quiz are hashed"""
+        with metrics.timed("dedup.sync"):
+            seen = set()
+            for quiz in records:
+                text = normalize(quiz)
+                seen.add(quiz._id)
+                entry = self._entries.get(quiz._id)
+                if (
+                    entry is None
+                    or entry[0] != zlib.crc32(text.encode("utf-8"))
+                    or entry[1] != answer(quiz)
+                ):
+                    with self._lock:
+                        self._unlink(quiz._id)
+                        self._link(quiz._id, quiz, text)
+            with self._lock:
+                for quiz_id in [i for i in self._entries if i not in seen]:
+                    self._unlink(quiz_id)
+
+    def _candidates(
+        self, sig: bytes, correct: int, exclude
+    ) -> List[Tuple[object, float]]:
+        found = set()
+        with self._lock:
+            for key in _bands(sig):
+                found.update(self._buckets.get(key, ()))
+            found.discard(exclude)
+            scored = [
+                (i, similarity(sig, self._entries[i][2]))
+                for i in found
+                if self._entries[i][1] == correct
+            ]
+        return sorted(
+            [(i, score) for i, score in scored if score >= self.threshold],
+            key=lambda match: match[1],
+            reverse=True,
+        )
+
+    def query(self, quiz: Quiz, exclude=None) -> List[Tuple[object, float]]:
+        """(_id, similarity) of the indexed duplicates of quiz, best first.
+        exclude is the _id of quiz itself, when it is indexed already"""
+        with metrics.timed("dedup.query"):
+            return self._candidates(signature(normalize(quiz)), answer(quiz), exclude)
+
+    def scan(self) -> List[List[object]]:
+        """Groups of _id of near-duplicate quiz, over the whole index"""
+        with metrics.timed("dedup.scan"):
+            parent = {}
+
+            def root(quiz_id):
+                while parent.get(quiz_id, quiz_id) != quiz_id:
+                    quiz_id = parent[quiz_id]
+                return quiz_id
+
+            for quiz_id, (_, correct, sig) in list(self._entries.items()):
+                for other, _ in self._candidates(sig, correct, quiz_id):
+                    first, second = root(quiz_id), root(other)
+                    if first != second:
+                        parent[second] = first
+
+            groups: Dict[object, List[object]] = {}
+            for quiz_id in parent:
+                groups.setdefault(root(quiz_id), []).append(quiz_id)
+            for first, members in groups.items():
+                if first not in members:
+                    members.insert(0, first)
+        return list(groups.values())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Update ingestion.
+Builds the Updater around a bounded update queue and starts it either as a
+webhook server or as a long-polling loop, depending on INGESTION_MODE. When
+handlers fall behind, the dispatcher stops pulling updates and the queue fills
+up. Long polling then waits for room before asking for more updates, Telegram
+keeps them meanwhile. The webhook answers 503 to updates the full queue can't
+take, before acknowledging them, so that Telegram delivers them again later;
+they are counted as rejected.
+Bot API calls are counted and timed as `bot_api.<method>`. In webhook mode,
+when METRICS_TOKEN is set, the webhook server also serves the metrics at
+METRICS_PATH to Prometheus, as a bearer token protected route.
+"""
+
+import os
+import hmac
+import time
+import logging
+import threading
+from queue import Queue, Full
+
+from telegram import Update
+from telegram.ext import Updater, Dispatcher, JobQueue, ExtBot
+from telegram.utils.request import Request
+from tornado.web import HTTPError, RequestHandler
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK = "webhook"
+POLLING = "polling"
+INGESTION_MODE = os.environ.get("INGESTION_MODE", WEBHOOK)
+# Updates received but not yet dispatched
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+# Handlers running or waiting for a worker
+MAX_INFLIGHT = int(os.environ.get("MAX_INFLIGHT", "256"))
+# Parallel connections Telegram may open to deliver webhook updates
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Long polling: how long getUpdates waits for updates, and pause between calls
+POLL_TIMEOUT = float(os.environ.get("POLL_TIMEOUT", "30"))
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "0"))
+POLL_READ_LATENCY = float(os.environ.get("POLL_READ_LATENCY", "2"))
+# Metrics endpoint of the webhook server, only served with a bearer token
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+
+class UpdateQueue(Queue):
+    """Bounded update queue that measures queueing lag.
+    Once reject_full is set (webhook mode), a put on a full queue fails with
+    a 503 instead of blocking the webhook server loop"""
+
+    def __init__(self, maxsize: int = UPDATE_QUEUE_SIZE):
+        super().__init__(maxsize)
+        self.reject_full = False
+        self.rejected = 0
+
+    def put(self, item, block: bool = True, timeout: float = None) -> None:
+        if not self.reject_full:
+            super().put(item, block, timeout)
+            return
+        try:
+            super().put(item, block=False)
+        except Full:
+            self.rejected += 1
+            logger.warning("[w]-> Update queue full, update left to Telegram")
+            # Raised before the response is sent, the 200 set by the webhook
+            # handler is replaced and Telegram delivers the update again
+            raise HTTPError(503) from None
+
+    # Items are stored with their arrival time
+    def _put(self, item) -> None:
+        self.queue.append((time.perf_counter(), item))
+
+    def _get(self):
+        queued_at, item = self.queue.popleft()
+        metrics.observe("update_lag", time.perf_counter() - queued_at)
+        return item
+
+
+class BoundedDispatcher(Dispatcher):
+    """Dispatcher that stops pulling updates while MAX_INFLIGHT handlers are pending"""
+
+    def __init__(self, *args, max_inflight: int = MAX_INFLIGHT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_inflight = max_inflight
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+
+    @property
+    def inflight(self) -> int:
+        return self.max_inflight - self._inflight._value
+
+    def _run_async(self, func, *args, update=None, error_handling=True, **kwargs):
+        self._inflight.acquire()
+
+        def bounded(*func_args, **func_kwargs):
+            try:
+                return func(*func_args, **func_kwargs)
+            finally:
+                self._inflight.release()
+
+        return super()._run_async(
+            bounded, *args, update=update, error_handling=error_handling, **kwargs
+        )
+
+
+class InstrumentedRequest(Request):
+    """Request timing each Bot API call by method"""
+
+    def post(self, url: str, data: dict = None, timeout: float = None):
+        method = url.rsplit("/", 1)[-1]
+        if method == "getUpdates":
+            # Long polling waits for updates, its duration is not a latency
+            return super().post(url, data, timeout)
+        return metrics.call("bot_api." + method, super().post, url, data, timeout)
+
+
+class MetricsHandler(RequestHandler):
+    """Serves metrics.prometheus() on the webhook server"""
+
+    def get(self) -> None:
+        authorization = self.request.headers.get("Authorization", "")
+        if not METRICS_TOKEN or not hmac.compare_digest(
+            authorization.encode(), ("Bearer " + METRICS_TOKEN).encode()
+        ):
+            self.set_status(403)
+            return
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.prometheus())
+
+
+def build_updater(token: str, workers: int) -> Updater:
+    # One connection per worker, plus dispatcher, updater, job queue and main thread
+    bot = ExtBot(token, request=InstrumentedRequest(con_pool_size=workers + 4))
+    job_queue = JobQueue()
+    dispatcher = BoundedDispatcher(
+        bot, UpdateQueue(), workers=workers, job_queue=job_queue
+    )
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def start(updater: Updater, port: int, url_path: str, webhook_url: str) -> None:
+    """Start receiving updates in the configured INGESTION_MODE"""
+    # We pass 'allowed_updates' handle *all* updates including `chat_member` updates
+    if INGESTION_MODE == POLLING:
+        logger.info("[i]-> Receiving updates by long polling")
+        updater.start_polling(
+            poll_interval=POLL_INTERVAL,
+            timeout=POLL_TIMEOUT,
+            read_latency=POLL_READ_LATENCY,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    elif INGESTION_MODE == WEBHOOK:
+        logger.info("[i]-> Receiving updates on webhook, port %d", port)
+        updater.update_queue.reject_full = True
+        updater.start_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=url_path,
+            webhook_url=webhook_url,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        if METRICS_TOKEN:
+            serve_metrics(updater)
+    else:
+        raise ValueError("Unknown INGESTION_MODE " + INGESTION_MODE)
+
+
+def serve_metrics(updater: Updater, path: str = METRICS_PATH) -> None:
+    """Add the metrics endpoint to the running webhook server"""
+    app = updater.httpd.http_server.request_callback
+    # Handlers are added from the server loop, the webhook keeps its route
+    updater.httpd.loop.add_callback(app.add_handlers, r".*", [(path, MetricsHandler)])
+    logger.info("[i]-> Metrics served at %s", path)
+
+
+def summary(dispatcher: Dispatcher) -> str:
+    update_queue = dispatcher.update_queue
+    text = "update_queue: depth=%d/%d rejected=%d" % (
+        update_queue.qsize(),
+        update_queue.maxsize,
+        getattr(update_queue, "rejected", 0),
+    )
+    if isinstance(dispatcher, BoundedDispatcher):
+        text += " inflight=%d/%d" % (dispatcher.inflight, dispatcher.max_inflight)
+    return text
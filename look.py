@@ -5,12 +5,16 @@
 """
 Simple Bot to handle '(my_)chat_member' updates.
 Greets new users & keeps track of which chats the bot is in.
+Joins and leaves of a chat are collected for GREETING_SECONDS and greeted in
+one message, naming up to GREETING_NAMES members of each and counting the
+others, so that a wave of joins doesn't hit the chat rate limit.
 Usage:
 Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 import os
 import logging
+import threading
 from typing import Tuple, Optional
 
 from telegram import Update, Chat, ChatMember, ParseMode, ChatMemberUpdated
@@ -21,6 +25,9 @@ from telegram.ext import (
     ChatMemberHandler,
 )
 
+import metrics
+import outbox
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -28,6 +35,11 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Joins and leaves of a chat are greeted in one message every GREETING_SECONDS
+GREETING_SECONDS = float(os.environ.get("GREETING_SECONDS", "5"))
+# Members named in one greeting, the others are counted
+GREETING_NAMES = int(os.environ.get("GREETING_NAMES", "10"))
+
 
 def extract_status_change(
     chat_member_update: ChatMemberUpdated,
@@ -67,6 +79,7 @@ def extract_status_change(
     return was_member, is_member
 
 
+@metrics.instrument("handler.track_chats")
 def track_chats(update: Update, context: CallbackContext) -> None:
     """Tracks the chats the bot is in."""
     result = extract_status_change(update.my_chat_member)
@@ -120,7 +133,97 @@ def show_chats(update: Update, context: CallbackContext) -> None:
         f" Moreover it is a member of the groups with IDs {group_ids} "
         f"and administrator in the channels with IDs {channel_ids}."
     )
-    update.effective_message.reply_text(text)
+    outbox.send(
+        update.effective_message.reply_text, text, chat=update.effective_chat.id
+    )
+
+
+class PendingGreeting:
+    """Joins and leaves of one chat waiting for their greeting"""
+
+    __slots__ = ("joined", "left", "more_joined", "more_left", "cause_name")
+
+    def __init__(self):
+        # user id -> mention, up to GREETING_NAMES, the others are counted
+        self.joined = {}
+        self.left = {}
+        self.more_joined = 0
+        self.more_left = 0
+        # Who caused the last change, named when only one member changed
+        self.cause_name = None
+
+    def join(self, user_id: int, member_name: str) -> None:
+        if self.left.pop(user_id, None) is not None:
+            # Left and came back meanwhile
+            return
+        if len(self.joined) < GREETING_NAMES:
+            self.joined[user_id] = member_name
+        else:
+            self.more_joined += 1
+
+    def leave(self, user_id: int, member_name: str) -> None:
+        if self.joined.pop(user_id, None) is not None:
+            return
+        if len(self.left) < GREETING_NAMES:
+            self.left[user_id] = member_name
+        else:
+            self.more_left += 1
+
+    def text(self) -> Optional[str]:
+        joined = len(self.joined) + self.more_joined
+        left = len(self.left) + self.more_left
+        if joined == 1 and not left and self.joined:
+            member_name = next(iter(self.joined.values()))
+            return f"{member_name} was added by {self.cause_name}. Welcome!"
+        if left == 1 and not joined and self.left:
+            member_name = next(iter(self.left.values()))
+            return f"{member_name} is no longer with us. Thanks a lot, {self.cause_name} ..."
+        lines = []
+        if joined:
+            lines.append(f"Welcome {name_list(self.joined, self.more_joined)}!")
+        if left:
+            lines.append(
+                f"{name_list(self.left, self.more_left)} "
+                + ("is" if left == 1 else "are")
+                + " no longer with us."
+            )
+        return "\n".join(lines) or None
+
+
+def name_list(names: dict, more: int) -> str:
+    """Names listed as in 'A, B and 12 others'"""
+    names = list(names.values())
+    if more:
+        names.append(f"{more} other" + ("s" if more > 1 else ""))
+    if len(names) == 1:
+        return names[0]
+    return ", ".join(names[:-1]) + " and " + names[-1]
+
+
+# chat id -> PendingGreeting, until its greeting is sent
+pending_greetings = {}
+pending_lock = threading.Lock()
+
+
+def send_greeting(bot, chat_id: int) -> None:
+    with pending_lock:
+        pending = pending_greetings.pop(chat_id, None)
+    text = pending.text() if pending else None
+    if text is None:
+        # Everyone who joined left meanwhile, or the other way round
+        return
+    outbox.send(
+        bot.send_message,
+        chat_id,
+        text,
+        parse_mode=ParseMode.HTML,
+        chat=chat_id,
+        priority=outbox.GREETING,
+    )
+
+
+def greeting_due(context: CallbackContext) -> None:
+    send_greeting(context.bot, context.job.context)
 
 
 def greet_chat_members(update: Update, context: CallbackContext) -> None:
@@ -130,18 +233,34 @@ def greet_chat_members(update: Update, context: CallbackContext) -> None:
         return
 
     was_member, is_member = result
+    if was_member == is_member:
+        return
     cause_name = update.chat_member.from_user.mention_html()
-    member_name = update.chat_member.new_chat_member.user.mention_html()
+    member = update.chat_member.new_chat_member.user
+    chat_id = update.effective_chat.id
 
-    if not was_member and is_member:
-        update.effective_chat.send_message(
-            f"{member_name} was added by {cause_name}. Welcome!",
-            parse_mode=ParseMode.HTML,
-        )
-    elif was_member and not is_member:
-        update.effective_chat.send_message(
-            f"{member_name} is no longer with us. Thanks a lot, {cause_name} ...",
-            parse_mode=ParseMode.HTML,
+    with pending_lock:
+        pending = pending_greetings.get(chat_id)
+        first = pending is None
+        if first:
+            pending = pending_greetings[chat_id] = PendingGreeting()
+        pending.cause_name = cause_name
+        if is_member:
+            pending.join(member.id, member.mention_html())
+        else:
+            pending.leave(member.id, member.mention_html())
+
+    if not first:
+        # Greeted with the first change of the window
+        return
+    if context.job_queue is None or GREETING_SECONDS <= 0:
+        send_greeting(context.bot, chat_id)
+    else:
+        context.job_queue.run_once(
+            greeting_due,
+            GREETING_SECONDS,
+            context=chat_id,
+            name="greeting-" + str(chat_id),
         )
 
 
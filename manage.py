@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Quiz bank maintenance commands.
+    python3 manage.py import bank.jsonl [--batch-size 1000] [--dry-run]
+    python3 manage.py export bank.csv
+    python3 manage.py duplicates [--threshold 0.8]
+Files are JSON lines (one quiz per line) or CSV (question, response_id,
+explanation, imgs, tags, option_1 ... option_10), chosen by extension or
+--format.
+`-` reads stdin or writes stdout. Records are streamed: each one is validated
+against the Quiz fields, duplicates (same question and options, in the file or
+already in the bank) are skipped and the rest is inserted in batches.
+`duplicates` lists the groups of near-duplicate quiz of the whole bank.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import contextlib
+from typing import Iterable, Iterator, Tuple
+
+import db
+from dedup import DUPLICATE_THRESHOLD, NearDuplicateIndex
+from models.quiz import Quiz
+from repository import QuizRepository
+
+# Telegram limits of a quiz poll
+MAX_QUESTION_LENGTH = 300
+MAX_OPTION_LENGTH = 100
+MIN_OPTIONS = 2
+MAX_OPTIONS = 10
+MAX_EXPLANATION_LENGTH = 200
+BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "1000"))
+OPTION_FIELDS = ["option_" + str(number) for number in range(1, MAX_OPTIONS + 1)]
+CSV_FIELDS = ["question", "response_id", "explanation", "imgs", "tags"] + OPTION_FIELDS
+
+
+class InvalidQuiz(ValueError):
+    pass
+
+
+def validate(record: dict) -> Quiz:
+    """Quiz made of the Quiz.FIELDS of record, raise InvalidQuiz if unusable.
+    Other fields (_id, chat_id, ...) are dropped"""
+    question = record.get("question")
+    if not isinstance(question, str) or not question.strip():
+        raise InvalidQuiz("question is missing")
+    if len(question) > MAX_QUESTION_LENGTH:
+        raise InvalidQuiz("question is over %d characters" % MAX_QUESTION_LENGTH)
+
+    options = record.get("options")
+    if not isinstance(options, list) or not (
+        MIN_OPTIONS <= len(options) <= MAX_OPTIONS
+    ):
+        raise InvalidQuiz("%d to %d options expected" % (MIN_OPTIONS, MAX_OPTIONS))
+    for option in options:
+        if not isinstance(option, str) or not option.strip():
+            raise InvalidQuiz("empty option")
+        if len(option) > MAX_OPTION_LENGTH:
+            raise InvalidQuiz("option is over %d characters" % MAX_OPTION_LENGTH)
+
+    # The GitHub issue workflow stores the index as a string
+    try:
+        response_id = int(record.get("response_id"))
+    except (TypeError, ValueError):
+        raise InvalidQuiz("response_id is not a number")
+    if not 0 <= response_id < len(options):
+        raise InvalidQuiz("response_id is not the index of an option")
+
+    imgs = record.get("imgs")
+    if imgs and (
+        not isinstance(imgs, list) or not all(isinstance(i, str) for i in imgs)
+    ):
+        raise InvalidQuiz("imgs must be a list of file ids")
+    # A list, or a text as stored by the GitHub issue workflow
+    tags = record.get("tags")
+    if (
+        tags
+        and not isinstance(tags, str)
+        and (not isinstance(tags, list) or not all(isinstance(t, str) for t in tags))
+    ):
+        raise InvalidQuiz("tags must be a list of words")
+    explanation = record.get("explanation") or None
+    if explanation is not None:
+        if not isinstance(explanation, str):
+            raise InvalidQuiz("explanation must be a text")
+        if len(explanation) > MAX_EXPLANATION_LENGTH:
+            raise InvalidQuiz(
+                "explanation is over %d characters" % MAX_EXPLANATION_LENGTH
+            )
+    return Quiz(question, options, response_id, imgs, explanation, tags=tags)
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def quiz_key(quiz: Quiz) -> bytes:
+    """Digest of the question and options, equal for duplicate quiz"""
+    text = "\x1f".join(
+        [_normalize(quiz.question)] + [_normalize(o) for o in quiz.options]
+    )
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def file_format(path: str, forced: str = None) -> str:
+    if forced:
+        return forced
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def read_csv(stream) -> Iterator[Tuple[int, dict]]:
+    reader = csv.DictReader(stream)
+    for row in reader:
+        options = [
+            row[field]
+            for field in OPTION_FIELDS
+            if field in row and row[field] not in (None, "")
+        ]
+        record = {
+            "question": row.get("question"),
+            "options": options,
+            "response_id": row.get("response_id"),
+            "explanation": row.get("explanation"),
+            "imgs": (row.get("imgs") or "").split(),
+            "tags": row.get("tags"),
+        }
+        yield reader.line_num, record
+
+
+def read_jsonl(stream) -> Iterator[Tuple[int, dict]]:
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as ex:
+            record = InvalidQuiz("not JSON: " + str(ex))
+        yield number, record
+
+
+def batches(items: Iterable, size: int) -> Iterator[list]:
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_quiz(
+    repository: QuizRepository,
+    stream,
+    fmt: str,
+    batch_size: int = BATCH_SIZE,
+    dry_run: bool = False,
+) -> dict:
+    """Stream quiz from a file into the bank, return the counts of the run"""
+    counts = {"read": 0, "imported": 0, "duplicates": 0, "invalid": 0}
+    # Only digests are kept, 20 bytes per quiz of the bank
+    seen = {quiz_key(quiz) for quiz in repository.iter_bank()}
+
+    def valid_quiz() -> Iterator[Quiz]:
+        reader = read_csv if fmt == "csv" else read_jsonl
+        for number, record in reader(stream):
+            counts["read"] += 1
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                if not isinstance(record, dict):
+                    raise InvalidQuiz("a quiz must be an object")
+                quiz = validate(record)
+            except InvalidQuiz as ex:
+                counts["invalid"] += 1
+                print("line %d: %s" % (number, ex), file=sys.stderr)
+                continue
+            key = quiz_key(quiz)
+            if key in seen:
+                counts["duplicates"] += 1
+                continue
+            seen.add(key)
+            yield quiz
+
+    for batch in batches(valid_quiz(), batch_size):
+        counts["imported"] += len(batch) if dry_run else repository.insert_many(batch)
+    return counts
+
+
+def export_quiz(repository: QuizRepository, stream, fmt: str) -> int:
+    """Stream the whole bank to a file, return the number of quiz written"""
+    written = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, CSV_FIELDS)
+        writer.writeheader()
+    for quiz in repository.iter_bank():
+        record = quiz.to_bson()
+        del record["_id"]
+        if fmt == "csv":
+            row = {
+                "question": record["question"],
+                "response_id": record["response_id"],
+                "explanation": record.get("explanation", ""),
+                "imgs": " ".join(record.get("imgs", [])),
+                "tags": " ".join(record.get("tags", [])),
+            }
+            row.update(zip(OPTION_FIELDS, record["options"]))
+            writer.writerow(row)
+        else:
+            stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        written += 1
+    return written
+
+
+def scan_duplicates(repository: QuizRepository, stream, threshold: float) -> int:
+    """Write the groups of near-duplicate quiz, return the number of groups"""
+    index = NearDuplicateIndex(threshold)
+    questions = {}
+    for quiz in repository.iter_bank():
+        index.add(quiz._id, quiz)
+        questions[quiz._id] = quiz.question
+    groups = index.scan()
+    for group in groups:
+        for quiz_id in group:
+            stream.write("%s  %s\n" % (quiz_id, questions[quiz_id]))
+        stream.write("\n")
+    return len(groups)
+
+
+def open_file(path: str, mode: str):
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    # newline="" lets the csv module handle line endings, and is harmless for JSON lines
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importing = commands.add_parser("import", help="add quiz from a file to the bank")
+    importing.add_argument("path")
+    importing.add_argument("--format", choices=("jsonl", "csv"))
+    importing.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    importing.add_argument(
+        "--dry-run", action="store_true", help="validate only, write nothing"
+    )
+
+    exporting = commands.add_parser("export", help="write the whole bank to a file")
+    exporting.add_argument("path")
+    exporting.add_argument("--format", choices=("jsonl", "csv"))
+
+    scanning = commands.add_parser(
+        "duplicates", help="list the groups of near-duplicate quiz"
+    )
+    scanning.add_argument("--threshold", type=float, default=DUPLICATE_THRESHOLD)
+    args = parser.parse_args()
+
+    repository = QuizRepository(db.collection("hcia", "quiz"))
+    start = time.perf_counter()
+    if args.command == "duplicates":
+        groups = scan_duplicates(repository, sys.stdout, args.threshold)
+        print(
+            "%d group(s) of near duplicates in %.1fs"
+            % (groups, time.perf_counter() - start),
+            file=sys.stderr,
+        )
+        return
+
+    fmt = file_format(args.path, args.format)
+    if args.command == "import":
+        with open_file(args.path, "r") as stream:
+            counts = import_quiz(repository, stream, fmt, args.batch_size, args.dry_run)
+        print(
+            "%(read)d read, %(imported)d imported, %(duplicates)d duplicates,"
+            " %(invalid)d invalid" % counts
+            + " in %.1fs" % (time.perf_counter() - start),
+            file=sys.stderr,
+        )
+    else:
+        with open_file(args.path, "w") as stream:
+            written = export_quiz(repository, stream, fmt)
+        print(
+            "%d exported in %.1fs" % (written, time.perf_counter() - start),
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Media cache.
+Local assets are uploaded to Telegram once, the returned file_id is kept in
+memory and in the `hcia.media` collection so that it survives restarts. Every
+later send only carries the file_id. Quiz illustrations are stored as file_id
+already and are sent with Bot.send_photo.
+"""
+
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from typing import Optional
+
+from telegram import Bot, Message
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def asset_key(path: str) -> str:
+    """Content digest of a local asset, a changed file gets a new key"""
+    with open(path, "rb") as asset:
+        return hashlib.sha1(asset.read()).hexdigest()
+
+
+class MediaCache:
+    """file_id of uploaded assets, in memory and in Mongo"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._lock = threading.Lock()
+        self._file_ids = {}
+
+    def file_id(self, key: str) -> Optional[str]:
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            return file_id
+        try:
+            media = self._collection.find_one({"_id": key}, {"file_id": 1})
+        except Exception as ex:
+            logger.error("[e]-> Exception in MediaCache.file_id() -> " + str(ex))
+            return None
+        if media:
+            with self._lock:
+                self._file_ids[key] = media["file_id"]
+            return media["file_id"]
+        return None
+
+    def remember(self, key: str, file_id: str, path: str = None) -> None:
+        with self._lock:
+            self._file_ids[key] = file_id
+        try:
+            self._collection.replace_one(
+                {"_id": key},
+                {"_id": key, "file_id": file_id, "path": path},
+                upsert=True,
+            )
+        except Exception as ex:
+            logger.error("[e]-> Exception in MediaCache.remember() -> " + str(ex))
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            self._file_ids.pop(key, None)
+        try:
+            self._collection.delete_one({"_id": key})
+        except Exception as ex:
+            logger.error("[e]-> Exception in MediaCache.forget() -> " + str(ex))
+
+    def send_asset(self, bot: Bot, chat_id: int, path: str, **kwargs) -> Message:
+        """Send the local picture at path, uploaded on first use only"""
+        key = asset_key(path)
+        file_id = self.file_id(key)
+        if file_id is not None:
+            try:
+                return bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except BadRequest as ex:
+                # file_id no longer valid (e.g. new bot token), upload again
+                logger.warning("[w]-> Cached file_id rejected -> " + str(ex))
+                self.forget(key)
+
+        with open(path, "rb") as asset:
+            message = bot.send_photo(chat_id=chat_id, photo=asset, **kwargs)
+        # Largest size is the original picture
+        self.remember(key, message.photo[-1].file_id, path=path)
+        return message
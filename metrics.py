@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Lightweight in-process metrics.
+Latencies are accumulated in fixed-bucket histograms, cheap enough to be
+observed on every update. Functions on hot paths (handlers, Mongo and Bot API
+calls) are timed on METRICS_SAMPLE_RATE of their calls, and all of them are
+counted. Gauges are read when reported.
+Everything is logged every METRICS_LOG_SECONDS, shown by /stats and served in
+the Prometheus text format when a scrape token is set (see
+ingest.serve_metrics).
+"""
+
+import os
+import time
+import math
+import bisect
+import random
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+METRICS_LOG_SECONDS = int(os.environ.get("METRICS_LOG_SECONDS", "300"))
+# Share of the calls of instrumented functions that are timed
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1"))
+# Upper bounds (in seconds) of histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        # Observed or not, when sampled
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[position] += 1
+            self.count += 1
+            self.sum += value
+            self.calls += 1
+
+    def skip(self) -> None:
+        """Count a call left out of the sample"""
+        with self._lock:
+            self.calls += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile"""
+        rank = q * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if position < len(self.buckets):
+                    return self.buckets[position]
+                return float("inf")
+        return 0.0
+
+    def summary(self) -> str:
+        if not self.count:
+            return "n=0 calls=%d" % self.calls if self.calls else "n=0"
+        text = "n=%d avg=%.3fs p50<=%ss p99<=%ss" % (
+            self.count,
+            self.sum / self.count,
+            self.quantile(0.5),
+            self.quantile(0.99),
+        )
+        if self.calls != self.count:
+            text += " calls=%d" % self.calls
+        return text
+
+    def snapshot(self) -> tuple:
+        """Consistent (counts, count, sum, calls)"""
+        with self._lock:
+            return list(self.counts), self.count, self.sum, self.calls
+
+
+histograms = {}
+# name -> function returning the current value
+gauges = {}
+_lock = threading.Lock()
+
+
+def histogram(name: str) -> Histogram:
+    found = histograms.get(name)
+    if found is None:
+        with _lock:
+            found = histograms.setdefault(name, Histogram())
+    return found
+
+
+def observe(name: str, value: float) -> None:
+    histogram(name).observe(value)
+
+
+@contextmanager
+def timed(name: str):
+    """Observe the duration of the with block under name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def call(name: str, function: Callable, *args, **kwargs):
+    """function(*args, **kwargs), timed under name if sampled"""
+    found = histogram(name)
+    if METRICS_SAMPLE_RATE < 1 and random.random() >= METRICS_SAMPLE_RATE:
+        found.skip()
+        return function(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        found.observe(time.perf_counter() - start)
+
+
+def instrument(name: str):
+    """Decorator timing each sampled call of a function under name"""
+
+    def decorate(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def instrumented(*args, **kwargs):
+            return call(name, function, *args, **kwargs)
+
+        return instrumented
+
+    return decorate
+
+
+def gauge(name: str, read: Callable[[], float]) -> None:
+    """Report read() as the value of name"""
+    gauges[name] = read
+
+
+def read_gauges() -> dict:
+    values = {}
+    for name, read in sorted(gauges.items()):
+        try:
+            values[name] = read()
+        except Exception as ex:
+            logger.error("[e]-> Exception in read_gauges() -> " + str(ex))
+            values[name] = math.nan
+    return values
+
+
+def summary() -> str:
+    lines = ["%s: %s" % (name, value) for name, value in read_gauges().items()]
+    lines += [
+        name + ": " + found.summary() for name, found in sorted(histograms.items())
+    ]
+    return "\n".join(lines)
+
+
+def _labels(name: str, **labels) -> str:
+    labels = dict(name=name, **labels)
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+
+
+def prometheus() -> str:
+    """Histograms, call counts and gauges in the Prometheus text format"""
+    latency = ["# TYPE hcia_latency_seconds histogram"]
+    calls = ["# TYPE hcia_calls_total counter"]
+    for name, found in sorted(histograms.items()):
+        counts, count, total, called = found.snapshot()
+        cumulative = 0
+        for bound, bucket in zip(found.buckets + (math.inf,), counts):
+            cumulative += bucket
+            le = "+Inf" if bound == math.inf else "%g" % bound
+            latency.append(
+                "hcia_latency_seconds_bucket%s %d" % (_labels(name, le=le), cumulative)
+            )
+        latency.append("hcia_latency_seconds_sum%s %f" % (_labels(name), total))
+        latency.append("hcia_latency_seconds_count%s %d" % (_labels(name), count))
+        calls.append("hcia_calls_total%s %d" % (_labels(name), called))
+    values = ["# TYPE hcia_value gauge"]
+    for name, value in read_gauges().items():
+        value = float(value)
+        values.append(
+            "hcia_value%s %s" % (_labels(name), "NaN" if math.isnan(value) else value)
+        )
+    return "\n".join(latency + calls + values) + "\n"
@@ -1,6 +1,137 @@
+import re
+
+# A tag is a word, "#ospf" and "OSPF" are the tag "ospf"
+TAG_PATTERN = re.compile(r"#?([\w-]+)")
+HASHTAG_PATTERN = re.compile(r"#([\w-]+)")
+# Hashtags separated by whitespace at the end of a text, e.g. "... #ospf #ipv6"
+TRAILING_HASHTAGS = re.compile(r"(?:^|\s+)(#[\w-]+(?:\s+#[\w-]+)*)\s*$")
+
+
+def parse_tags(tags) -> tuple:
+    """Normalized tags of a text separated by spaces or commas, or of a list
+    of such texts (e.g. the arguments of a command)"""
+    if not tags:
+        return ()
+    if isinstance(tags, str):
+        tags = (tags,)
+    # Lower case, in order, without duplicates
+    return tuple(
+        dict.fromkeys(
+            t.lower() for text in tags if text for t in TAG_PATTERN.findall(text)
+        )
+    )
+
+
+def split_hashtags(text: str) -> tuple:
+    """Text without the #hashtags ending it, None if nothing else is left, and
+    their tags. Hashtags within the text are left as they are"""
+    if not text:
+        return text, ()
+    found = TRAILING_HASHTAGS.search(text)
+    if found is None:
+        return text, ()
+    tags = parse_tags(HASHTAG_PATTERN.findall(found.group(1)))
+    return text[: found.start()].strip() or None, tags
+
+
 class Quiz:
-    _id = ""
-    question = ""
-    options = []
-    response_id = -1
-    imgs = []
+    """Immutable quiz record.
+    Slots and tuples keep a fully cached bank small, and one Quiz is shared by
+    every session drawing it. Build a changed copy with `replace`.
+    """
+
+    # Stored fields of a quiz, besides _id and the chat_id/msg_id of its poll
+    FIELDS = ("question", "options", "response_id", "imgs", "explanation", "tags")
+
+    __slots__ = (
+        "_id",
+        "question",
+        "options",
+        "response_id",
+        "imgs",
+        "explanation",
+        "tags",
+        "chat_id",
+        "msg_id",
+    )
+
+    def __init__(
+        self,
+        question: str,
+        options,
+        response_id: int,
+        imgs=(),
+        explanation: str = None,
+        _id=None,
+        chat_id: int = None,
+        msg_id: int = None,
+        tags=(),
+    ):
+        setattr_ = object.__setattr__
+        setattr_(self, "_id", _id)
+        setattr_(self, "question", question)
+        setattr_(self, "options", tuple(options))
+        # The GitHub issue workflow stores the index as a string
+        setattr_(self, "response_id", int(response_id))
+        setattr_(self, "imgs", tuple(imgs) if imgs else ())
+        setattr_(self, "explanation", explanation)
+        # The GitHub issue workflow stores them as a text
+        setattr_(self, "tags", parse_tags(tags))
+        setattr_(self, "chat_id", chat_id)
+        setattr_(self, "msg_id", msg_id)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Quiz is immutable, use replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError("Quiz is immutable, use replace()")
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Quiz):
+            return NotImplemented
+        return all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return "Quiz(_id=%r, question=%r)" % (self._id, self.question)
+
+    @classmethod
+    def from_bson(cls, doc: dict) -> "Quiz":
+        """Quiz of a document of the quiz collection, unknown fields are ignored"""
+        return cls(
+            doc["question"],
+            doc["options"],
+            doc["response_id"],
+            doc.get("imgs"),
+            doc.get("explanation"),
+            doc.get("_id"),
+            doc.get("chat_id"),
+            doc.get("msg_id"),
+            doc.get("tags"),
+        )
+
+    def to_bson(self) -> dict:
+        """Document of the quiz collection, unset fields are left out"""
+        doc = {
+            "question": self.question,
+            "options": list(self.options),
+            "response_id": self.response_id,
+        }
+        if self._id is not None:
+            doc["_id"] = self._id
+        if self.imgs:
+            doc["imgs"] = list(self.imgs)
+        if self.tags:
+            doc["tags"] = list(self.tags)
+        for field in ("explanation", "chat_id", "msg_id"):
+            value = getattr(self, field)
+            if value is not None:
+                doc[field] = value
+        return doc
+
+    def replace(self, **changes) -> "Quiz":
+        """Copy of this quiz with some fields changed"""
+        fields = {s: getattr(self, s) for s in self.__slots__}
+        fields.update(changes)
+        return Quiz(**fields)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Outbound Bot API scheduler.
+Every call to the Bot API goes through one queue, served by a few worker
+threads, so the bot stays under Telegram's limits instead of collecting
+flood-wait (429) errors:
+- a global token bucket (about 30 calls/s) and one bucket per chat
+  (about 1/s in private chats, 20/min in groups),
+- priority lanes, polls first, then greetings, broadcasts last,
+- RetryAfter is honored by delaying the chat it came from for the requested
+  time, or every lane when the call was not bound to a chat,
+- edits of the same message are merged and stale edits are dropped.
+"""
+
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from concurrent.futures import Future
+from typing import Callable
+
+from telegram.error import RetryAfter, TelegramError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lower is served first
+POLL = 0
+MESSAGE = 1
+EDIT = 2
+GREETING = 3
+BROADCAST = 4
+LANES = {
+    POLL: "poll",
+    MESSAGE: "message",
+    EDIT: "edit",
+    GREETING: "greeting",
+    BROADCAST: "broadcast",
+}
+
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "8"))
+GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", "30"))
+# Calls the bot may make in a row from idle, on top of GLOBAL_RATE in a second
+GLOBAL_BURST = int(os.environ.get("OUTBOX_GLOBAL_BURST", "1"))
+PRIVATE_RATE = float(os.environ.get("OUTBOX_PRIVATE_RATE", "1"))
+GROUP_RATE = float(os.environ.get("OUTBOX_GROUP_RATE", "0.3"))
+# Calls a chat may make in a row before its rate applies
+CHAT_BURST = int(os.environ.get("OUTBOX_CHAT_BURST", "5"))
+# Telegram allows 20 messages a minute in a group, burst included
+GROUP_PER_MINUTE = 20
+GROUP_BURST = max(1, min(CHAT_BURST, int(GROUP_PER_MINUTE - 60 * GROUP_RATE)))
+MAX_RETRIES = int(os.environ.get("OUTBOX_MAX_RETRIES", "3"))
+# Idle per-chat buckets are forgotten past this many chats
+MAX_CHAT_BUCKETS = 10000
+
+
+class TokenBucket:
+    """Classic token bucket, not thread safe (the outbox lock guards it)"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Seconds to wait before a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float) -> None:
+        """No token for the next seconds"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Call:
+    """One pending Bot API call"""
+
+    __slots__ = (
+        "function",
+        "args",
+        "kwargs",
+        "chat_id",
+        "priority",
+        "merge_key",
+        "max_age",
+        "future",
+        "enqueued_at",
+        "retries",
+    )
+
+    def __init__(self, function, args, kwargs, chat_id, priority, merge_key, max_age):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = chat_id
+        self.priority = priority
+        self.merge_key = merge_key
+        self.max_age = max_age
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.retries = 0
+
+
+class Outbox:
+    """Rate limited, prioritized queue of Bot API calls"""
+
+    def __init__(self, workers: int = OUTBOX_WORKERS, global_rate: float = GLOBAL_RATE):
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._sequence = itertools.count()
+        # (priority, sequence, call) ready to go, and (not_before, sequence, call)
+        # waiting for their chat bucket or a RetryAfter
+        self._ready = []
+        self._delayed = []
+        self._merging = {}
+        self._global = TokenBucket(global_rate, GLOBAL_BURST)
+        self._chats = {}
+        self._paused_until = 0.0
+        self._threads = []
+        self.merged = 0
+        self.dropped = 0
+        self.retried = 0
+
+    def __len__(self) -> int:
+        return len(self._ready) + len(self._delayed)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self._workers):
+                thread = threading.Thread(
+                    target=self._work, name="outbox-" + str(number), daemon=True
+                )
+                self._threads.append(thread)
+                thread.start()
+
+    def send(
+        self,
+        function: Callable,
+        *args,
+        chat: int = None,
+        priority: int = MESSAGE,
+        merge_key=None,
+        max_age: float = None,
+        **kwargs
+    ) -> Future:
+        """Queue function(*args, **kwargs), a Bot method, and return its Future.
+
+        chat is the id of the chat the call sends to, for its rate limit. A
+        call with the same merge_key as a pending one replaces it, and a call
+        still pending after max_age seconds is dropped (its result is None).
+        """
+        if not self._threads:
+            self.start()
+        call = Call(function, args, kwargs, chat, priority, merge_key, max_age)
+        call.future.add_done_callback(_log_failure)
+        with self._lock:
+            if merge_key is not None:
+                stale = self._merging.get(merge_key)
+                if stale is not None and not stale.future.done():
+                    # Merged calls share the latest call's fate
+                    stale.function, stale.args, stale.kwargs = function, args, kwargs
+                    self.merged += 1
+                    return stale.future
+                self._merging[merge_key] = call
+            heapq.heappush(self._ready, (priority, next(self._sequence), call))
+            self._wakeup.notify()
+        return call.future
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._chats = {
+                    key: value
+                    for key, value in self._chats.items()
+                    if not value.is_full(now)
+                }
+            # Group and channel ids are negative
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_RATE, CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _next_call(self) -> Call:
+        """Wait for a call allowed to run now and take its tokens"""
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, sequence, call = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (call.priority, sequence, call))
+
+                wait = max(self._paused_until - now, 0.0)
+                if not wait and self._ready:
+                    wait = self._global.delay(now)
+                    if not wait:
+                        _, sequence, call = heapq.heappop(self._ready)
+                        if call.max_age is not None and (
+                            now - call.enqueued_at > call.max_age
+                        ):
+                            if self._merging.get(call.merge_key) is call:
+                                del self._merging[call.merge_key]
+                            self._finish(call, None)
+                            self.dropped += 1
+                            continue
+                        if call.chat_id is not None:
+                            bucket = self._chat_bucket(call.chat_id, now)
+                            delay = bucket.delay(now)
+                            if delay:
+                                heapq.heappush(
+                                    self._delayed, (now + delay, sequence, call)
+                                )
+                                continue
+                            bucket.take(now)
+                        self._global.take(now)
+                        if self._merging.get(call.merge_key) is call:
+                            del self._merging[call.merge_key]
+                        return call
+
+                if self._delayed:
+                    delayed_wait = self._delayed[0][0] - now
+                    wait = min(wait, delayed_wait) if wait else delayed_wait
+                self._wakeup.wait(wait or None)
+
+    def _finish(self, call: Call, result=None, exception: Exception = None) -> None:
+        if exception is not None:
+            call.future.set_exception(exception)
+        else:
+            call.future.set_result(result)
+        metrics.observe(
+            "outbox." + LANES.get(call.priority, "other"),
+            time.monotonic() - call.enqueued_at,
+        )
+
+    def _work(self) -> None:
+        while True:
+            call = self._next_call()
+            try:
+                result = call.function(*call.args, **call.kwargs)
+            except RetryAfter as ex:
+                with self._lock:
+                    self.retried += 1
+                    now = time.monotonic()
+                    not_before = now + ex.retry_after
+                    if call.chat_id is not None:
+                        # Flood control of a chat, the other chats go on
+                        self._chat_bucket(call.chat_id, now).pause(now, ex.retry_after)
+                    else:
+                        self._paused_until = max(self._paused_until, not_before)
+                    if call.retries < MAX_RETRIES:
+                        call.retries += 1
+                        heapq.heappush(
+                            self._delayed, (not_before, next(self._sequence), call)
+                        )
+                        self._wakeup.notify()
+                        continue
+                self._finish(call, exception=ex)
+            except Exception as ex:
+                self._finish(call, exception=ex)
+            else:
+                self._finish(call, result)
+
+    def summary(self) -> str:
+        return "outbox: pending=%d merged=%d dropped=%d retried=%d" % (
+            len(self),
+            self.merged,
+            self.dropped,
+            self.retried,
+        )
+
+
+def _log_failure(future: Future) -> None:
+    exception = future.exception()
+    if exception is not None and not isinstance(exception, RetryAfter):
+        level = (
+            logging.WARNING if isinstance(exception, TelegramError) else logging.ERROR
+        )
+        logger.log(level, "[e]-> Bot API call failed -> " + str(exception))
+
+
+outbox = Outbox()
+
+
+def send(function: Callable, *args, **kwargs) -> Future:
+    """Queue a Bot API call on the shared outbox"""
+    return outbox.send(function, *args, **kwargs)
+
+
+def summary() -> str:
+    return outbox.summary()
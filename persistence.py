@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Crash-safe state with write-behind batching.
+Running Q/A sessions and the chat registry of look.py (`user_ids`, `group_ids`,
+`channel_ids` in bot_data) are written to MongoDB every STATE_FLUSH_SECONDS,
+in one bulk write holding only what changed meanwhile. Handlers never wait for
+the database: recording a change is a set insertion. Everything is loaded back
+at startup.
+With a shared session store (SESSION_BACKEND=mongo) sessions are written by the
+store itself, only the chat registry is left here. It is written as additions
+and removals, so several bot processes merge their registries, and each flush
+reads back the changes of the other processes. The /create gate is kept here
+too, so that a code typed on one process unlocks the others.
+"""
+
+import os
+import logging
+import threading
+from typing import Optional
+
+from pymongo import ReplaceOne, DeleteOne
+
+import metrics
+from bank import QuizBank
+from sessions import Session, SessionStore
+
+logger = logging.getLogger(__name__)
+
+STATE_FLUSH_SECONDS = int(os.environ.get("STATE_FLUSH_SECONDS", "5"))
+REGISTRY_KEYS = ("user_ids", "group_ids", "channel_ids")
+REGISTRY_ID = "chats"
+USER_CODE_ID = "user_code"
+
+
+def registry_snapshot(bot_data: dict) -> dict:
+    """Sorted ids of the chat registry, by key"""
+    # set.copy() is atomic, track_chats may update the sets meanwhile
+    return {key: sorted(bot_data.get(key, set()).copy()) for key in REGISTRY_KEYS}
+
+
+class StateStore:
+    """Write-behind persistence of sessions and chat registry"""
+
+    def __init__(self, sessions_collection, state_collection):
+        self._sessions = sessions_collection
+        self._state = state_collection
+        # Flushes may come from the job queue and from shutdown at once
+        self._lock = threading.Lock()
+        self._registry = None
+
+    def flush(self, sessions: SessionStore, bot_data: dict) -> int:
+        """Write pending changes, return the number of written documents"""
+        with self._lock, metrics.timed("state.flush"):
+            changed, closed = sessions.drain_changes()
+            requests = [
+                ReplaceOne({"_id": session.chat_id}, session.to_doc(), upsert=True)
+                for session in changed
+            ]
+            requests += [DeleteOne({"_id": chat_id}) for chat_id in closed]
+            if requests:
+                try:
+                    self._sessions.bulk_write(requests, ordered=False)
+                except Exception as ex:
+                    logger.error("[e]-> Exception in flush() -> " + str(ex))
+                    # Written again at next flush
+                    sessions.requeue_changes(
+                        [session.chat_id for session in changed], closed
+                    )
+                    requests = []
+
+            written = len(requests)
+            registry = registry_snapshot(bot_data)
+            if registry != self._registry:
+                try:
+                    self._write_registry(registry)
+                    self._registry = registry
+                    written += 1
+                except Exception as ex:
+                    logger.error("[e]-> Exception in flush() -> " + str(ex))
+            if sessions.shared:
+                try:
+                    self._merge_registry(bot_data)
+                except Exception as ex:
+                    logger.error("[e]-> Exception in flush() -> " + str(ex))
+        return written
+
+    def _write_registry(self, registry: dict) -> None:
+        """Apply the registry changes since the last write, other processes
+        may have written theirs meanwhile"""
+        added, removed = {}, {}
+        for key in REGISTRY_KEYS:
+            previous = set(self._registry.get(key, ())) if self._registry else set()
+            current = set(registry[key])
+            if current - previous:
+                added[key] = {"$each": sorted(current - previous)}
+            if previous - current:
+                removed[key] = sorted(previous - current)
+        # A field can't be both added to and pulled from in one update
+        if added:
+            self._state.update_one(
+                {"_id": REGISTRY_ID}, {"$addToSet": added}, upsert=True
+            )
+        if removed:
+            self._state.update_one({"_id": REGISTRY_ID}, {"$pullAll": removed})
+
+    def _merge_registry(self, bot_data: dict) -> None:
+        """Apply the registry changes written by the other processes"""
+        doc = self._state.find_one({"_id": REGISTRY_ID}) or {}
+        persisted = {}
+        for key in REGISTRY_KEYS:
+            remote = set(doc.get(key, ()))
+            known = set(self._registry.get(key, ())) if self._registry else set()
+            chats = bot_data.setdefault(key, set())
+            chats.update(remote - known)
+            chats.difference_update(known - remote)
+            persisted[key] = sorted(remote)
+        # Local changes not written yet still differ from it, the next flush
+        # writes them
+        self._registry = persisted
+
+    def user_code(self) -> Optional[str]:
+        """Shared state of the /create gate: None until a code is asked, ""
+        while it is, "ok" once given"""
+        doc = self._state.find_one({"_id": USER_CODE_ID})
+        return None if doc is None else doc.get("value")
+
+    def set_user_code(self, value: str) -> None:
+        if value:
+            self._state.update_one(
+                {"_id": USER_CODE_ID}, {"$set": {"value": value}}, upsert=True
+            )
+        else:
+            # Asking again must not lock a gate another process opened
+            self._state.update_one(
+                {"_id": USER_CODE_ID}, {"$setOnInsert": {"value": value}}, upsert=True
+            )
+
+    def restore(self, sessions: SessionStore, bot_data: dict, bank: QuizBank) -> int:
+        """Load persisted state back, return the number of restored sessions"""
+        with metrics.timed("state.restore"):
+            registry = self._state.find_one({"_id": REGISTRY_ID}) or {}
+            for key in REGISTRY_KEYS:
+                bot_data.setdefault(key, set()).update(registry.get(key, ()))
+            self._registry = registry_snapshot(bot_data)
+
+            restored = 0
+            if sessions.shared:
+                # Shared sessions are read from the database on demand
+                logger.info("[i]-> State restored : shared sessions")
+                return restored
+            for doc in self._sessions.find({}):
+                questions = [bank.get(quiz_id) for quiz_id in doc["questions"]]
+                if None in questions:
+                    # Question removed from the bank meanwhile, session is lost
+                    continue
+                if sessions.restore(Session.from_doc(doc, questions)):
+                    restored += 1
+        logger.info("[i]-> State restored : %d session(s)", restored)
+        return restored
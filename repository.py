@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Quiz repository.
+Every read and write of the `hcia.quiz` collection goes through QuizRepository:
+indexes are created at startup, each read only fetches the fields its caller
+needs, and each call is timed under `mongo.<operation>` in the metrics.
+"""
+
+import logging
+from typing import Iterable, Iterator, List, Optional
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import metrics
+from models.quiz import Quiz
+
+logger = logging.getLogger(__name__)
+
+# Fields needed to send a question, kept by the quiz bank
+BANK_PROJECTION = {
+    "question": 1,
+    "options": 1,
+    "response_id": 1,
+    "imgs": 1,
+    "explanation": 1,
+    "tags": 1,
+}
+# Fields needed to edit a quiz from a reply to its poll
+EDIT_PROJECTION = {"chat_id": 1, "msg_id": 1}
+BANK_BATCH_SIZE = 1000
+
+
+def from_bson(doc: dict) -> Optional[Quiz]:
+    """Quiz of a document, None if it is malformed"""
+    try:
+        return Quiz.from_bson(doc)
+    except (KeyError, TypeError, ValueError) as ex:
+        logger.error(
+            "[e]-> Exception in from_bson() -> [ _id = "
+            + str(doc.get("_id"))
+            + " ] -> "
+            + repr(ex)
+        )
+        return None
+
+
+class QuizRepository:
+    """Data access layer of the quiz collection"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def ensure_indexes(self) -> None:
+        """Create the indexes the bot relies on, existing ones are left as is"""
+        try:
+            # Quiz created from Telegram are found back by the poll message.
+            # Quiz imported from GitHub issues have no message and are not indexed
+            self._collection.create_index(
+                [("chat_id", ASCENDING), ("msg_id", ASCENDING)],
+                name="chat_msg",
+                unique=True,
+                partialFilterExpression={"msg_id": {"$exists": True}},
+            )
+        except PyMongoError as ex:
+            logger.error("[e]-> Exception in ensure_indexes() -> " + str(ex))
+
+    def iter_bank(self) -> Iterator[Quiz]:
+        """Stream every quiz with the fields kept by the quiz bank, malformed
+        documents are skipped"""
+        cursor = self._collection.find({}, BANK_PROJECTION, batch_size=BANK_BATCH_SIZE)
+        for doc in cursor:
+            quiz = from_bson(doc)
+            if quiz is not None:
+                yield quiz
+
+    def sample(self, size: int) -> List[Quiz]:
+        """Up to size distinct random quiz, in one aggregation"""
+        with metrics.timed("mongo.sample"):
+            # $sample may return the same document twice, keep distinct ones
+            questions = {}
+            for doc in self._collection.aggregate(
+                [{"$sample": {"size": size}}, {"$project": BANK_PROJECTION}]
+            ):
+                if doc["_id"] not in questions:
+                    quiz = from_bson(doc)
+                    if quiz is not None:
+                        questions[doc["_id"]] = quiz
+        return list(questions.values())
+
+    def find_by_message(
+        self, chat_id: int, msg_id: int, projection: dict = EDIT_PROJECTION
+    ) -> Optional[dict]:
+        with metrics.timed("mongo.find_by_message"):
+            return self._collection.find_one(
+                {"chat_id": chat_id, "msg_id": msg_id}, projection
+            )
+
+    def insert(self, quiz: Quiz) -> Quiz:
+        """Insert quiz and return it with its new _id"""
+        with metrics.timed("mongo.insert"):
+            result = self._collection.insert_one(quiz.to_bson())
+        return quiz.replace(_id=result.inserted_id)
+
+    def replace(self, quiz: Quiz) -> None:
+        with metrics.timed("mongo.replace"):
+            self._collection.replace_one({"_id": quiz._id}, quiz.to_bson())
+
+    def set_imgs(self, quiz_id, imgs: list) -> Optional[Quiz]:
+        """Set the illustrations of a quiz and return it as kept by the bank"""
+        with metrics.timed("mongo.set_imgs"):
+            doc = self._collection.find_one_and_update(
+                {"_id": quiz_id},
+                {"$set": {"imgs": imgs}},
+                projection=BANK_PROJECTION,
+                return_document=ReturnDocument.AFTER,
+            )
+        return None if doc is None else Quiz.from_bson(doc)
+
+    def insert_many(self, quizzes: Iterable[Quiz]) -> int:
+        """Insert a batch of quiz, a failing one doesn't stop the others"""
+        with metrics.timed("mongo.insert_many"):
+            try:
+                result = self._collection.insert_many(
+                    [quiz.to_bson() for quiz in quizzes], ordered=False
+                )
+            except BulkWriteError as ex:
+                logger.error("[e]-> Exception in insert_many() -> " + str(ex))
+                return ex.details["nInserted"]
+        return len(result.inserted_ids)
+
+    def bulk_write(self, requests: list):
+        with metrics.timed("mongo.bulk_write"):
+            return self._collection.bulk_write(requests, ordered=False)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Session results and score aggregates.
+Each completed session is appended to `hcia.results`, one document per player
+(the chat user, or every member who scored in a group). Aggregates of each
+user are kept up to date with every answer and every session instead of being
+computed from the history: sessions, marks, answers, correct answers, current
+and best streaks of correct answers, best marks.
+Results and aggregate changes are written every STATS_FLUSH_SECONDS, counters
+as `$inc` so bot processes sharing the database merge theirs. /me reads the
+aggregates of its user by _id, plus the changes of this process not written
+yet.
+"""
+
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
+from pymongo.errors import PyMongoError
+
+import metrics
+from sessions import Session
+
+logger = logging.getLogger(__name__)
+
+# Aggregates of a user added up with each answer and session
+COUNTERS = ("sessions", "marks", "questions", "answers", "correct")
+
+
+class ResultStore:
+    """Result history and per-user aggregates, written behind"""
+
+    def __init__(self, results_collection=None, scores_collection=None):
+        self._results = results_collection
+        self._scores = scores_collection
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # user id -> COUNTERS, plus "streak", "best_streak", "best_marks"
+        self._users = {}
+        # Changes since the last flush: result documents, and
+        # user id -> COUNTERS to add
+        self._pending_results = []
+        self._changed = {}
+        # Counters being written by a flush
+        self._flushing = {}
+        # Counters counted before restore() would be flushed, then restored
+        self._restored = False
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def ensure_indexes(self) -> None:
+        try:
+            self._results.create_index(
+                [("user_id", ASCENDING), ("finished_at", DESCENDING)], name="user"
+            )
+        except PyMongoError as ex:
+            logger.error("[e]-> Exception in ensure_indexes() -> " + str(ex))
+
+    def _user(self, user_id: int) -> dict:
+        found = self._users.get(user_id)
+        if found is None:
+            found = self._users[user_id] = dict.fromkeys(
+                COUNTERS + ("streak", "best_streak", "best_marks"), 0
+            )
+        return found
+
+    def _add(self, user_id: int, **counts) -> dict:
+        user = self._user(user_id)
+        changed = self._changed.setdefault(user_id, dict.fromkeys(COUNTERS, 0))
+        for counter, count in counts.items():
+            user[counter] += count
+            changed[counter] += count
+        return user
+
+    def answer(self, user_id: int, correct: bool) -> None:
+        """Count one answer of user"""
+        with self._lock:
+            user = self._add(user_id, answers=1, correct=1 if correct else 0)
+            user["streak"] = user["streak"] + 1 if correct else 0
+            user["best_streak"] = max(user["best_streak"], user["streak"])
+
+    def finish(self, session: Session) -> None:
+        """Record the results of a completed session"""
+        if session.group:
+            marks = {int(uid): score["marks"] for uid, score in session.scores.items()}
+        else:
+            marks = {session.chat_id: session.marks}
+        finished_at = datetime.utcnow()
+        questions = len(session.questions)
+        with self._lock:
+            for user_id, mark in marks.items():
+                user = self._add(user_id, sessions=1, marks=mark, questions=questions)
+                user["best_marks"] = max(user["best_marks"], mark)
+                self._pending_results.append(
+                    {
+                        "user_id": user_id,
+                        "chat_id": session.chat_id,
+                        "group": session.group,
+                        "marks": mark,
+                        "questions": questions,
+                        "finished_at": finished_at,
+                    }
+                )
+
+    def user(self, user_id: int) -> Optional[dict]:
+        """Aggregates of user, None before their first answer"""
+        if self._scores is None or not self._restored:
+            found = self._users.get(user_id)
+            return None if found is None else dict(found)
+        try:
+            with metrics.timed("mongo.find_score"):
+                doc = self._scores.find_one({"_id": user_id})
+        except Exception as ex:
+            logger.error("[e]-> Exception in user() -> " + str(ex))
+            doc = None
+        with self._lock:
+            local = self._users.get(user_id)
+            pending = [
+                changes[user_id]
+                for changes in (self._changed, self._flushing)
+                if user_id in changes
+            ]
+            if doc is None:
+                return None if local is None else dict(local)
+            found = {counter: doc.get(counter, 0) for counter in COUNTERS}
+            for changes in pending:
+                for counter, count in changes.items():
+                    found[counter] += count
+            local = local or {}
+            # This process' streak is the latest if it has answers to write
+            found["streak"] = local["streak"] if pending else doc.get("streak", 0)
+            for best in ("best_streak", "best_marks"):
+                found[best] = max(doc.get(best, 0), local.get(best, 0))
+        return found
+
+    def flush(self) -> int:
+        """Write the results and aggregates changed since the last flush,
+        return the number of written documents"""
+        if self._results is None or not self._restored:
+            return 0
+        with self._flush_lock, metrics.timed("results.flush"):
+            with self._lock:
+                results, self._pending_results = self._pending_results, []
+                changed, self._changed = self._changed, {}
+                self._flushing = changed
+                scores = [
+                    UpdateOne(
+                        {"_id": user_id},
+                        {
+                            "$inc": counts,
+                            "$set": {"streak": self._users[user_id]["streak"]},
+                            "$max": {
+                                "best_streak": self._users[user_id]["best_streak"],
+                                "best_marks": self._users[user_id]["best_marks"],
+                            },
+                        },
+                        upsert=True,
+                    )
+                    for user_id, counts in changed.items()
+                ]
+
+            written = 0
+            if results:
+                try:
+                    self._results.bulk_write(
+                        [InsertOne(result) for result in results], ordered=False
+                    )
+                    written += len(results)
+                except Exception as ex:
+                    logger.error("[e]-> Exception in flush() -> " + str(ex))
+                    # Written again at next flush
+                    with self._lock:
+                        self._pending_results[:0] = results
+            if scores:
+                try:
+                    self._scores.bulk_write(scores, ordered=False)
+                    written += len(scores)
+                except Exception as ex:
+                    logger.error("[e]-> Exception in flush() -> " + str(ex))
+                    with self._lock:
+                        self._flushing = {}
+                        for user_id, counts in changed.items():
+                            pending = self._changed.setdefault(
+                                user_id, dict.fromkeys(COUNTERS, 0)
+                            )
+                            for counter, count in counts.items():
+                                pending[counter] += count
+            with self._lock:
+                self._flushing = {}
+        return written
+
+    def restore(self) -> int:
+        """Load persisted aggregates back, return the number of users"""
+        if self._scores is None:
+            return 0
+        with metrics.timed("results.restore"):
+            users = {}
+            for doc in self._scores.find({}):
+                users[doc.pop("_id")] = doc
+            with self._lock:
+                for user_id, doc in users.items():
+                    user = self._user(user_id)
+                    for counter in COUNTERS:
+                        user[counter] += doc.get(counter, 0)
+                    for best in ("best_streak", "best_marks"):
+                        user[best] = max(user[best], doc.get(best, 0))
+                    if user_id not in self._changed:
+                        user["streak"] = doc.get("streak", 0)
+        self._restored = True
+        logger.info("[i]-> Results restored : %d user(s)", len(users))
+        return len(users)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Adaptive question selection.
+Every answer updates the stats of its question (attempts, correct answers) and
+those of its user on that question (attempts, correct answers, correct answers
+in a row, last seen). Private sessions draw their questions by weighted
+sampling:
+- an unseen question weighs its difficulty, from 0.5 to 1.5 with the error
+  rate of every user on it,
+- a question the user got wrong comes back after RETRY_SECONDS, WRONG_BOOST
+  times heavier,
+- a question the user got right comes back after REVIEW_SECONDS, doubled by
+  each correct answer in a row (spaced repetition),
+- until then it weighs almost nothing.
+Weights are integers in a Fenwick tree over the bank snapshot, so a pick is a
+O(log n) descent. The tree of difficulties is shared by every user, a user only
+owns a sparse tree of differences over the questions they have seen, and a
+question coming due is only reweighted at the next draw of its user.
+A draw among the questions of some tags goes down a tree of their shared
+weights instead, built once per snapshot, with the differences of the user
+over them moved to a throwaway overlay.
+Difficulties are refreshed with the bank snapshot. Stats are kept in memory and
+the changes are written every STATS_FLUSH_SECONDS, when the ranking of the
+hardest questions is computed again. Counts are written as increments and the
+last seen time as a maximum, so bot processes sharing the database merge their
+answers, only the correct answers in a row are last writer wins.
+"""
+
+import os
+import time
+import heapq
+import random
+import logging
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from pymongo import UpdateOne
+
+import metrics
+from bank import QuizBank, TAGGED_CACHE_SIZE
+from models.quiz import Quiz
+
+logger = logging.getLogger(__name__)
+
+STATS_FLUSH_SECONDS = int(os.environ.get("STATS_FLUSH_SECONDS", "60"))
+RETRY_SECONDS = int(os.environ.get("RETRY_SECONDS", "3600"))
+REVIEW_SECONDS = int(os.environ.get("REVIEW_SECONDS", "86400"))
+# Review intervals stop doubling after that many correct answers in a row
+MAX_STREAK = 8
+WRONG_BOOST = 3
+# Weight of an unseen question of average difficulty
+WEIGHT_UNIT = 1000
+# Questions not due yet weigh their due weight divided by COOLDOWN
+COOLDOWN = 50
+# Questions ranked by /hardest, answered at least HARDEST_MIN_ATTEMPTS times
+HARDEST_SIZE = 10
+HARDEST_MIN_ATTEMPTS = int(os.environ.get("HARDEST_MIN_ATTEMPTS", "5"))
+
+
+def difficulty(attempts: int, correct: int) -> int:
+    """Weight of an unseen question, from the answers of every user to it"""
+    # (errors + 1) / (attempts + 2) is 0.5 for a question never answered
+    return WEIGHT_UNIT // 2 + WEIGHT_UNIT * (attempts - correct + 1) // (attempts + 2)
+
+
+def due_at(entry: tuple) -> int:
+    """Time a question seen by a user should be asked again"""
+    _, _, streak, last_seen = entry
+    if not streak:
+        return last_seen + RETRY_SECONDS
+    return last_seen + REVIEW_SECONDS * 2 ** (min(streak, MAX_STREAK) - 1)
+
+
+ENTRY_FIELDS = ("attempts", "correct", "streak", "last_seen")
+
+
+def entry_doc(entry) -> dict:
+    """Stored form of the entry of a user on a question"""
+    return dict(zip(ENTRY_FIELDS, entry))
+
+
+def entry_tuple(entry) -> tuple:
+    """Entry of a user on a question from its stored form, older ones are lists"""
+    if isinstance(entry, dict):
+        return tuple(entry.get(field, 0) for field in ENTRY_FIELDS)
+    return tuple(entry)
+
+
+def entry_update(entries: dict, added: dict) -> dict:
+    """Update adding the answers of a user to their stored entries"""
+    update = {"$inc": {}, "$max": {}, "$set": {}}
+    for quiz_id, (attempts, correct) in added.items():
+        path = "entries." + str(quiz_id) + "."
+        update["$inc"][path + "attempts"] = attempts
+        update["$inc"][path + "correct"] = correct
+        update["$max"][path + "last_seen"] = entries[quiz_id][3]
+        update["$set"][path + "streak"] = entries[quiz_id][2]
+    return update
+
+
+class WeightTree:
+    """Fenwick tree of integer weights over positions 0 to size - 1.
+    Methods taking an overlay read and write a sparse tree of differences
+    instead, as a dict of nodes"""
+
+    def __init__(self, weights: List[int]):
+        # A power of two, so the root node holds the total
+        self.size = 1
+        while self.size < len(weights):
+            self.size *= 2
+        tree = [0] * (self.size + 1)
+        for node in range(1, self.size + 1):
+            if node <= len(weights):
+                tree[node] += weights[node - 1]
+            parent = node + (node & -node)
+            if parent <= self.size:
+                tree[parent] += tree[node]
+        self.tree = tree
+
+    def total(self, overlay: dict) -> int:
+        return self.tree[self.size] + overlay.get(self.size, 0)
+
+    def add(self, position: int, delta: int, overlay: dict) -> None:
+        node = position + 1
+        while node <= self.size:
+            value = overlay.get(node, 0) + delta
+            if value:
+                overlay[node] = value
+            else:
+                del overlay[node]
+            node += node & -node
+
+    def find(self, target: int, overlay: dict) -> int:
+        """Position of the weight holding target, for 0 <= target < total"""
+        position = 0
+        step = self.size
+        while step:
+            node = position + step
+            weight = self.tree[node] + overlay.get(node, 0)
+            if target >= weight:
+                target -= weight
+                position = node
+            step //= 2
+        return position
+
+
+class UserStats:
+    """Answers of one user and their sampling weights"""
+
+    __slots__ = ("entries", "overlay", "deltas", "due", "version")
+
+    def __init__(self):
+        # quiz _id -> (attempts, correct, correct in a row, last seen)
+        self.entries = {}
+        # Differences with the shared weights: sparse tree, and by position
+        self.overlay = {}
+        self.deltas = {}
+        # Heap of (due_at, quiz _id) of the questions cooling down
+        self.due = []
+        # Bank snapshot the weights were computed for
+        self.version = None
+
+
+class TaggedWeights:
+    """Shared weights of the quiz having some tags, in a tree of their own"""
+
+    __slots__ = ("records", "base", "index", "tree")
+
+    def __init__(self, records: List[Quiz], base: List[int], index: Dict[int, int]):
+        self.records = records
+        self.base = base
+        # Position in the bank snapshot -> position in records
+        self.index = index
+        self.tree = WeightTree(base)
+
+
+class AdaptiveSelector:
+    """Question stats and weighted draws over a QuizBank"""
+
+    def __init__(self, bank: QuizBank, users_collection=None, quiz_collection=None):
+        self._bank = bank
+        self._users_collection = users_collection
+        self._quiz_collection = quiz_collection
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._users: Dict[int, UserStats] = {}
+        # quiz _id -> [attempts, correct] of every user
+        self._quiz = {}
+        # Changes since the last flush: user id -> quiz _id -> [attempts,
+        # correct] to add, and quiz _id -> [attempts, correct] to add
+        self._changed_users = {}
+        self._changed_quiz = {}
+        # Flushing before restore() would $inc counts it then adds again
+        self._restored = False
+        # Shared weights of the bank snapshot
+        self._version = None
+        self._records = []
+        self._positions = {}
+        self._base = []
+        self._tree = WeightTree([])
+        # frozenset of tags -> TaggedWeights of the quiz having them all
+        self._tagged_weights = {}
+        # (quiz, attempts, correct) of the hardest questions, at the last flush
+        self._hardest = []
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def _sync(self) -> None:
+        """Rebuild the shared weights when the bank changed"""
+        if self._bank.version == self._version:
+            return
+        version, records = self._bank.snapshot()
+        self._records = records
+        self._positions = {quiz._id: position for position, quiz in enumerate(records)}
+        self._base = [difficulty(*self._quiz.get(quiz._id, (0, 0))) for quiz in records]
+        self._tree = WeightTree(self._base)
+        self._tagged_weights = {}
+        self._version = version
+
+    def _reweigh(self, user: UserStats, quiz_id, now: int) -> None:
+        """Set the weight of a question seen by user from its entry"""
+        position = self._positions.get(quiz_id)
+        if position is None:
+            return
+        entry = user.entries[quiz_id]
+        base = self._base[position]
+        weight = base if entry[2] else base * WRONG_BOOST
+        due = due_at(entry)
+        if due > now:
+            weight = max(1, weight // COOLDOWN)
+            heapq.heappush(user.due, (due, quiz_id))
+        delta = weight - base
+        change = delta - user.deltas.get(position, 0)
+        if change:
+            self._tree.add(position, change, user.overlay)
+        if delta:
+            user.deltas[position] = delta
+        else:
+            user.deltas.pop(position, None)
+
+    def _prepare(self, user: UserStats, now: int) -> None:
+        """Bring the weights of user up to date before a draw"""
+        if user.version != self._version:
+            user.overlay.clear()
+            user.deltas.clear()
+            user.due = []
+            user.version = self._version
+            for quiz_id in user.entries:
+                self._reweigh(user, quiz_id, now)
+            return
+        while user.due and user.due[0][0] <= now:
+            due, quiz_id = heapq.heappop(user.due)
+            # Answered again since, its current due time is in the heap too
+            if due_at(user.entries[quiz_id]) == due:
+                self._reweigh(user, quiz_id, now)
+
+    def _tagged(self, tags: Iterable[str]) -> TaggedWeights:
+        """Shared weights of the quiz having every tag of tags"""
+        key = frozenset(tags)
+        found = self._tagged_weights.get(key)
+        if found is None:
+            positions = sorted(
+                self._positions[i]
+                for i in self._bank.tagged(key)
+                if i in self._positions
+            )
+            found = TaggedWeights(
+                [self._records[p] for p in positions],
+                [self._base[p] for p in positions],
+                {p: i for i, p in enumerate(positions)},
+            )
+            if len(self._tagged_weights) >= TAGGED_CACHE_SIZE:
+                self._tagged_weights.clear()
+            self._tagged_weights[key] = found
+        return found
+
+    def draw(self, user_id: int, size: int, tags: Iterable[str] = ()) -> List[Quiz]:
+        """Pick up to size distinct quiz for user, heaviest first on average,
+        having every tag of tags if any"""
+        with metrics.timed("selection.draw"), self._lock:
+            self._sync()
+            user = self._users.get(user_id)
+            if user is None:
+                deltas, overlay = {}, {}
+            else:
+                self._prepare(user, int(time.time()))
+                deltas, overlay = user.deltas, user.overlay
+            records, base, tree = self._records, self._base, self._tree
+            restore = user is not None
+
+            if tags:
+                tagged = self._tagged(tags)
+                records, base, tree = tagged.records, tagged.base, tagged.tree
+                # Differences of user over the tagged quiz, on a throwaway overlay
+                index = tagged.index
+                deltas = {index[p]: d for p, d in deltas.items() if p in index}
+                overlay = {}
+                for position, delta in deltas.items():
+                    tree.add(position, delta, overlay)
+                restore = False
+
+            # Picked positions weigh nothing until the draw is over
+            picked = []
+            for _ in range(min(size, len(records))):
+                total = tree.total(overlay)
+                if total <= 0:
+                    break
+                position = tree.find(random.randrange(total), overlay)
+                weight = base[position] + deltas.get(position, 0)
+                tree.add(position, -weight, overlay)
+                picked.append((position, weight))
+            if restore:
+                for position, weight in picked:
+                    tree.add(position, weight, overlay)
+            return [records[position] for position, _ in picked]
+
+    def record(self, user_id: int, quiz_id, correct: bool) -> None:
+        """Count one answer of user to a question"""
+        now = int(time.time())
+        with self._lock:
+            for stats in (
+                self._quiz.setdefault(quiz_id, [0, 0]),
+                self._changed_quiz.setdefault(quiz_id, [0, 0]),
+            ):
+                stats[0] += 1
+                stats[1] += 1 if correct else 0
+
+            user = self._users.get(user_id)
+            if user is None:
+                user = self._users[user_id] = UserStats()
+            attempts, hits, streak, _ = user.entries.get(quiz_id, (0, 0, 0, 0))
+            if correct:
+                user.entries[quiz_id] = (attempts + 1, hits + 1, streak + 1, now)
+            else:
+                user.entries[quiz_id] = (attempts + 1, hits, 0, now)
+            added = self._changed_users.setdefault(user_id, {}).setdefault(
+                quiz_id, [0, 0]
+            )
+            added[0] += 1
+            added[1] += 1 if correct else 0
+            # Otherwise every weight of user is computed at its next draw
+            if user.version == self._version:
+                self._reweigh(user, quiz_id, now)
+
+    def hardest(self) -> List[Tuple[Quiz, int, int]]:
+        """(quiz, attempts, correct) of the questions with the lowest success
+        rate, as ranked at the last flush"""
+        return self._hardest
+
+    def _rank_hardest(self) -> None:
+        with self._lock:
+            answered = [
+                (quiz_id, attempts, correct)
+                for quiz_id, (attempts, correct) in self._quiz.items()
+                if attempts >= HARDEST_MIN_ATTEMPTS
+            ]
+        ranked = []
+        for quiz_id, attempts, correct in sorted(
+            answered, key=lambda stats: (stats[2] / stats[1], -stats[1])
+        ):
+            quiz = self._bank.get(quiz_id)
+            if quiz is not None:
+                ranked.append((quiz, attempts, correct))
+                if len(ranked) == HARDEST_SIZE:
+                    break
+        self._hardest = ranked
+
+    def flush(self) -> int:
+        """Write the stats changed since the last flush, return the number of
+        written documents"""
+        self._rank_hardest()
+        if self._users_collection is None or not self._restored:
+            return 0
+        with self._flush_lock, metrics.timed("selection.flush"):
+            with self._lock:
+                changed_users, self._changed_users = self._changed_users, {}
+                changed_quiz, self._changed_quiz = self._changed_quiz, {}
+                users = [
+                    UpdateOne(
+                        {"_id": user_id},
+                        entry_update(self._users[user_id].entries, added),
+                        upsert=True,
+                    )
+                    for user_id, added in changed_users.items()
+                ]
+            # Counts are added, so bot processes sharing the database merge theirs
+            quiz = [
+                UpdateOne(
+                    {"_id": quiz_id},
+                    {"$inc": {"attempts": attempts, "correct": correct}},
+                    upsert=True,
+                )
+                for quiz_id, (attempts, correct) in changed_quiz.items()
+            ]
+
+            written = 0
+            if users:
+                try:
+                    self._users_collection.bulk_write(users, ordered=False)
+                    written += len(users)
+                except Exception as ex:
+                    logger.error("[e]-> Exception in flush() -> " + str(ex))
+                    # Written again at next flush
+                    with self._lock:
+                        for user_id, added in changed_users.items():
+                            pending = self._changed_users.setdefault(user_id, {})
+                            for quiz_id, (attempts, correct) in added.items():
+                                stats = pending.setdefault(quiz_id, [0, 0])
+                                stats[0] += attempts
+                                stats[1] += correct
+            if quiz:
+                try:
+                    self._quiz_collection.bulk_write(quiz, ordered=False)
+                    written += len(quiz)
+                except Exception as ex:
+                    logger.error("[e]-> Exception in flush() -> " + str(ex))
+                    with self._lock:
+                        for quiz_id, (attempts, correct) in changed_quiz.items():
+                            stats = self._changed_quiz.setdefault(quiz_id, [0, 0])
+                            stats[0] += attempts
+                            stats[1] += correct
+        return written
+
+    def restore(self) -> int:
+        """Load persisted stats back, return the number of users"""
+        if self._users_collection is None:
+            return 0
+        with metrics.timed("selection.restore"):
+            # Entries are stored by str(_id), questions left the bank are dropped
+            _, records = self._bank.snapshot()
+            ids = {str(quiz._id): quiz._id for quiz in records}
+            quiz = {
+                doc["_id"]: [doc.get("attempts", 0), doc.get("correct", 0)]
+                for doc in self._quiz_collection.find({})
+            }
+            users = {}
+            # Entries stored as lists cannot take $inc, they are rewritten
+            converted = []
+            for doc in self._users_collection.find({}):
+                user = UserStats()
+                for key, entry in doc.get("entries", {}).items():
+                    if isinstance(entry, list):
+                        converted.append(
+                            # Unless another process did it in between
+                            UpdateOne(
+                                {"_id": doc["_id"], "entries." + key: entry},
+                                {"$set": {"entries." + key: entry_doc(entry)}},
+                            )
+                        )
+                    if key in ids:
+                        user.entries[ids[key]] = entry_tuple(entry)
+                users[doc["_id"]] = user
+            if converted:
+                self._users_collection.bulk_write(converted, ordered=False)
+
+            with self._lock:
+                for quiz_id, (attempts, correct) in quiz.items():
+                    stats = self._quiz.setdefault(quiz_id, [0, 0])
+                    stats[0] += attempts
+                    stats[1] += correct
+                for user_id, user in users.items():
+                    if user_id in self._users:
+                        # Answers counted before the restore are added to it
+                        for quiz_id, entry in self._users[user_id].entries.items():
+                            attempts, hits, _, seen = user.entries.get(
+                                quiz_id, (0, 0, 0, 0)
+                            )
+                            user.entries[quiz_id] = (
+                                attempts + entry[0],
+                                hits + entry[1],
+                                entry[2],
+                                max(seen, entry[3]),
+                            )
+                    self._users[user_id] = user
+                # Difficulties are computed again with the restored stats
+                self._version = None
+        self._restored = True
+        self._rank_hardest()
+        logger.info("[i]-> Selection stats restored : %d user(s)", len(users))
+        return len(users)
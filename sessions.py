@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# pylint: disable=C0116,W0613
+
+"""
+Per-chat Q/A session store.
+Each chat owns at most one running session, reachable either by chat id or by
+the id of the poll currently open in that session. Sessions nobody touched for
+SESSION_TTL_SECONDS are evicted by `evict_expired`.
+SessionStore keeps sessions in process memory. With SESSION_BACKEND=mongo,
+MongoSessionStore keeps them in MongoDB instead, so several bot processes can
+serve the same sessions: the open poll is claimed atomically and the cursor
+moves by compare-and-set on nb_question, along with the marks.
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import List, Optional, Set, Tuple
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import PyMongoError
+
+import metrics
+from models.quiz import Quiz
+
+logger = logging.getLogger(__name__)
+
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "1800"))
+SESSION_SWEEP_SECONDS = int(os.environ.get("SESSION_SWEEP_SECONDS", "60"))
+# memory (one bot process) or mongo (sessions shared by every bot process)
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+
+
+class Session:
+    """State of one running Q/A session"""
+
+    __slots__ = (
+        "chat_id",
+        "message_id",
+        "poll_id",
+        "nb_question",
+        "marks",
+        "questions",
+        "correct_options",
+        "poll_questions",
+        "group",
+        "scores",
+        "last_seen",
+    )
+
+    def __init__(self, chat_id: int, group: bool = False):
+        self.chat_id = chat_id
+        self.message_id = None
+        self.poll_id = None
+        self.nb_question = 0
+        self.marks = 0
+        # Whole question set, drawn at session start. nb_question is the cursor
+        self.questions = []
+        # poll_id -> correct option of each poll sent in the session
+        self.correct_options = {}
+        # poll_id -> index in questions of the question of each poll, the
+        # cursor may have moved on when an answer is handled
+        self.poll_questions = {}
+        # Group sessions score every member answering: str(user id) ->
+        # {"name", "marks", "poll_id" of the last answer counted}
+        self.group = group
+        self.scores = {}
+        self.last_seen = time.monotonic()
+
+    def to_doc(self) -> dict:
+        """Persisted form, questions are stored by _id"""
+        return {
+            "_id": self.chat_id,
+            "message_id": self.message_id,
+            "poll_id": self.poll_id,
+            "nb_question": self.nb_question,
+            "marks": self.marks,
+            "questions": [quiz._id for quiz in self.questions],
+            "correct_options": self.correct_options,
+            "poll_questions": self.poll_questions,
+            "group": self.group,
+            "scores": self.scores,
+        }
+
+    @classmethod
+    def from_doc(cls, doc: dict, questions: list) -> "Session":
+        session = cls(doc["_id"], doc.get("group", False))
+        session.message_id = doc["message_id"]
+        session.poll_id = doc["poll_id"]
+        session.nb_question = doc["nb_question"]
+        session.marks = doc["marks"]
+        session.questions = questions
+        session.correct_options = doc.get("correct_options", {})
+        session.poll_questions = doc.get("poll_questions", {})
+        session.scores = doc.get("scores", {})
+        return session
+
+    def is_correct(self, poll_id: str, option_ids: list) -> bool:
+        """Whether option_ids, the options a user chose, answer poll_id right"""
+        correct = self.correct_options.get(poll_id)
+        return correct is not None and list(option_ids) == [correct]
+
+    def question(self, poll_id: str) -> Optional[Quiz]:
+        """Quiz asked by poll_id, None if unknown"""
+        index = self.poll_questions.get(poll_id)
+        return None if index is None else self.questions[index]
+
+
+class SessionStore:
+    """Sessions indexed by chat id and by open poll id"""
+
+    # Sessions only live in this process, they are persisted by StateStore
+    shared = False
+
+    def __init__(self, ttl: int = SESSION_TTL_SECONDS):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._by_chat = {}
+        self._by_poll = {}
+        # Chats whose session changed or closed since the last drain_changes
+        self._changed = set()
+        self._closed = set()
+
+    def __len__(self) -> int:
+        return len(self._by_chat)
+
+    def open(self, chat_id: int, group: bool = False) -> Session:
+        """Start a new session for chat_id, dropping the previous one"""
+        session = Session(chat_id, group)
+        with self._lock:
+            previous = self._by_chat.get(chat_id)
+            if previous is not None:
+                self._by_poll.pop(previous.poll_id, None)
+            self._by_chat[chat_id] = session
+            self._changed.add(chat_id)
+        return session
+
+    def get(self, chat_id: int) -> Optional[Session]:
+        session = self._by_chat.get(chat_id)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        return session
+
+    def by_poll(self, poll_id: str) -> Optional[Session]:
+        session = self._by_poll.get(poll_id)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        return session
+
+    def claim_poll(self, poll_id: str) -> Optional[Session]:
+        """Unbind poll_id and return its session, only the first claim gets it"""
+        with self._lock:
+            session = self._by_poll.pop(poll_id, None)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        return session
+
+    def bind_poll(
+        self, session: Session, poll_id: str, message_id: int, correct_option: int
+    ) -> bool:
+        """Make poll_id the open poll of session, answers to older polls are ignored.
+        False if session is not the running session of its chat anymore"""
+        with self._lock:
+            self._by_poll.pop(session.poll_id, None)
+            session.poll_id = poll_id
+            session.message_id = message_id
+            session.correct_options[poll_id] = correct_option
+            session.poll_questions[poll_id] = session.nb_question
+            session.last_seen = time.monotonic()
+            if self._by_chat.get(session.chat_id) is not session:
+                return False
+            self._by_poll[poll_id] = session
+            self._changed.add(session.chat_id)
+        return True
+
+    def advance(self, session: Session, nb_question: int) -> bool:
+        """Move the cursor of session from nb_question to the next question.
+        False if it was moved meanwhile, or the session replaced"""
+        with self._lock:
+            if (
+                self._by_chat.get(session.chat_id) is not session
+                or session.nb_question != nb_question
+            ):
+                return False
+            session.nb_question = nb_question + 1
+            session.last_seen = time.monotonic()
+            self._changed.add(session.chat_id)
+        return True
+
+    def score(
+        self, session: Session, poll_id: str, user_id: int, name: str, correct: bool
+    ) -> bool:
+        """Count the answer of a group member to poll_id, once per poll"""
+        with self._lock:
+            score = session.scores.setdefault(
+                str(user_id), {"name": name, "marks": 0, "poll_id": None}
+            )
+            if score["poll_id"] == poll_id:
+                return False
+            score["name"] = name
+            score["poll_id"] = poll_id
+            score["marks"] += 1 if correct else 0
+            session.last_seen = time.monotonic()
+            if self._by_chat.get(session.chat_id) is session:
+                self._changed.add(session.chat_id)
+        return True
+
+    def close(self, chat_id: int) -> None:
+        with self._lock:
+            session = self._by_chat.pop(chat_id, None)
+            if session is not None:
+                self._by_poll.pop(session.poll_id, None)
+                self._changed.discard(chat_id)
+                self._closed.add(chat_id)
+
+    def evict_expired(self) -> int:
+        """Drop abandoned sessions and return how many were dropped"""
+        deadline = time.monotonic() - self._ttl
+        with self._lock:
+            expired = [
+                chat_id
+                for chat_id, session in self._by_chat.items()
+                if session.last_seen < deadline
+            ]
+            for chat_id in expired:
+                session = self._by_chat.pop(chat_id)
+                self._by_poll.pop(session.poll_id, None)
+                self._changed.discard(chat_id)
+                self._closed.add(chat_id)
+        return len(expired)
+
+    def drain_changes(self) -> Tuple[List[Session], Set[int]]:
+        """Sessions changed and chat ids closed since the previous call"""
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            closed, self._closed = self._closed, set()
+            sessions = [self._by_chat[chat_id] for chat_id in changed]
+        return sessions, closed
+
+    def requeue_changes(self, chat_ids: List[int], closed: Set[int]) -> None:
+        """Mark drained changes as pending again, after a failed write"""
+        with self._lock:
+            self._changed.update(c for c in chat_ids if c in self._by_chat)
+            self._closed.update(c for c in closed if c not in self._by_chat)
+
+    def restore(self, session: Session) -> bool:
+        """Add a persisted session, unless its chat already started a new one"""
+        with self._lock:
+            if session.chat_id in self._by_chat:
+                return False
+            self._by_chat[session.chat_id] = session
+            if session.poll_id is not None:
+                self._by_poll[session.poll_id] = session
+        return True
+
+
+class MongoSessionStore:
+    """Sessions shared by every bot process through a MongoDB collection.
+
+    Documents have the layout of Session.to_doc plus `updated_at`, a wall clock
+    time. Sessions read from the store are copies: a change is only visible to
+    other processes once written by bind_poll or advance, which both only apply
+    if nobody moved the cursor meanwhile.
+    """
+
+    shared = True
+
+    def __init__(self, collection, bank, ttl: int = SESSION_TTL_SECONDS):
+        self._collection = collection
+        # Questions are stored by _id and resolved against the local quiz bank
+        self._bank = bank
+        self._ttl = ttl
+
+    def __len__(self) -> int:
+        return self._collection.estimated_document_count()
+
+    def ensure_indexes(self) -> None:
+        try:
+            self._collection.create_index(
+                [("poll_id", ASCENDING)], name="poll_id", sparse=True
+            )
+            self._collection.create_index(
+                [("updated_at", ASCENDING)], name="updated_at"
+            )
+        except PyMongoError as ex:
+            logger.error("[e]-> Exception in ensure_indexes() -> " + str(ex))
+
+    def _load(self, doc: Optional[dict]) -> Optional[Session]:
+        if doc is None:
+            return None
+        questions = [self._bank.get(quiz_id) for quiz_id in doc["questions"]]
+        if None in questions:
+            # Question removed from the bank meanwhile, session is lost
+            return None
+        return Session.from_doc(doc, questions)
+
+    def open(self, chat_id: int, group: bool = False) -> Session:
+        """New session for chat_id, it replaces the previous one once bound"""
+        return Session(chat_id, group)
+
+    def get(self, chat_id: int) -> Optional[Session]:
+        with metrics.timed("mongo.session_get"):
+            return self._load(self._collection.find_one({"_id": chat_id}))
+
+    def by_poll(self, poll_id: str) -> Optional[Session]:
+        with metrics.timed("mongo.session_get"):
+            return self._load(self._collection.find_one({"poll_id": poll_id}))
+
+    def claim_poll(self, poll_id: str) -> Optional[Session]:
+        """Unbind poll_id and return its session, only the first claim gets it,
+        whichever process it comes from"""
+        if poll_id is None:
+            return None
+        with metrics.timed("mongo.session_claim"):
+            doc = self._collection.find_one_and_update(
+                {"poll_id": poll_id},
+                {"$set": {"poll_id": None, "updated_at": time.time()}},
+                return_document=ReturnDocument.AFTER,
+            )
+        return self._load(doc)
+
+    def bind_poll(
+        self, session: Session, poll_id: str, message_id: int, correct_option: int
+    ) -> bool:
+        """Make poll_id the open poll of session, answers to older polls are ignored.
+        False if the session was moved or replaced by another process meanwhile"""
+        opening = session.poll_id is None and session.nb_question == 0
+        session.poll_id = poll_id
+        session.message_id = message_id
+        session.correct_options[poll_id] = correct_option
+        session.poll_questions[poll_id] = session.nb_question
+        doc = dict(session.to_doc(), updated_at=time.time())
+        with metrics.timed("mongo.session_bind"):
+            if opening:
+                # A new session replaces whatever the chat was running
+                self._collection.replace_one({"_id": session.chat_id}, doc, upsert=True)
+                return True
+            result = self._collection.update_one(
+                {"_id": session.chat_id, "nb_question": session.nb_question},
+                {
+                    "$set": {
+                        "poll_id": poll_id,
+                        "message_id": message_id,
+                        "correct_options." + poll_id: correct_option,
+                        "poll_questions." + poll_id: session.nb_question,
+                        "updated_at": doc["updated_at"],
+                    }
+                },
+            )
+        return result.matched_count == 1
+
+    def advance(self, session: Session, nb_question: int) -> bool:
+        """Compare-and-set the cursor from nb_question to the next question,
+        along with the session marks. False if another process moved it first"""
+        with metrics.timed("mongo.session_advance"):
+            result = self._collection.update_one(
+                {"_id": session.chat_id, "nb_question": nb_question},
+                {
+                    "$set": {
+                        "nb_question": nb_question + 1,
+                        "marks": session.marks,
+                        "updated_at": time.time(),
+                    }
+                },
+            )
+        if result.matched_count != 1:
+            return False
+        session.nb_question = nb_question + 1
+        return True
+
+    def score(
+        self, session: Session, poll_id: str, user_id: int, name: str, correct: bool
+    ) -> bool:
+        """Count the answer of a group member to poll_id, once per poll, even
+        when several processes get it"""
+        field = "scores." + str(user_id)
+        with metrics.timed("mongo.session_score"):
+            result = self._collection.update_one(
+                {"_id": session.chat_id, field + ".poll_id": {"$ne": poll_id}},
+                {
+                    "$set": {field + ".name": name, field + ".poll_id": poll_id},
+                    "$inc": {field + ".marks": 1 if correct else 0},
+                },
+            )
+        return result.matched_count == 1
+
+    def close(self, chat_id: int) -> None:
+        with metrics.timed("mongo.session_close"):
+            self._collection.delete_one({"_id": chat_id})
+
+    def evict_expired(self) -> int:
+        """Drop abandoned sessions and return how many were dropped"""
+        with metrics.timed("mongo.session_evict"):
+            result = self._collection.delete_many(
+                {"updated_at": {"$lt": time.time() - self._ttl}}
+            )
+        return result.deleted_count
+
+    # Every change is written at once, there is nothing to persist behind
+
+    def drain_changes(self) -> Tuple[List[Session], Set[int]]:
+        return [], set()
+
+    def requeue_changes(self, chat_ids: List[int], closed: Set[int]) -> None:
+        pass
+
+    def restore(self, session: Session) -> bool:
+        return False